@@ -0,0 +1,65 @@
+import sys
+import json
+import logging
+import argparse
+import numpy as np
+from haystack import Document
+from vector_index import IVFIndex, recall_report
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def synthetic_corpus(size, dimension, clusters, seed):
+    """Clustered unit vectors, roughly like topic-grouped note embeddings"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimension))
+    labels = rng.integers(0, clusters, size=size)
+    vectors = centers[labels] + rng.normal(scale=0.6, size=(size, dimension))
+    return vectors.astype(np.float32), rng
+
+def load_firestore_corpus(user_id=None):
+    """Embeddings currently stored in Firestore for one user"""
+    from haystack_service import FirebaseSync
+    docs = [doc for doc in FirebaseSync().load_documents(user_id, include_content=False) if doc.embedding is not None]
+    return np.array([doc.embedding for doc in docs], dtype=np.float32)
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k and latency of the IVF index against exact search")
+    parser.add_argument("--size", type=int, default=20000, help="Synthetic corpus size")
+    parser.add_argument("--dimension", type=int, default=768)
+    parser.add_argument("--clusters", type=int, default=200, help="Topic clusters in the synthetic corpus")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--nlist", type=int, default=0, help="IVF lists (0 = ~4*sqrt(n))")
+    parser.add_argument("--nprobe", default="1,2,4,8,16,32", help="Comma-separated nprobe values to sweep")
+    parser.add_argument("--firestore", action="store_true", help="Use embeddings stored in Firestore instead of synthetic data")
+    parser.add_argument("--user-id", help="User whose Firestore embeddings to use (default: the shared partition)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.firestore:
+        vectors = load_firestore_corpus(args.user_id)
+        rng = np.random.default_rng(args.seed)
+    else:
+        vectors, rng = synthetic_corpus(args.size, args.dimension, args.clusters, args.seed)
+    if len(vectors) == 0:
+        print(json.dumps({"error": "No embeddings to index"}))
+        sys.exit(1)
+
+    # Load everything at once and train a single time, rather than retraining as upserts grow the index
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    index = IVFIndex(nlist=args.nlist, min_train_size=1, auto_train=False)
+    index.bulk_load([Document(id=str(i), content="") for i in range(len(vectors))],
+                    vectors / np.maximum(norms, 1e-12))
+    index.train()
+
+    # Queries are perturbed corpus vectors, like a question close to some note
+    picks = rng.integers(0, len(vectors), size=args.queries)
+    queries = vectors[picks] + rng.normal(scale=0.3, size=(args.queries, vectors.shape[1])).astype(np.float32)
+
+    nprobes = [int(n) for n in args.nprobe.split(",") if n]
+    print(json.dumps(recall_report(index, queries, args.top_k, nprobes), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL_SECONDS = 3600
+DEFAULT_THRESHOLD = 0.97
+
+
+class _Entry:
+    __slots__ = ("user_id", "embedding", "reply", "doc_ids", "min_score", "created_at")
+
+    def __init__(self, user_id, embedding, reply, doc_ids, min_score):
+        self.user_id = user_id
+        self.embedding = embedding
+        self.reply = reply
+        self.doc_ids = doc_ids
+        self.min_score = min_score
+        self.created_at = time.time()
+
+
+class AnswerCache:
+    """Generated answers keyed by query embedding, with LRU and TTL eviction
+
+    A lookup hits when a cached query of the same user is within the cosine
+    threshold. Entries stay valid only while their retrieved document set
+    would be unchanged, so mutations invalidate exactly the entries they
+    affect: removing or updating one of an entry's documents, or adding a
+    document that scores high enough to change what would be retrieved.
+    """
+
+    def __init__(self, max_entries=None, ttl_seconds=None, threshold=None):
+        self.max_entries = int(max_entries or os.getenv("ANSWER_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+        self.ttl_seconds = float(ttl_seconds or os.getenv("ANSWER_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS))
+        self.threshold = float(threshold or os.getenv("ANSWER_CACHE_THRESHOLD", DEFAULT_THRESHOLD))
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, user_id, query_embedding):
+        """Return the cached reply for the closest matching query, or None"""
+        query = self._normalize(query_embedding)
+        with self._lock:
+            self._expire()
+            entry_ids = list(self._by_user.get(user_id, ()))
+            best_id, best_score = None, self.threshold
+            for entry_id in entry_ids:
+                entry = self._entries[entry_id]
+                if entry.embedding.shape != query.shape:
+                    continue
+                score = float(entry.embedding @ query)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            logger.info(f"Answer cache hit for user {user_id} (similarity {best_score:.4f})")
+            return self._entries[best_id].reply
+
+    def put(self, user_id, query_embedding, reply, doc_ids, min_score=None):
+        """Cache a reply generated from the given documents
+
+        min_score is the similarity an added document needs to change the
+        retrieved set, or None if any added document could (fewer results
+        than asked for).
+        """
+        if not doc_ids:
+            return
+        entry = _Entry(user_id, self._normalize(query_embedding), reply, frozenset(doc_ids), min_score)
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = entry
+            self._by_user.setdefault(user_id, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                oldest_id = next(iter(self._entries))
+                self._remove(oldest_id)
+                self.evictions += 1
+
+    def documents_changed(self, user_id, documents):
+        """Invalidate entries that added or updated documents could change"""
+        changed_ids = {doc.id for doc in documents}
+        vectors = [self._normalize(doc.embedding) for doc in documents if doc.embedding is not None]
+        with self._lock:
+            stale = []
+            for entry_id in self._by_user.get(user_id, ()):
+                entry = self._entries[entry_id]
+                if entry.doc_ids & changed_ids or entry.min_score is None:
+                    stale.append(entry_id)
+                elif any(v.shape == entry.embedding.shape and float(v @ entry.embedding) >= entry.min_score
+                         for v in vectors):
+                    stale.append(entry_id)
+            self._invalidate(stale)
+
+    def documents_removed(self, user_id, doc_ids):
+        """Invalidate entries whose answer drew on any of the removed documents"""
+        doc_ids = set(doc_ids)
+        with self._lock:
+            stale = [entry_id for entry_id in self._by_user.get(user_id, ())
+                     if self._entries[entry_id].doc_ids & doc_ids]
+            self._invalidate(stale)
+
+    def invalidate_user(self, user_id):
+        """Drop every entry of one user"""
+        with self._lock:
+            self._invalidate(list(self._by_user.get(user_id, ())))
+
+    def _invalidate(self, entry_ids):
+        for entry_id in entry_ids:
+            self._remove(entry_id)
+        self.invalidations += len(entry_ids)
+        if entry_ids:
+            logger.info(f"Invalidated {len(entry_ids)} cached answers")
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        user_entries = self._by_user.get(entry.user_id)
+        if user_entries is not None:
+            user_entries.discard(entry_id)
+            if not user_entries:
+                del self._by_user[entry.user_id]
+
+    def _expire(self):
+        """Drop entries older than the TTL; the oldest entries are not always least recently used"""
+        cutoff = time.time() - self.ttl_seconds
+        expired = [entry_id for entry_id, entry in self._entries.items() if entry.created_at < cutoff]
+        for entry_id in expired:
+            self._remove(entry_id)
+        self.expirations += len(expired)
+
+    def stats(self):
+        """Hit/miss and eviction counters for the cache"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0
+            }
@@ -0,0 +1,25 @@
+import sys
+import json
+import logging
+from haystack_service import FirebaseSync
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def backfill_partition_fields(dry_run=False):
+    try:
+        result = FirebaseSync().backfill_partition_fields(dry_run=dry_run)
+        print(json.dumps({"success": True, "dry_run": dry_run, **result}))
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error backfilling partition fields: {error_msg}")
+        print(json.dumps({"success": False, "error": error_msg}))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    if any(arg != "--dry-run" for arg in sys.argv[1:]):
+        print("Usage: python backfill_partition_fields.py [--dry-run]")
+        sys.exit(1)
+
+    backfill_partition_fields(dry_run="--dry-run" in sys.argv)
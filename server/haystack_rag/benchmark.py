@@ -0,0 +1,313 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Query stages reported from HaystackService timing, plus the end-to-end total
+QUERY_STAGES = ("embedding", "retrieval", "content", "prompt", "total")
+RESULTS_VERSION = 1
+
+TOPICS = {
+    "gardening": "tomato compost seedling mulch pruning soil basil trellis watering harvest aphids raised bed",
+    "cooking": "sourdough starter braise knife stock simmer roast marinade spices pasta dough oven",
+    "travel": "itinerary flight hostel passport train museum layover backpack visa hiking ferry market",
+    "fitness": "squat deadlift cadence interval recovery stretching protein mileage tempo rowing mobility",
+    "finance": "budget savings index fund mortgage invoice taxes expenses dividend spreadsheet retirement",
+    "programming": "refactor python deploy database latency cache queue api regression index thread",
+    "reading": "novel chapter author essay quotes library memoir poetry translation annotations",
+    "music": "guitar chords practice metronome scales melody rehearsal piano rhythm recording",
+    "health": "sleep doctor appointment allergy vitamins migraine posture hydration therapy",
+    "work": "meeting roadmap deadline stakeholder review hiring feedback quarterly planning",
+    "home": "renovation plumbing paint shelves insulation furniture lease repair boiler garden",
+    "learning": "spanish vocabulary flashcards grammar course lecture notes exam calculus statistics",
+}
+COMMON_WORDS = ("today I noticed that the plan for next week should include more time for this and "
+                "maybe try something different because last time it went well but could be better").split()
+
+
+def synthetic_note(index, rng):
+    """One note: a topic, a title and one to six paragraphs mixing topic and filler words"""
+    topic = rng.choice(sorted(TOPICS))
+    vocabulary = TOPICS[topic].split()
+    paragraphs = []
+    for _ in range(rng.randint(1, 6)):
+        sentences = []
+        for _ in range(rng.randint(2, 6)):
+            words = [rng.choice(vocabulary) if rng.random() < 0.4 else rng.choice(COMMON_WORDS)
+                     for _ in range(rng.randint(6, 16))]
+            sentences.append(" ".join(words).capitalize() + ".")
+        paragraphs.append(" ".join(sentences))
+    return {
+        "id": f"note-{index:06d}",
+        "title": f"{topic.capitalize()} note {index}",
+        "content": "\n\n".join(paragraphs)
+    }
+
+
+def synthetic_question(note, rng):
+    """A question about a note, built from some of its topical words"""
+    words = [word for word in note["content"].lower().replace(".", "").split() if word not in COMMON_WORDS]
+    picked = rng.sample(sorted(set(words)), min(3, len(set(words)))) if words else ["notes"]
+    return f"What did I write about {', '.join(picked)}?"
+
+
+def synthetic_corpus(size, seed=0, batch_size=500, question_count=100):
+    """Yield batches of synthetic notes, and collect questions about randomly chosen ones
+
+    Returns (batches generator, questions list); the list fills as batches are consumed.
+    """
+    rng = random.Random(seed)
+    question_rng = random.Random(seed + 1)
+    asked = set(question_rng.sample(range(size), min(question_count, size)))
+    questions = []
+
+    def batches():
+        batch = []
+        for index in range(size):
+            note = synthetic_note(index, rng)
+            if index in asked:
+                questions.append(synthetic_question(note, question_rng))
+            batch.append(note)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    return batches(), questions
+
+
+def percentiles(values):
+    """Summary of latencies in milliseconds"""
+    if not values:
+        return {"count": 0}
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        "count": int(values.size),
+        "mean": round(float(values.mean()), 3),
+        "p50": round(float(np.percentile(values, 50)), 3),
+        "p95": round(float(np.percentile(values, 95)), 3),
+        "p99": round(float(np.percentile(values, 99)), 3),
+        "max": round(float(values.max()), 3)
+    }
+
+
+def run_size(service, size, args):
+    """Ingest a synthetic corpus of one size, then measure a cold load, queries and a clear"""
+    user_id = f"bench-{size}"
+    cleared = None
+    try:
+        batches, questions = synthetic_corpus(size, args.seed, args.batch_size, args.queries)
+
+        # Ingestion through the same path as the insert command
+        batch_ms, chunks = [], 0
+        ingest_start = time.perf_counter()
+        for batch in batches:
+            start = time.perf_counter()
+            result = service.add_documents(batch, user_id)
+            batch_ms.append((time.perf_counter() - start) * 1000)
+            chunks += result["chunk_count"]
+        ingest_seconds = time.perf_counter() - ingest_start
+
+        # Cold load of the partition from the store
+        service.partitions.drop(user_id)
+        start = time.perf_counter()
+        partition = service.partitions.get(user_id)
+        load_ms = (time.perf_counter() - start) * 1000
+        load = {"ms": round(load_ms, 3), "documents": len(partition.index), "memory_bytes": partition.memory_bytes()}
+
+        # Queries, with a few unmeasured ones first
+        stage_ms = {stage: [] for stage in QUERY_STAGES}
+        for i, question in enumerate(questions[:args.warmup] + questions):
+            timing, usage = {}, {}
+            start = time.perf_counter()
+            service._retrieve(question, user_id, timing, usage, args.mode)
+            timing["total"] = (time.perf_counter() - start) * 1000
+            if i < args.warmup:
+                continue
+            for stage in QUERY_STAGES:
+                if stage in timing:
+                    stage_ms[stage].append(timing[stage])
+
+        start = time.perf_counter()
+        cleared = service.clear_documents(user_id)
+        clear_seconds = time.perf_counter() - start
+    finally:
+        # Leave no benchmark data behind, even when a step above failed
+        if cleared is None:
+            service.clear_documents(user_id)
+        service.partitions.drop(user_id)
+
+    return {
+        "size": size,
+        "ingestion": {
+            "notes": size,
+            "chunks": chunks,
+            "seconds": round(ingest_seconds, 3),
+            "notes_per_second": round(size / ingest_seconds, 1) if ingest_seconds else 0.0,
+            "chunks_per_second": round(chunks / ingest_seconds, 1) if ingest_seconds else 0.0,
+            "batch_ms": percentiles(batch_ms)
+        },
+        "load": load,
+        "query": {stage: percentiles(values) for stage, values in stage_ms.items()},
+        "clear": {
+            "deleted": cleared["deleted"],
+            "seconds": round(clear_seconds, 3)
+        }
+    }
+
+
+def compare(results, baseline, threshold, min_delta_ms=0.0):
+    """Flag latencies and throughputs that got worse than the baseline by more than threshold
+
+    Latencies must also have moved by at least min_delta_ms, so jitter on
+    sub-millisecond stages is not reported as a regression.
+    """
+    baseline_sizes = {entry["size"]: entry for entry in baseline.get("results", [])}
+    comparisons, regressions = [], []
+    for entry in results["results"]:
+        before = baseline_sizes.get(entry["size"])
+        if before is None:
+            continue
+        metrics = [(f"query.{stage}.{q}", entry["query"][stage].get(q), before["query"].get(stage, {}).get(q), "lower")
+                   for stage in QUERY_STAGES for q in ("p50", "p95", "p99")]
+        metrics += [
+            ("ingestion.chunks_per_second", entry["ingestion"]["chunks_per_second"],
+             before["ingestion"]["chunks_per_second"], "higher"),
+            ("load.ms", entry["load"]["ms"], before["load"]["ms"], "lower"),
+        ]
+        for name, current, previous, better in metrics:
+            if current is None or not previous:
+                continue
+            change = (current - previous) / previous
+            comparison = {"size": entry["size"], "metric": name, "baseline": previous,
+                          "current": current, "change": round(change, 4)}
+            comparisons.append(comparison)
+            if better == "lower":
+                regressed = change > threshold and current - previous >= min_delta_ms
+            else:
+                regressed = change < -threshold
+            if regressed:
+                regressions.append(comparison)
+    return {"baseline_commit": baseline.get("commit"), "threshold": threshold, "min_delta_ms": min_delta_ms,
+            "regressions": regressions, "comparisons": comparisons}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark HaystackService ingestion and query stages against local Ollama and Firestore stand-ins")
+    parser.add_argument("--sizes", default="100,1000,10000", help="Comma-separated corpus sizes, e.g. 100,1000,10000,100000")
+    parser.add_argument("--queries", type=int, default=100, help="Measured queries per corpus size")
+    parser.add_argument("--warmup", type=int, default=5, help="Unmeasured queries run first")
+    parser.add_argument("--batch-size", type=int, default=500, help="Notes per add_documents call")
+    parser.add_argument("--mode", default="vector", help="Retrieval mode for the queries")
+    parser.add_argument("--dimension", type=int, default=768, help="Fake embedding dimension")
+    parser.add_argument("--ollama-latency-ms", type=float, default=0.0, help="Fake Ollama latency per request")
+    parser.add_argument("--ollama-per-text-ms", type=float, default=0.0, help="Fake Ollama latency per embedded text")
+    parser.add_argument("--ollama-host", help="Use this Ollama server instead of the fake one")
+    parser.add_argument("--firestore", choices=("memory", "emulator"), default="memory",
+                        help="In-memory fake, or the emulator at FIRESTORE_EMULATOR_HOST")
+    parser.add_argument("--firestore-latency-ms", type=float, default=0.0, help="In-memory Firestore latency per round trip")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the results to this file")
+    parser.add_argument("--compare", help="Baseline results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="Smallest latency increase, in milliseconds, counted as a regression")
+    parser.add_argument("--verbose", action="store_true", help="Keep the service's INFO logging")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    # Configure the service before it is imported: a throwaway embedding
+    # cache, no snapshots or answer cache, and the fake Ollama server
+    workdir = tempfile.mkdtemp(prefix="haystack-bench-")
+    os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(workdir, "embeddings.sqlite3")
+    os.environ.setdefault("SNAPSHOTS_ENABLED", "0")
+    os.environ.setdefault("ANSWER_CACHE_ENABLED", "0")
+    if args.mode != "vector":
+        # Lexical retrieval needs content in memory
+        os.environ.setdefault("LAZY_CONTENT", "0")
+    fake_ollama = None
+    if args.ollama_host:
+        os.environ["OLLAMA_HOST"] = args.ollama_host
+    else:
+        from fake_ollama import FakeOllamaServer
+        fake_ollama = FakeOllamaServer(dimension=args.dimension, latency_ms=args.ollama_latency_ms,
+                                       per_text_ms=args.ollama_per_text_ms)
+        os.environ["OLLAMA_HOST"] = fake_ollama.start()
+
+    import haystack_service
+    if args.firestore == "memory":
+        from fake_firestore import InMemoryFirestore
+        haystack_service.FirebaseSync(db=InMemoryFirestore(rpc_latency_ms=args.firestore_latency_ms))
+    elif not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        parser.error("--firestore emulator needs FIRESTORE_EMULATOR_HOST")
+
+    start = time.perf_counter()
+    service = haystack_service.HaystackService()
+    startup_ms = (time.perf_counter() - start) * 1000
+
+    results = {
+        "version": RESULTS_VERSION,
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "platform": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "config": {
+            "queries": args.queries,
+            "batch_size": args.batch_size,
+            "mode": args.mode,
+            "dimension": args.dimension if fake_ollama else None,
+            "ollama": args.ollama_host or "fake",
+            "ollama_latency_ms": args.ollama_latency_ms,
+            "ollama_per_text_ms": args.ollama_per_text_ms,
+            "firestore": args.firestore,
+            "firestore_latency_ms": args.firestore_latency_ms,
+            "seed": args.seed,
+            "lazy_content": haystack_service.LAZY_CONTENT,
+            "ingest_slice_chunks": haystack_service.INGEST_SLICE_CHUNKS,
+            "vector_index": os.getenv("VECTOR_INDEX_BACKEND", "exact")
+        },
+        "startup_ms": round(startup_ms, 3),
+        "results": []
+    }
+    for size in sizes:
+        logger.warning(f"Benchmarking corpus of {size} notes...")
+        results["results"].append(run_size(service, size, args))
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare) as f:
+            results["comparison"] = compare(results, json.load(f), args.threshold, args.min_delta_ms)
+        exit_code = 1 if results["comparison"]["regressions"] else 0
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    if fake_ollama is not None:
+        fake_ollama.stop()
+    sys.exit(exit_code)
+
+if __name__ == "__main__":
+    main()
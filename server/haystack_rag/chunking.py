@@ -0,0 +1,156 @@
+import os
+
+from text_units import CHARS_PER_TOKEN, PARAGRAPH_BREAK, SENTENCE_BREAK, estimate_tokens
+
+DEFAULT_CHUNK_TOKENS = 256
+DEFAULT_CHUNK_OVERLAP_TOKENS = 32
+
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", DEFAULT_CHUNK_TOKENS))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", DEFAULT_CHUNK_OVERLAP_TOKENS))
+
+
+def _word_windows(text, max_tokens):
+    """Split text without usable sentence breaks into pieces of at most max_tokens"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    pieces, current = [], ""
+    for word in text.split():
+        if current and len(current) + 1 + len(word) > max_chars:
+            pieces.append(current)
+            current = word
+        else:
+            current = f"{current} {word}" if current else word
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _units(text, max_tokens):
+    """Paragraphs, or the sentences (and word windows) of paragraphs too long for one chunk
+
+    Returns (text, separator) pairs, where separator joins the unit to the one before it.
+    """
+    units = []
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if estimate_tokens(paragraph) <= max_tokens:
+            units.append((paragraph, "\n\n"))
+            continue
+        separator = "\n\n"
+        for sentence in SENTENCE_BREAK.split(paragraph):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            pieces = [sentence] if estimate_tokens(sentence) <= max_tokens else _word_windows(sentence, max_tokens)
+            for piece in pieces:
+                units.append((piece, separator))
+                separator = " "
+    return units
+
+
+def _tail_sentences(text, max_tokens):
+    """The longest run of closing sentences of text that fits in max_tokens"""
+    tail = ""
+    for sentence in reversed(SENTENCE_BREAK.split(text)):
+        candidate = f"{sentence} {tail}".strip()
+        if estimate_tokens(candidate) + 1 > max_tokens:
+            break
+        tail = candidate
+    return tail
+
+
+def _join(units):
+    return "".join(sep + text if i else text for i, (text, sep) in enumerate(units))
+
+
+def split_text(text, max_tokens=None, overlap_tokens=None):
+    """Split text into chunks of at most max_tokens that break at paragraphs where possible
+
+    Consecutive chunks share up to overlap_tokens of trailing paragraphs or
+    sentences, so a passage cut at a boundary is still whole in one chunk.
+    """
+    max_tokens = max_tokens or CHUNK_TOKENS
+    overlap_tokens = CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+    text = (text or "").strip()
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+
+    chunks = []
+    current, current_tokens = [], 0
+    for unit in _units(text, max_tokens):
+        unit_tokens = estimate_tokens(unit[0]) + 1
+        if current and current_tokens + unit_tokens > max_tokens:
+            chunks.append(_join(current))
+            # Carry the tail of this chunk into the next one
+            overlap, overlap_size = [], 0
+            for previous in reversed(current):
+                size = estimate_tokens(previous[0]) + 1
+                room = min(overlap_tokens, max_tokens - unit_tokens) - overlap_size
+                if size > room:
+                    # Fall back to the closing sentences of a unit too long to repeat whole
+                    tail = _tail_sentences(previous[0], room)
+                    if tail:
+                        overlap.insert(0, (tail, previous[1]))
+                        overlap_size += estimate_tokens(tail) + 1
+                    break
+                overlap.insert(0, previous)
+                overlap_size += size
+            current, current_tokens = overlap, overlap_size
+        current.append(unit)
+        current_tokens += unit_tokens
+    if current:
+        chunks.append(_join(current))
+    return chunks
+
+
+def chunk_id(parent_id, index, count):
+    """Document ID of a chunk; single-chunk notes keep the note's own ID"""
+    return parent_id if count == 1 else f"{parent_id}#{index}"
+
+
+def parent_id_of(doc):
+    """ID of the note a chunk belongs to; documents stored before chunking are their own parent"""
+    return doc.meta.get("parent_id") or doc.id
+
+
+class NoteHit:
+    """Retrieved chunks of one note, scored by its best chunk"""
+
+    def __init__(self, parent_id):
+        self.parent_id = parent_id
+        self.score = None
+        self.chunks = []
+
+    def add(self, doc, score):
+        self.chunks.append((doc, score))
+        if self.score is None or score > self.score:
+            self.score = score
+
+    @property
+    def best_chunk(self):
+        return max(self.chunks, key=lambda pair: pair[1])[0]
+
+    @property
+    def meta(self):
+        return self.best_chunk.meta
+
+    def text(self):
+        """The hit chunks in note order"""
+        ordered = sorted(self.chunks, key=lambda pair: pair[0].meta.get("chunk_index", 0))
+        return "\n\n".join(doc.content for doc, _ in ordered)
+
+
+def group_hits(hits, top_k, max_chunks_per_note=3):
+    """Group (chunk, score) hits by note and return the top_k notes, best first"""
+    notes = {}
+    for doc, score in hits:
+        parent_id = parent_id_of(doc)
+        note = notes.get(parent_id)
+        if note is None:
+            if len(notes) == top_k:
+                continue
+            note = notes[parent_id] = NoteHit(parent_id)
+        if len(note.chunks) < max_chunks_per_note:
+            note.add(doc, score)
+    return sorted(notes.values(), key=lambda note: note.score, reverse=True)
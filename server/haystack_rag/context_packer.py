@@ -0,0 +1,161 @@
+import logging
+import os
+import re
+
+from text_units import CHARS_PER_TOKEN, PARAGRAPH_BREAK, SENTENCE_BREAK, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOKEN_BUDGET = 2000
+DEFAULT_MAX_DOC_TOKENS = 800
+DEFAULT_DEDUP_THRESHOLD = 0.8
+
+_WORD_RE = re.compile(r"\w+")
+_ELLIPSIS = " … "
+
+
+def _terms(text):
+    return {word for word in _WORD_RE.findall(text.lower()) if len(word) > 2}
+
+
+def _shingles(text, size=3):
+    words = _WORD_RE.findall(text.lower())
+    if len(words) <= size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _passages(text, max_tokens):
+    """Split text into paragraphs, and paragraphs longer than max_tokens into sentences"""
+    passages = []
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if estimate_tokens(paragraph) <= max_tokens:
+            passages.append(paragraph)
+        else:
+            passages.extend(s.strip() for s in SENTENCE_BREAK.split(paragraph) if s.strip())
+    return passages
+
+
+def truncate(text, max_tokens):
+    """Cut text to max_tokens, at a word boundary where possible"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars - len(_ELLIPSIS)]
+    space = cut.rfind(" ")
+    if space > max_chars // 2:
+        cut = cut[:space]
+    return cut.rstrip() + _ELLIPSIS.rstrip()
+
+
+def trim_to_relevant(text, question_terms, max_tokens):
+    """Keep the passage that best matches the question plus as many neighbours as fit"""
+    passages = _passages(text, max_tokens)
+    if not passages:
+        return ""
+    scores = [len(_terms(p) & question_terms) for p in passages]
+    best = max(range(len(passages)), key=lambda i: (scores[i], -i))
+
+    first = last = best
+    used = estimate_tokens(passages[best])
+    if used > max_tokens:
+        return truncate(passages[best], max_tokens)
+
+    # Grow the window towards whichever neighbour matches the question better
+    while True:
+        candidates = []
+        if first > 0:
+            candidates.append((scores[first - 1], first - 1))
+        if last < len(passages) - 1:
+            candidates.append((scores[last + 1], last + 1))
+        added = False
+        for _, i in sorted(candidates, reverse=True):
+            cost = estimate_tokens(passages[i]) + 1
+            # Leave room for the ellipses marking omitted text
+            if used + cost <= max_tokens - 2:
+                used += cost
+                first, last = min(first, i), max(last, i)
+                added = True
+                break
+        if not added:
+            break
+
+    window = "\n".join(passages[first:last + 1])
+    if first > 0:
+        window = _ELLIPSIS.lstrip() + window
+    if last < len(passages) - 1:
+        window = window + _ELLIPSIS.rstrip()
+    return window
+
+
+class ContextPacker:
+    """Fits retrieved documents into a token budget for the prompt
+
+    Documents are taken in relevance order. Near-duplicates of a document
+    already packed are skipped, and documents longer than their share of
+    the remaining budget are trimmed to the passage that best matches the
+    question.
+    """
+
+    def __init__(self, token_budget=None, max_doc_tokens=None, dedup_threshold=None):
+        self.token_budget = int(token_budget or os.getenv("CONTEXT_TOKEN_BUDGET", DEFAULT_TOKEN_BUDGET))
+        self.max_doc_tokens = int(max_doc_tokens or os.getenv("CONTEXT_MAX_DOC_TOKENS", DEFAULT_MAX_DOC_TOKENS))
+        self.dedup_threshold = float(dedup_threshold or os.getenv("CONTEXT_DEDUP_THRESHOLD", DEFAULT_DEDUP_THRESHOLD))
+
+    def _is_duplicate(self, shingles, packed_shingles):
+        """Whether most of a document's shingles already appear in one packed document"""
+        if not shingles:
+            return False
+        return any(len(shingles & other) / len(shingles) >= self.dedup_threshold for other in packed_shingles)
+
+    def pack(self, question, texts):
+        """Return (packed texts aligned with the input, None where dropped, stats)"""
+        question_terms = _terms(question)
+        packed = [None] * len(texts)
+        packed_shingles = []
+        remaining = self.token_budget
+        original_tokens = used = truncated = deduplicated = 0
+
+        for i, text in enumerate(texts):
+            text = (text or "").strip()
+            tokens = estimate_tokens(text)
+            original_tokens += tokens
+            if not text or remaining <= 0:
+                continue
+
+            shingles = _shingles(text)
+            if self._is_duplicate(shingles, packed_shingles):
+                deduplicated += 1
+                continue
+
+            # Split what is left evenly over the documents still to come;
+            # anything a short document leaves unused carries over
+            allowance = min(self.max_doc_tokens, remaining // (len(texts) - i))
+            allowance = max(allowance, min(remaining, 32))
+            if tokens > allowance:
+                text = trim_to_relevant(text, question_terms, allowance)
+                tokens = estimate_tokens(text)
+                truncated += 1
+            if not text:
+                continue
+
+            packed[i] = text
+            packed_shingles.append(shingles)
+            used += tokens
+            remaining -= tokens
+
+        stats = {
+            "context_tokens": used,
+            "token_budget": self.token_budget,
+            "original_tokens": original_tokens,
+            "documents": len(texts),
+            "packed": sum(1 for text in packed if text is not None),
+            "truncated": truncated,
+            "deduplicated": deduplicated
+        }
+        logger.info(f"Packed {stats['packed']}/{len(texts)} documents into {used} of "
+                    f"{self.token_budget} context tokens ({original_tokens} before packing)")
+        return packed, stats
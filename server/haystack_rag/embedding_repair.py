@@ -0,0 +1,113 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_INTERVAL_SECONDS = 0.5
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+class RepairQueue:
+    """Background re-embedding of documents whose stored embedding is missing or stale
+
+    Documents are queued per user and handed to repair_fn(user_id, documents)
+    in batches by one daemon thread, taking users in turn. The worker pauses
+    between batches so repairs yield to interactive embedding and writes.
+    repair_fn returns the documents it could not repair; they are retried up
+    to max_attempts times. Queueing a document that is already pending
+    replaces the pending copy.
+    """
+
+    def __init__(self, repair_fn, batch_size=None, interval_seconds=None, max_attempts=None):
+        self._repair_fn = repair_fn
+        self.batch_size = int(batch_size or os.getenv("REPAIR_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+        self.interval_seconds = float(interval_seconds if interval_seconds is not None
+                                      else os.getenv("REPAIR_INTERVAL_SECONDS", DEFAULT_INTERVAL_SECONDS))
+        self.max_attempts = int(max_attempts or os.getenv("REPAIR_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS))
+        # user_id -> OrderedDict of doc_id -> (document, attempts so far)
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self.queued = 0
+        self.repaired = 0
+        self.failed = 0
+        self.last_error = None
+        self._thread = threading.Thread(target=self._run, name="embedding-repair", daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id, documents, attempts=0):
+        """Queue documents of one user for re-embedding"""
+        documents = list(documents)
+        if not documents:
+            return
+        with self._condition:
+            user_pending = self._pending.setdefault(user_id, OrderedDict())
+            for doc in documents:
+                user_pending[doc.id] = (doc, attempts)
+            self.queued += len(documents)
+            self._condition.notify()
+        if not attempts:
+            logger.info(f"Queued {len(documents)} documents of user {user_id} for embedding repair")
+
+    def backlog(self, user_id=None):
+        """Documents waiting for or undergoing repair, for one user or all of them"""
+        with self._condition:
+            if user_id is not None:
+                return len(self._pending.get(user_id, ()))
+            return sum(len(docs) for docs in self._pending.values()) + self._in_flight
+
+    def _next_batch(self):
+        """Take up to batch_size documents of the user first in line, then move that user to the back"""
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            user_id, user_pending = next(iter(self._pending.items()))
+            batch = [user_pending.popitem(last=False) for _ in range(min(self.batch_size, len(user_pending)))]
+            if user_pending:
+                self._pending.move_to_end(user_id)
+            else:
+                del self._pending[user_id]
+            self._in_flight = len(batch)
+            return user_id, batch
+
+    def _run(self):
+        while True:
+            user_id, batch = self._next_batch()
+            documents = [doc for _, (doc, _) in batch]
+            try:
+                failed = {doc.id for doc in self._repair_fn(user_id, documents) or ()}
+            except Exception as e:
+                logger.warning(f"Embedding repair of {len(documents)} documents for user {user_id} failed: {str(e)}")
+                self.last_error = str(e)
+                failed = {doc.id for doc in documents}
+
+            retry = [(doc, attempts + 1) for doc_id, (doc, attempts) in batch if doc_id in failed]
+            with self._condition:
+                self._in_flight = 0
+                self.repaired += len(batch) - len(retry)
+                given_up = [doc for doc, attempts in retry if attempts >= self.max_attempts]
+                self.failed += len(given_up)
+            for doc, attempts in retry:
+                if attempts < self.max_attempts:
+                    self.submit(user_id, [doc], attempts=attempts)
+            if given_up:
+                logger.error(f"Gave up repairing embeddings of {len(given_up)} documents for user {user_id} "
+                             f"after {self.max_attempts} attempts")
+            if self.interval_seconds:
+                time.sleep(self.interval_seconds)
+
+    def stats(self):
+        """Backlog and repair counters"""
+        with self._condition:
+            return {
+                "backlog": sum(len(docs) for docs in self._pending.values()) + self._in_flight,
+                "users": len(self._pending),
+                "queued": self.queued,
+                "repaired": self.repaired,
+                "failed": self.failed,
+                "last_error": self.last_error
+            }
@@ -0,0 +1,304 @@
+import bisect
+import copy
+import operator
+import threading
+import time
+from datetime import datetime, timezone
+
+# The subset of the google-cloud-firestore client API that FirebaseSync
+# uses, held in memory: document get/set/update/delete, filtered queries
+# with ordering, projection, limits and cursors, batched writes and
+# get_all. rpc_latency_ms is added to every round trip, to approximate
+# the network.
+
+_OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda value, options: value in options,
+}
+
+
+def _is_server_timestamp(value):
+    from google.cloud.firestore_v1.transforms import SERVER_TIMESTAMP
+    return value is SERVER_TIMESTAMP
+
+
+def _get_path(data, field_path):
+    """Value at a dotted field path, or KeyError"""
+    value = data
+    for part in field_path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(field_path)
+        value = value[part]
+    return value
+
+
+def _project(data, field_paths):
+    """Copy of data with only the given (top-level or dotted) fields"""
+    projected = {}
+    for field_path in field_paths:
+        try:
+            value = _get_path(data, field_path)
+        except KeyError:
+            continue
+        target = projected
+        parts = field_path.split(".")
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return projected
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.copy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        return _get_path(self._data, field_path)
+
+
+class DocumentReference:
+    def __init__(self, collection, doc_id):
+        self._collection = collection
+        self.id = doc_id
+
+    def get(self, field_paths=None):
+        self._collection._client._round_trip()
+        return self._collection._snapshot(self.id, field_paths)
+
+    def set(self, data):
+        self._collection._client._round_trip()
+        self._collection._set(self.id, data)
+
+    def update(self, data):
+        self._collection._client._round_trip()
+        self._collection._update(self.id, data)
+
+    def delete(self):
+        self._collection._client._round_trip()
+        self._collection._delete(self.id)
+
+
+class Query:
+    def __init__(self, collection, filters=(), orders=(), fields=None, limit=None, cursor=None):
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._fields = fields
+        self._limit = limit
+        self._cursor = cursor
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, fields=self._fields,
+                     limit=self._limit, cursor=self._cursor)
+        state.update(changes)
+        return Query(self._collection, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in _OPERATORS:
+            raise ValueError(f"Unsupported operator: {op_string}")
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        if direction != "ASCENDING":
+            raise ValueError("Only ascending order is supported")
+        return self._copy(orders=self._orders + (field_path,))
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot):
+        return self._copy(cursor=snapshot)
+
+    def _matches(self, data):
+        for field_path, op_string, value in self._filters:
+            try:
+                if not _OPERATORS[op_string](_get_path(data, field_path), value):
+                    return False
+            except (KeyError, TypeError):
+                return False
+        return True
+
+    def _sort_key(self, doc_id, data):
+        return tuple(doc_id if field == "__name__" else _get_path(data, field) for field in self._orders)
+
+    def _run(self):
+        collection = self._collection
+        collection._client._round_trip()
+        with collection._lock:
+            if self._orders in ((), ("__name__",)):
+                # Document-ID order: seek straight to the cursor
+                ids = collection._sorted_ids()
+                start = bisect.bisect_right(ids, self._cursor.id) if self._cursor is not None else 0
+                results = []
+                for doc_id in ids[start:]:
+                    data = collection._documents[doc_id]
+                    if self._matches(data):
+                        results.append((doc_id, data))
+                        if self._limit is not None and len(results) == self._limit:
+                            break
+            else:
+                rows = []
+                for doc_id, data in collection._documents.items():
+                    if not self._matches(data):
+                        continue
+                    try:
+                        rows.append((self._sort_key(doc_id, data), doc_id, data))
+                    except KeyError:
+                        # Documents without an ordered field are left out, as in Firestore
+                        continue
+                rows.sort(key=lambda row: row[0])
+                if self._cursor is not None:
+                    after = self._sort_key(self._cursor.id, self._cursor._data)
+                    rows = rows[bisect.bisect_right([row[0] for row in rows], after):]
+                results = [(doc_id, data) for _, doc_id, data in rows[:self._limit]]
+            return [
+                DocumentSnapshot(DocumentReference(collection, doc_id),
+                                 _project(data, self._fields) if self._fields is not None else copy.copy(data))
+                for doc_id, data in results
+            ]
+
+    def get(self):
+        return self._run()
+
+    def stream(self):
+        return iter(self._run())
+
+
+class CollectionReference(Query):
+    def __init__(self, client, name):
+        super().__init__(self)
+        self._client = client
+        self.id = name
+        self._documents = {}
+        self._ids = None
+        self._lock = threading.RLock()
+
+    def document(self, doc_id):
+        return DocumentReference(self, doc_id)
+
+    def _sorted_ids(self):
+        if self._ids is None:
+            self._ids = sorted(self._documents)
+        return self._ids
+
+    def _snapshot(self, doc_id, field_paths=None):
+        with self._lock:
+            data = self._documents.get(doc_id)
+            if data is not None:
+                data = _project(data, field_paths) if field_paths is not None else copy.copy(data)
+            return DocumentSnapshot(DocumentReference(self, doc_id), data)
+
+    def _resolve(self, data):
+        now = datetime.now(timezone.utc)
+        return {key: now if _is_server_timestamp(value) else value for key, value in data.items()}
+
+    def _set(self, doc_id, data):
+        with self._lock:
+            if doc_id not in self._documents:
+                self._ids = None
+            self._documents[doc_id] = self._resolve(data)
+
+    def _update(self, doc_id, data):
+        from google.api_core.exceptions import NotFound
+        with self._lock:
+            if doc_id not in self._documents:
+                raise NotFound(f"No document to update: {self.id}/{doc_id}")
+            self._documents[doc_id] = {**self._documents[doc_id], **self._resolve(data)}
+
+    def _delete(self, doc_id):
+        with self._lock:
+            if self._documents.pop(doc_id, None) is not None:
+                self._ids = None
+
+    def __len__(self):
+        return len(self._documents)
+
+
+class WriteBatch:
+    """Buffered writes applied together on commit; an update of a missing document fails the batch"""
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, data):
+        self._writes.append(("set", reference, data))
+
+    def update(self, reference, data):
+        self._writes.append(("update", reference, data))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference, None))
+
+    def commit(self):
+        from google.api_core.exceptions import NotFound
+        self._client._round_trip()
+        collections = {reference._collection for _, reference, _ in self._writes}
+        for collection in collections:
+            collection._lock.acquire()
+        try:
+            for op, reference, _ in self._writes:
+                if op == "update" and reference.id not in reference._collection._documents:
+                    raise NotFound(f"No document to update: {reference._collection.id}/{reference.id}")
+            for op, reference, data in self._writes:
+                collection = reference._collection
+                if op == "set":
+                    collection._set(reference.id, data)
+                elif op == "update":
+                    collection._update(reference.id, data)
+                else:
+                    collection._delete(reference.id)
+        finally:
+            for collection in collections:
+                collection._lock.release()
+        self._client.commits += 1
+        return []
+
+
+class InMemoryFirestore:
+    """In-memory stand-in for a Firestore client"""
+
+    def __init__(self, rpc_latency_ms=0.0):
+        self.rpc_latency_ms = rpc_latency_ms
+        self._collections = {}
+        self._lock = threading.Lock()
+        self.round_trips = 0
+        self.commits = 0
+
+    def _round_trip(self):
+        self.round_trips += 1
+        if self.rpc_latency_ms:
+            time.sleep(self.rpc_latency_ms / 1000)
+
+    def collection(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = CollectionReference(self, name)
+            return self._collections[name]
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def get_all(self, references, field_paths=None):
+        self._round_trip()
+        for reference in references:
+            yield reference._collection._snapshot(reference.id, field_paths)
@@ -0,0 +1,149 @@
+import json
+import hashlib
+import logging
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from lexical_index import tokenize
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIMENSION = 768
+
+
+class HashingEmbedder:
+    """Deterministic text embeddings: the normalized sum of a fixed random vector per token
+
+    Texts sharing words get similar vectors, so retrieval over a synthetic
+    corpus ranks topical matches first, as a real model would.
+    """
+
+    def __init__(self, dimension=DEFAULT_DIMENSION):
+        self.dimension = dimension
+        self._token_vectors = {}
+        self._lock = threading.Lock()
+
+    def _token_vector(self, token):
+        vector = self._token_vectors.get(token)
+        if vector is None:
+            seed = int.from_bytes(hashlib.sha256(token.encode()).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+            with self._lock:
+                self._token_vectors[token] = vector
+        return vector
+
+    def embed(self, text):
+        tokens = tokenize(text) or [text or "_empty"]
+        vector = np.sum([self._token_vector(token) for token in tokens], axis=0)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+
+class FakeOllamaServer:
+    """Local HTTP server speaking the parts of the Ollama API the service uses
+
+    Serves /api/embed (batched), /api/embeddings (single prompt), /api/tags
+    and /api/version. latency_ms is added per request and per_text_ms per
+    embedded text, to approximate a real model's cost.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, dimension=DEFAULT_DIMENSION, latency_ms=0.0, per_text_ms=0.0):
+        self.embedder = HashingEmbedder(dimension)
+        self.latency_ms = latency_ms
+        self.per_text_ms = per_text_ms
+        self.requests = 0
+        self.texts = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out as separate writes; without this, Nagle's
+            # algorithm and delayed ACKs add ~40ms to every keep-alive request
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/api/version":
+                    return self._reply(200, {"version": "0.0.0-fake"})
+                if self.path == "/api/tags":
+                    return self._reply(200, {"models": []})
+                self._reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if self.path == "/api/embed":
+                    texts = request.get("input") or []
+                    texts = [texts] if isinstance(texts, str) else texts
+                    embeddings = server._embed(texts)
+                    return self._reply(200, {
+                        "model": request.get("model", ""),
+                        "embeddings": [vector.tolist() for vector in embeddings],
+                        "prompt_eval_count": sum(len(text.split()) for text in texts)
+                    })
+                if self.path == "/api/embeddings":
+                    vector = server._embed([request.get("prompt") or ""])[0]
+                    return self._reply(200, {"embedding": vector.tolist()})
+                self._reply(404, {"error": "not found"})
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _embed(self, texts):
+        delay = self.latency_ms + self.per_text_ms * len(texts)
+        if delay:
+            time.sleep(delay / 1000)
+        self.requests += 1
+        self.texts += len(texts)
+        return [self.embedder.embed(text) for text in texts]
+
+    def start(self):
+        """Serve on a background thread; returns the server's base URL"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-ollama", daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic stand-in for the Ollama embedding API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--dimension", type=int, default=DEFAULT_DIMENSION)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Added to every request")
+    parser.add_argument("--per-text-ms", type=float, default=0.0, help="Added per embedded text")
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(args.host, args.port, args.dimension, args.latency_ms, args.per_text_ms)
+    logger.info(f"Fake Ollama serving {args.dimension}-dimensional embeddings on {server.url}")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import registry as metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Firestore accepts at most 500 writes and 10 MiB per commit
+MAX_BATCH_WRITES = 500
+MAX_BATCH_BYTES = 9 * 1024 * 1024
+
+
+def _transient_errors():
+    """Exception types worth retrying: throttling, timeouts and server-side failures"""
+    from google.api_core import exceptions
+    return (
+        exceptions.Aborted,
+        exceptions.DeadlineExceeded,
+        exceptions.InternalServerError,
+        exceptions.ResourceExhausted,
+        exceptions.ServiceUnavailable,
+        exceptions.TooManyRequests,
+        ConnectionError,
+        TimeoutError,
+    )
+
+
+def estimate_size(data):
+    """Approximate encoded size of a Firestore document in bytes"""
+    if data is None:
+        return 1
+    if isinstance(data, (bytes, str)):
+        return len(data) + 1
+    if isinstance(data, dict):
+        return sum(len(key) + 1 + estimate_size(value) for key, value in data.items()) + 32
+    if isinstance(data, (list, tuple)):
+        return sum(estimate_size(value) for value in data) + 8
+    return 8
+
+
+class WriteError(RuntimeError):
+    """Raised when some batches still failed after retries"""
+
+    def __init__(self, message, stats, failed_refs):
+        super().__init__(message)
+        self.stats = stats
+        self.failed_refs = failed_refs
+
+
+class FirestoreWriter:
+    """Write pipeline: full-size batches committed in parallel, with retries
+
+    Writes are grouped into batches of up to 500 operations (and below the
+    request size limit) and committed by a bounded pool of workers.
+    Transient errors are retried with exponential backoff and full jitter.
+    Works with anything exposing db.batch(), so it runs unchanged against
+    the Firestore emulator (FIRESTORE_EMULATOR_HOST) or an in-memory fake.
+    """
+
+    def __init__(self, db, batch_size=None, max_concurrency=None, max_retries=None,
+                 base_delay=0.25, max_delay=8.0, sleep=time.sleep):
+        self.db = db
+        self.batch_size = min(int(batch_size or os.getenv("FIRESTORE_BATCH_SIZE", MAX_BATCH_WRITES)), MAX_BATCH_WRITES)
+        self.max_concurrency = int(max_concurrency or os.getenv("FIRESTORE_WRITE_CONCURRENCY", 8))
+        self.max_retries = int(max_retries if max_retries is not None else os.getenv("FIRESTORE_WRITE_RETRIES", 5))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._sleep = sleep
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="firestore-write")
+        self._lock = threading.Lock()
+        self.documents_written = 0
+        self.batches_committed = 0
+        self.retries = 0
+        self.failed_batches = 0
+        self.write_seconds = 0.0
+
+    def _plan_batches(self, operations):
+        """Group operations into batches under the write-count and size limits"""
+        batches, current, current_bytes = [], [], 0
+        for operation in operations:
+            size = estimate_size(operation[2]) + 128
+            if current and (len(current) >= self.batch_size or current_bytes + size > MAX_BATCH_BYTES):
+                batches.append(current)
+                current, current_bytes = [], 0
+            current.append(operation)
+            current_bytes += size
+        if current:
+            batches.append(current)
+        return batches
+
+    def _commit(self, operations):
+        """Commit one batch, retrying transient failures; returns the retries it took"""
+        transient = _transient_errors()
+        attempt = 0
+        while True:
+            batch = self.db.batch()
+            for op, ref, data in operations:
+                if op == "set":
+                    batch.set(ref, data)
+                elif op == "update":
+                    batch.update(ref, data)
+                elif op == "delete":
+                    batch.delete(ref)
+                else:
+                    raise ValueError(f"Unknown write operation: {op}")
+            try:
+                with metrics.timer("stage_duration_ms", stage="firestore_write"), \
+                        tracing.span("firestore_write", writes=len(operations), attempt=attempt):
+                    batch.commit()
+                return attempt
+            except transient as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                attempt += 1
+                logger.warning(f"Firestore commit of {len(operations)} writes failed ({type(e).__name__}), "
+                               f"retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                self._sleep(delay)
+
+    def write(self, operations):
+        """Apply (op, document reference, data) operations, op being set, update or delete
+
+        Returns stats for the call; raises WriteError listing the references
+        of batches that still failed after retries.
+        """
+        operations = list(operations)
+        if not operations:
+            return {"documents": 0, "batches": 0, "retries": 0, "failed": 0, "seconds": 0.0, "docs_per_second": 0.0}
+
+        start_time = time.time()
+        batches = self._plan_batches(operations)
+        futures = [self._executor.submit(tracing.propagate(self._commit), batch) for batch in batches]
+
+        retries = written = 0
+        failed_refs, errors = [], []
+        for batch, future in zip(batches, futures):
+            try:
+                retries += future.result()
+                written += len(batch)
+            except Exception as e:
+                errors.append(e)
+                failed_refs.extend(ref for _, ref, _ in batch)
+
+        duration = time.time() - start_time
+        stats = {
+            "documents": written,
+            "batches": len(batches),
+            "retries": retries,
+            "failed": len(failed_refs),
+            "seconds": round(duration, 3),
+            "docs_per_second": round(written / duration, 1) if duration > 0 else 0.0
+        }
+        with self._lock:
+            self.documents_written += written
+            self.batches_committed += len(batches) - len(errors)
+            self.retries += retries
+            self.failed_batches += len(errors)
+            self.write_seconds += duration
+        metrics.increment("errors_total", len(errors), operation="firestore_write")
+
+        logger.info(f"Wrote {written}/{len(operations)} documents in {len(batches)} batches "
+                    f"({stats['docs_per_second']} docs/s, {retries} retries)")
+        if errors:
+            raise WriteError(f"{len(errors)} of {len(batches)} batches failed: {str(errors[0])}", stats, failed_refs)
+        return stats
+
+    def stats(self):
+        """Cumulative write counters"""
+        with self._lock:
+            return {
+                "documents": self.documents_written,
+                "batches": self.batches_committed,
+                "retries": self.retries,
+                "failed_batches": self.failed_batches,
+                "docs_per_second": round(self.documents_written / self.write_seconds, 1) if self.write_seconds else 0.0
+            }
@@ -1,29 +1,45 @@
-from haystack import Document, Pipeline
-from haystack.document_stores.in_memory import InMemoryDocumentStore
-from haystack.components.retrievers.in_memory import InMemoryEmbeddingRetriever
-from haystack.components.builders import PromptBuilder
 import os
 from dotenv import load_dotenv
 import logging
-import google.generativeai as genai
 import uuid
-import firebase_admin
-from firebase_admin import credentials, firestore
 import numpy as np
 from functools import lru_cache
 import time
-import ollama
 import asyncio
+import threading
+import contextlib
+import dataclasses
+import random
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from embedding_cache import EmbeddingCache, content_hash
+from vector_index import create_vector_index
+from partitions import Partition, PartitionManager, DEFAULT_PARTITION
+from snapshot import SnapshotStore
+from firestore_writer import FirestoreWriter, WriteError
+from answer_cache import AnswerCache
+from embedding_repair import RepairQueue
+from metrics import registry as metrics
+import tracing
+from context_packer import ContextPacker
+from text_units import estimate_tokens
+from chunking import split_text, chunk_id, parent_id_of, group_hits
+from lexical_index import tokenize, reciprocal_rank_fusion
+import httpx
+import ollama
+import firebase_admin
+from firebase_admin import credentials, firestore
+from google.cloud import firestore as cloud_firestore
+import google.generativeai as genai
+from haystack import Document
+from haystack.components.builders import PromptBuilder
 
 # Load environment variables
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Configure Gemini
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
 SPHINX_PROMPT = '''You are **Sphinx**, a friendly and insightful AI companion who helps users explore and understand their personal notes and thoughts. Your personality is warm, engaging, and conversational - like chatting with a knowledgeable friend who's genuinely interested in the user's ideas and projects.
 
 Core Traits:
@@ -79,29 +95,43 @@ Context:
 Question: {{question}}
 Answer:'''
 
+# Ollama model that embeds documents and queries; stored embeddings record it
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+# Embedding requests allowed in flight at once, and per-request timeout in seconds
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 4))
+EMBEDDING_REQUEST_TIMEOUT = float(os.getenv("EMBEDDING_REQUEST_TIMEOUT", 30))
+
 class OllamaEmbedder:
     _instance = None
     _initialized = False
     _model = None
     _embedding_dimension = None
-    _executor = None
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
             cls._instance._model = None
             cls._instance._embedding_dimension = None
-            cls._instance._executor = ThreadPoolExecutor(max_workers=4)
+            cls._instance._loop = None
+            cls._instance._loop_thread = None
+            cls._instance._async_client = None
+            cls._instance._async_semaphore = None
+            cls._instance._cache = None
+            cls._instance._texts_embedded = 0
+            cls._instance._requests_sent = 0
+            cls._instance._embedding_seconds = 0.0
             cls._instance._initialized = False
         return cls._instance
 
-    def __init__(self, model_name="nomic-embed-text", batch_size=32):
+    def __init__(self, model_name=EMBEDDING_MODEL, batch_size=32, token_budget=None, max_tokens_per_text=2048):
         if self._initialized:
             return
             
         logger.info("Initializing OllamaEmbedder singleton...")
         self.model_name = model_name
         self.batch_size = batch_size
+        self.token_budget = int(token_budget or os.getenv("EMBEDDING_BATCH_TOKEN_BUDGET", 16384))
+        self.max_tokens_per_text = max_tokens_per_text
         
         # Initialize model only once
         if self._model is None:
@@ -118,52 +148,193 @@ class OllamaEmbedder:
             except Exception as e:
                 logger.error(f"❌ Error warming up model: {str(e)}")
                 raise
+        
+        # Persistent embedding cache shared by document and query embedding
+        if self._cache is None:
+            try:
+                self._cache = EmbeddingCache()
+            except Exception as e:
+                logger.warning(f"⚠️ Embedding cache unavailable, continuing without it: {str(e)}")
+        
+        # All embedding requests run on one event loop with one pooled client
+        self._start_loop()
             
         self._initialized = True
         logger.info("✅ OllamaEmbedder singleton initialized")
 
+    def _plan_batches(self, texts):
+        """Group text indices into batches that fit the token budget"""
+        batches = []
+        current, current_tokens = [], 0
+        for i, text in enumerate(texts):
+            # Rough token estimate; nomic-embed-text truncates long inputs anyway
+            tokens = min(max(1, estimate_tokens(text)), self.max_tokens_per_text)
+            if current and (len(current) >= self.batch_size or current_tokens + tokens > self.token_budget):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _start_loop(self):
+        """Run the event loop that owns the async client on a daemon thread"""
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, name="embedding-loop", daemon=True)
+        self._loop_thread.start()
+
+        async def create_client():
+            # Created on the loop that uses them, and kept for the process lifetime
+            client = ollama.AsyncClient(
+                timeout=EMBEDDING_REQUEST_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=EMBEDDING_MAX_CONCURRENCY,
+                    max_keepalive_connections=EMBEDDING_MAX_CONCURRENCY
+                )
+            )
+            return client, asyncio.Semaphore(EMBEDDING_MAX_CONCURRENCY)
+        self._async_client, self._async_semaphore = self._run(create_client())
+
+    def _run(self, coroutine):
+        """Run a coroutine on the embedding loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def _lookup_cached(self, texts):
+        """Return embeddings aligned with texts from the cache, plus the indices still missing"""
+        if self._cache is not None:
+            all_embeddings = self._cache.get_many(self._model, texts)
+        else:
+            all_embeddings = [None] * len(texts)
+        missing = [i for i, embedding in enumerate(all_embeddings) if embedding is None]
+        if self._cache is not None:
+            metrics.increment("cache_requests_total", len(texts) - len(missing), cache="embedding", result="hit")
+            metrics.increment("cache_requests_total", len(missing), cache="embedding", result="miss")
+        return all_embeddings, missing
+
+    def _finish_embeddings(self, texts, all_embeddings, missing, computed, batch_count, started_at):
+        """Merge computed embeddings back, write them to the cache and record throughput"""
+        missing_texts = [texts[i] for i in missing]
+        for i, embedding in zip(missing, computed):
+            all_embeddings[i] = embedding
+        if self._cache is not None and missing_texts:
+            try:
+                self._cache.put_many(self._model, missing_texts, computed)
+            except Exception as e:
+                logger.warning(f"Failed to write embeddings to cache: {str(e)}")
+
+        total_duration = time.time() - started_at
+        if missing_texts:
+            self._texts_embedded += len(missing_texts)
+            self._requests_sent += batch_count
+            self._embedding_seconds += total_duration
+        failed = sum(1 for e in computed if e is None)
+        throughput = len(texts) / total_duration if total_duration > 0 else 0.0
+        logger.info(f"Total embedding generation for {len(texts)} texts took {total_duration * 1000:.2f}ms "
+                    f"({len(texts) - len(missing)} cached, {len(missing)} computed in {batch_count} requests, "
+                    f"{failed} failed, {throughput:.1f} texts/s)")
+        return all_embeddings
+
+    @staticmethod
+    def _as_vector(embedding):
+        return np.asarray(embedding, dtype=np.float32) if embedding is not None else None
+
     def get_embeddings(self, texts):
-        """Get embeddings for a list of texts in parallel"""
+        """Get embeddings for a list of texts, aligned with the input (None where embedding failed)
+
+        Callable from any thread except the embedding loop's own; concurrent
+        callers share the loop, its pooled connections and its concurrency limit.
+        """
         if not self._model:
             raise RuntimeError("Ollama model not initialized properly")
+        return self._run(self.aget_embeddings(texts))
+
+    async def _aembed_batch(self, batch):
+        """Embed a batch with one request, falling back to single requests on failure
 
-        def embed_single(text):
+        Every request holds the concurrency semaphore and is bounded by the request timeout.
+        """
+        client, semaphore = self._async_client, self._async_semaphore
+        async with semaphore:
             try:
                 start_time = time.time()
-                response = ollama.embeddings(
-                    model=self._model,  # Use stored model name
-                    prompt=text
+                response = await asyncio.wait_for(
+                    client.embed(model=self._model, input=batch),
+                    timeout=EMBEDDING_REQUEST_TIMEOUT
                 )
-                embedding = response['embedding']
+                embeddings = response['embeddings']
+                if len(embeddings) != len(batch):
+                    raise ValueError(f"Expected {len(batch)} embeddings, got {len(embeddings)}")
                 duration = (time.time() - start_time) * 1000
-                logger.debug(f"Single embedding took {duration:.2f}ms")
-                return embedding
+                logger.debug(f"Batch of {len(batch)} embeddings took {duration:.2f}ms")
+                return embeddings
             except Exception as e:
-                logger.error(f"Error getting embedding: {str(e)}")
-                return None
+                logger.warning(f"Batched embedding failed, retrying texts individually: {str(e)}")
+
+        async def embed_single(text):
+            async with semaphore:
+                try:
+                    response = await asyncio.wait_for(
+                        client.embeddings(model=self._model, prompt=text),
+                        timeout=EMBEDDING_REQUEST_TIMEOUT
+                    )
+                    return response['embedding']
+                except Exception as e:
+                    logger.error(f"Error getting embedding: {str(e)}")
+                    return None
 
-        # Process in batches for memory efficiency
-        all_embeddings = []
+        return await asyncio.gather(*(embed_single(text) for text in batch))
+
+    async def aget_embeddings(self, texts):
+        """Embed texts on the embedding loop: cache lookups, then batched requests in parallel
+
+        Runs only on the embedding loop (see get_embeddings); the SQLite
+        cache is read and written on worker threads to keep the loop free.
+        """
         total_start = time.time()
+        all_embeddings, missing = await asyncio.to_thread(self._lookup_cached, texts)
+        missing_texts = [texts[i] for i in missing]
         
-        for i in range(0, len(texts), self.batch_size):
-            batch = texts[i:i + self.batch_size]
-            batch_start = time.time()
-            # Process batch in parallel
-            embeddings = list(self._executor.map(embed_single, batch))
-            batch_duration = (time.time() - batch_start) * 1000
-            logger.debug(f"Batch of {len(batch)} embeddings took {batch_duration:.2f}ms")
-            all_embeddings.extend(embeddings)
-
-        total_duration = (time.time() - total_start) * 1000
-        logger.info(f"Total embedding generation for {len(texts)} texts took {total_duration:.2f}ms")
+        # Send misses as multi-input requests sized to the token budget,
+        # with up to EMBEDDING_MAX_CONCURRENCY in flight at once
+        computed = [None] * len(missing_texts)
+        batches = self._plan_batches(missing_texts)
+        results = await asyncio.gather(
+            *(self._aembed_batch([missing_texts[j] for j in batch]) for batch in batches)
+        )
+        for batch, embeddings in zip(batches, results):
+            for j, embedding in zip(batch, embeddings):
+                computed[j] = self._as_vector(embedding)
         
-        return np.array([e for e in all_embeddings if e is not None])
+        return await asyncio.to_thread(
+            self._finish_embeddings, texts, all_embeddings, missing, computed, len(batches), total_start
+        )
 
-    def __del__(self):
-        """Cleanup executor on deletion"""
-        if self._executor:
-            self._executor.shutdown(wait=False)
+    def throughput_stats(self):
+        """Cumulative throughput of texts sent to Ollama"""
+        return {
+            "texts": self._texts_embedded,
+            "requests": self._requests_sent,
+            "seconds": round(self._embedding_seconds, 3),
+            "texts_per_second": round(self._texts_embedded / self._embedding_seconds, 2) if self._embedding_seconds else 0.0
+        }
+
+    def cache_stats(self):
+        """Hit/miss statistics for the embedding cache"""
+        if self._cache is None:
+            return {"enabled": False}
+        return {"enabled": True, **self._cache.stats()}
+
+    def close(self):
+        """Close the pooled client and stop the embedding loop"""
+        if self._loop is None:
+            return
+        if self._async_client is not None:
+            self._run(self._async_client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self._loop = None
 
 # Global singleton instance
 _ollama_embedder = None
@@ -184,9 +355,13 @@ class CustomDocumentEmbedder:
         texts = [doc.content for doc in documents]
         embeddings = self.embedder.get_embeddings(texts)
         
-        # Attach embeddings to documents
+        return self._attach(documents, embeddings)
+
+    @staticmethod
+    def _attach(documents, embeddings):
+        # Attach embeddings to documents; failed ones keep no embedding
         for doc, embedding in zip(documents, embeddings):
-            doc.embedding = embedding
+            doc.embedding = embedding.tolist() if embedding is not None else None
             
         return {"documents": documents}
 
@@ -197,7 +372,9 @@ class CustomTextEmbedder:
     def run(self, text: str):
         """Run embedding for single text"""
         embedding = self.embedder.get_embeddings([text])[0]
-        return {"embedding": embedding, "text": text}
+        if embedding is None:
+            raise RuntimeError("Failed to generate query embedding")
+        return {"embedding": embedding.tolist(), "text": text}
 
 # Update the getter functions to use the global embedder
 def get_doc_embedder():
@@ -213,21 +390,124 @@ def get_ollama_model():
 # Cache for Gemini model
 @lru_cache(maxsize=1)
 def get_gemini_model():
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
     return genai.GenerativeModel('gemini-1.5-flash-latest')
 
+# Notes retrieved per question, and chunk candidates searched per note
+QUERY_TOP_K = 5
+CHUNK_CANDIDATE_FACTOR = int(os.getenv("CHUNK_CANDIDATE_FACTOR", 4))
+
+# Ingestion embeds and writes chunks in slices of this size, overlapping the two
+INGEST_SLICE_CHUNKS = int(os.getenv("INGEST_SLICE_CHUNKS", 256))
+INGEST_STORE_WORKERS = int(os.getenv("INGEST_STORE_WORKERS", 4))
+
+# Retrieval modes selectable per query; auto uses the lexical fast path for
+# keyword queries of at most LEXICAL_FAST_PATH_MAX_TERMS terms and hybrid otherwise
+RETRIEVAL_MODES = ("vector", "hybrid", "lexical", "auto")
+DEFAULT_RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "vector")
+LEXICAL_FAST_PATH_MAX_TERMS = int(os.getenv("LEXICAL_FAST_PATH_MAX_TERMS", 3))
+
+# Share of queries whose full prompt is logged; prompts are large, so off by default
+PROMPT_LOG_SAMPLE_RATE = float(os.getenv("PROMPT_LOG_SAMPLE_RATE", 0.0))
+
+# Sampling settings for answers, tuned for natural conversation
+GENERATION_CONFIG = {
+    "temperature": 0.88,  # Balanced for natural conversation
+    "max_output_tokens": 1024,
+    "top_p": 0.95,  # Increased for more natural language
+    "top_k": 45,  # Slightly increased for more expressive responses
+}
+
+# The template is compiled once and the builder shared by all queries
+@lru_cache(maxsize=1)
+def get_prompt_builder():
+    return PromptBuilder(template=SPHINX_PROMPT)
+
+# Embeddings are stored in Firestore as packed little-endian bytes tagged
+# with a format version; legacy documents hold a plain array of doubles
+EMBEDDING_FORMATS = {
+    "f32v1": np.dtype("<f4"),
+    "f16v1": np.dtype("<f2"),
+}
+EMBEDDING_STORAGE_FORMAT = "f16v1" if os.getenv("EMBEDDING_STORAGE_DTYPE", "float32") == "float16" else "f32v1"
+
+# Snapshot loading: deletes since the snapshot are read from tombstones,
+# kept for TOMBSTONE_RETENTION_DAYS. Older snapshots, or every load with
+# SNAPSHOT_VERIFY_DELETES=1 (to catch deletes made outside this service),
+# list all of the user's document IDs instead. Plus slack for clock skew
+# against Firestore
+SNAPSHOT_VERIFY_DELETES = os.getenv("SNAPSHOT_VERIFY_DELETES", "0") == "1"
+TOMBSTONE_RETENTION = timedelta(days=float(os.getenv("TOMBSTONE_RETENTION_DAYS", 30)))
+SNAPSHOT_WATERMARK_SKEW = timedelta(seconds=float(os.getenv("SNAPSHOT_WATERMARK_SKEW_SECONDS", 60)))
+
+# Corpus loads read the corpus in pages of this many documents, projected to
+# the fields the index needs. With LAZY_CONTENT=1 content is left out of
+# loads and fetched for the documents a query retrieves (keeping the most
+# recent in an LRU); that saves memory and reads, but without content there
+# is no lexical index, so only vector retrieval is available
+FIRESTORE_PAGE_SIZE = int(os.getenv("FIRESTORE_PAGE_SIZE", 500))
+INDEX_FIELDS = ('meta', 'embedding', 'embedding_format', 'embedding_model')
+LAZY_CONTENT = os.getenv("LAZY_CONTENT", "0") == "1"
+CONTENT_CACHE_MAX_ENTRIES = int(os.getenv("CONTENT_CACHE_MAX_ENTRIES", 2000))
+
+# Most values Firestore accepts in one "in" filter
+FIRESTORE_IN_LIMIT = 30
+
+def encode_embedding(embedding, embedding_format=None):
+    """Pack an embedding into bytes for Firestore, returning (blob, format tag)"""
+    embedding_format = embedding_format or EMBEDDING_STORAGE_FORMAT
+    vector = np.asarray(embedding, dtype=EMBEDDING_FORMATS[embedding_format])
+    return vector.tobytes(), embedding_format
+
+def decode_embedding(data):
+    """Read an embedding from a Firestore document, packed or legacy array"""
+    embedding = data.get('embedding')
+    if embedding is None:
+        return None
+    embedding_format = data.get('embedding_format')
+    if embedding_format is None:
+        return np.array(embedding, dtype=np.float32)
+    if embedding_format not in EMBEDDING_FORMATS:
+        raise ValueError(f"Unknown embedding format: {embedding_format}")
+    return np.frombuffer(embedding, dtype=EMBEDDING_FORMATS[embedding_format]).astype(np.float32)
+
+def current_embedding(data):
+    """A Firestore document's embedding, or None if it is missing or was made by another embedding model"""
+    # Documents written before the model was recorded are taken as current
+    model = data.get('embedding_model')
+    if model is not None and model != EMBEDDING_MODEL:
+        return None
+    return decode_embedding(data)
+
 class FirebaseSync:
     _instance = None
     
-    def __new__(cls):
+    def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = super(FirebaseSync, cls).__new__(cls)
             cls._instance._initialized = False
         return cls._instance
     
-    def __init__(self):
+    def __init__(self, db=None):
+        """Connect to Firestore; db replaces the client (an emulator or in-memory stand-in) when given"""
         if getattr(self, '_initialized', False):
             return
-            
+
+        if db is not None:
+            self.db = db
+        elif os.getenv("FIRESTORE_EMULATOR_HOST"):
+            # The client talks to the emulator without credentials
+            self.db = cloud_firestore.Client(project="mindfeed-dfe94")
+        else:
+            self.db = self._connect()
+        self.collection = self.db.collection('haystack_documents')
+        # One record per deleted document, so snapshot loads can find deletes without listing every ID
+        self.tombstones = self.db.collection('haystack_tombstones')
+        self.writer = FirestoreWriter(self.db)
+        self._initialized = True
+
+    @staticmethod
+    def _connect():
         if not firebase_admin._apps:
             cred = credentials.Certificate({
                 "type": "service_account",
@@ -243,18 +523,13 @@ class FirebaseSync:
                 "universe_domain": "googleapis.com"
             })
             firebase_admin.initialize_app(cred)
-        self.db = firestore.client()
-        self.collection = self.db.collection('haystack_documents')
-        self._initialized = True
-        self._document_cache = {}
+        return firestore.client()
 
     def delete_document(self, doc_id: str):
         """Delete a document and its embedding"""
         try:
             # Delete from Firestore
             self.collection.document(doc_id).delete()
-            # Remove from cache
-            self._document_cache.pop(doc_id, None)
             logger.info(f"Deleted document {doc_id} and its embedding from Firestore")
             return True
         except Exception as e:
@@ -262,82 +537,304 @@ class FirebaseSync:
             raise
 
     def save_documents(self, documents):
-        """Save documents to Firestore in smaller batches"""
+        """Save documents to Firestore through the batched, parallel write pipeline"""
         try:
-            BATCH_SIZE = 5  # Smaller batch size for better performance
+            operations = []
+            for doc in documents:
+                # Pack the embedding into a compact bytes blob
+                embedding, embedding_format = None, None
+                if getattr(doc, 'embedding', None) is not None:
+                    embedding, embedding_format = encode_embedding(doc.embedding)
+
+                doc_dict = {
+                    'content': doc.content,
+                    'meta': doc.meta,
+                    'user_id': doc.meta.get('user_id', DEFAULT_PARTITION),
+                    'parent_id': doc.meta.get('parent_id', doc.id),
+                    'embedding': embedding,
+                    'embedding_format': embedding_format,
+                    'embedding_model': EMBEDDING_MODEL if embedding is not None else None,
+                    'updated_at': firestore.SERVER_TIMESTAMP
+                }
+                operations.append(("set", self.collection.document(doc.id), doc_dict))
             
-            for i in range(0, len(documents), BATCH_SIZE):
-                batch = self.db.batch()
-                batch_docs = documents[i:i + BATCH_SIZE]
-                
-                for doc in batch_docs:
-                    # Convert embedding to list if it's a numpy array
-                    embedding = None
-                    if hasattr(doc, 'embedding') and doc.embedding is not None:
-                        if isinstance(doc.embedding, np.ndarray):
-                            embedding = doc.embedding.tolist()
-                        elif isinstance(doc.embedding, list):
-                            embedding = doc.embedding
-
-                    doc_dict = {
-                        'content': doc.content,
-                        'meta': doc.meta,
-                        'embedding': embedding,
-                        'updated_at': firestore.SERVER_TIMESTAMP
-                    }
-                    batch.set(self.collection.document(doc.id), doc_dict)
-                    # Update cache
-                    self._document_cache[doc.id] = doc
-                    
-                # Commit smaller batch
-                batch.commit()
+            return self.writer.write(operations)
                 
         except Exception as e:
             logger.error(f"Error saving documents to Firestore: {str(e)}")
             raise
 
-    def load_documents(self):
-        """Load documents from Firestore or cache"""
+    def update_embeddings(self, documents):
+        """Write regenerated embeddings back, leaving content and meta alone
+
+        Updates fail for documents deleted in the meantime rather than recreating them.
+        """
+        operations = []
+        for doc in documents:
+            embedding, embedding_format = encode_embedding(doc.embedding)
+            operations.append(("update", self.collection.document(doc.id), {
+                'embedding': embedding,
+                'embedding_format': embedding_format,
+                'embedding_model': EMBEDDING_MODEL,
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }))
+        return self.writer.write(operations)
+
+    def iter_document_pages(self, user_id=None, updated_after=None, include_content=True, page_size=None):
+        """Stream one user's documents from Firestore in pages, resuming each page from a cursor
+
+        Only the fields the index needs are read. Without include_content the
+        documents come back with content None, to be fetched by load_contents
+        when they are used. Yields one list of Documents per page, so callers
+        hold a page at a time rather than the whole corpus. Filters on the
+        top-level user_id, which older documents only get from
+        backfill_partition_fields.py.
+        """
+        user_id = user_id or DEFAULT_PARTITION
+        page_size = page_size or FIRESTORE_PAGE_SIZE
+        fields = list(INDEX_FIELDS) + (['content'] if include_content else [])
+        query = self.collection.where(filter=firestore.FieldFilter('user_id', '==', user_id))
+        if updated_after is not None:
+            # Needs a composite index on (user_id, updated_at); the cursor
+            # reads updated_at from the last document, so it is projected too
+            query = (query.where(filter=firestore.FieldFilter('updated_at', '>', updated_after))
+                     .order_by('updated_at'))
+            fields.append('updated_at')
+        # Order by document ID so the cursor is stable while documents change
+        query = query.order_by('__name__').select(fields).limit(page_size)
+        
+        cursor, loaded, pages = None, 0, 0
         try:
-            # Return cached documents if available
-            if self._document_cache:
-                logger.info(f"Returning {len(self._document_cache)} documents from cache")
-                return list(self._document_cache.values())
-
-            docs = self.collection.get()
-            haystack_docs = []
-            for doc in docs:
-                data = doc.to_dict()
-                # Convert embedding back to numpy array if it exists
-                embedding = data.get('embedding')
-                if embedding is not None:
-                    embedding = np.array(embedding)
-                
-                haystack_doc = Document(
-                    content=data['content'],
-                    meta=data['meta'],
-                    id=doc.id,
-                    embedding=embedding
-                )
-                haystack_docs.append(haystack_doc)
-                # Update cache
-                self._document_cache[doc.id] = haystack_doc
-                
-            logger.info(f"Loaded {len(haystack_docs)} documents from Firestore")
-            return haystack_docs
+            while True:
+                with metrics.timer("stage_duration_ms", stage="firestore_read"), \
+                        tracing.span("firestore_read", page=pages):
+                    page = list((query.start_after(cursor) if cursor is not None else query).stream())
+                if not page:
+                    break
+                pages += 1
+                loaded += len(page)
+                yield [
+                    Document(
+                        content=data.get('content'),
+                        meta=data.get('meta', {}),
+                        id=snapshot.id,
+                        # Decode the packed (or legacy array) embedding; stale ones are left out
+                        embedding=current_embedding(data)
+                    )
+                    for snapshot, data in ((snapshot, snapshot.to_dict()) for snapshot in page)
+                ]
+                if len(page) < page_size:
+                    break
+                cursor = page[-1]
         except Exception as e:
             logger.error(f"Error loading documents from Firestore: {str(e)}")
             raise
+        logger.info(f"Loaded {loaded} documents for user {user_id} from Firestore in {pages} pages")
+
+    def load_documents(self, user_id=None, updated_after=None, include_content=True):
+        """Load one user's documents from Firestore, optionally only those updated after a watermark"""
+        return [doc for page in self.iter_document_pages(user_id, updated_after, include_content) for doc in page]
+
+    def load_contents(self, document_ids):
+        """Content of documents loaded without it, by ID"""
+        refs = [self.collection.document(doc_id) for doc_id in document_ids]
+        contents = {}
+        for start in range(0, len(refs), FIRESTORE_PAGE_SIZE):
+            batch = refs[start:start + FIRESTORE_PAGE_SIZE]
+            with metrics.timer("stage_duration_ms", stage="firestore_read"), \
+                    tracing.span("firestore_read", documents=len(batch)):
+                snapshots = list(self.db.get_all(batch, field_paths=['content']))
+            for snapshot in snapshots:
+                if snapshot.exists:
+                    contents[snapshot.id] = snapshot.to_dict().get('content')
+        return contents
+
+    def list_document_ids(self, user_id=None):
+        """IDs of one user's documents, without reading any fields"""
+        user_id = user_id or DEFAULT_PARTITION
+        query = self.collection.where(filter=firestore.FieldFilter('user_id', '==', user_id)).select([])
+        with metrics.timer("stage_duration_ms", stage="firestore_read"):
+            return {doc.id for doc in query.get()}
+
+    def owned_document_ids(self, document_ids, user_id=None):
+        """The subset of document_ids stored for the given user"""
+        user_id = user_id or DEFAULT_PARTITION
+        refs = [self.collection.document(doc_id) for doc_id in document_ids]
+        owned = set()
+        with metrics.timer("stage_duration_ms", stage="firestore_read"):
+            for snapshot in self.db.get_all(refs, field_paths=['user_id', 'meta.user_id']):
+                if not snapshot.exists:
+                    continue
+                data = snapshot.to_dict()
+                # Documents not yet backfilled only carry their owner in meta
+                owner = data.get('user_id') or (data.get('meta') or {}).get('user_id', DEFAULT_PARTITION)
+                if owner == user_id:
+                    owned.add(snapshot.id)
+        return owned
+
+    def list_chunk_ids(self, parent_id, user_id=None):
+        """IDs of the chunks stored for one note"""
+        user_id = user_id or DEFAULT_PARTITION
+        query = (self.collection
+                 .where(filter=firestore.FieldFilter('user_id', '==', user_id))
+                 .where(filter=firestore.FieldFilter('parent_id', '==', parent_id))
+                 .select([]))
+        with metrics.timer("stage_duration_ms", stage="firestore_read"):
+            return {doc.id for doc in query.get()}
+
+    def note_chunks(self, user_id=None, parent_ids=None):
+        """Chunks stored for a user's notes, with or without an embedding, as {parent_id: {chunk_id: content_hash}}
 
-    def delete_documents(self, document_ids):
-        """Delete documents from Firestore"""
-        batch = self.db.batch()
-        for doc_id in document_ids:
-            batch.delete(self.collection.document(doc_id))
-            # Remove from cache
-            self._document_cache.pop(doc_id, None)
-        batch.commit()
-        logger.info(f"Deleted {len(document_ids)} documents from Firestore")
+        Covers every note of the user, or only parent_ids when given.
+        """
+        user_id = user_id or DEFAULT_PARTITION
+        query = self.collection.where(filter=firestore.FieldFilter('user_id', '==', user_id))
+        if parent_ids is None:
+            queries = [query]
+        else:
+            parent_ids = sorted(set(parent_ids))
+            queries = [query.where(filter=firestore.FieldFilter('parent_id', 'in', parent_ids[i:i + FIRESTORE_IN_LIMIT]))
+                       for i in range(0, len(parent_ids), FIRESTORE_IN_LIMIT)]
+        notes = {}
+        for query in queries:
+            with metrics.timer("stage_duration_ms", stage="firestore_read"):
+                snapshots = query.select(['parent_id', 'meta.parent_id', 'meta.content_hash']).get()
+            for snapshot in snapshots:
+                data = snapshot.to_dict()
+                meta = data.get('meta') or {}
+                parent_id = data.get('parent_id') or meta.get('parent_id') or snapshot.id
+                notes.setdefault(parent_id, {})[snapshot.id] = meta.get('content_hash')
+        return notes
+
+    def migrate_embeddings(self, embedding_format=None, dry_run=False):
+        """Rewrite embeddings stored as arrays of doubles (or in another format) as packed bytes"""
+        embedding_format = embedding_format or EMBEDDING_STORAGE_FORMAT
+        BATCH_SIZE = 500  # Firestore limit on writes per batch
+        
+        migrated = skipped = failed = 0
+        batch, pending = self.db.batch(), 0
+        for doc in self.collection.stream():
+            data = doc.to_dict()
+            if data.get('embedding') is None or data.get('embedding_format') == embedding_format:
+                skipped += 1
+                continue
+            try:
+                embedding, _ = encode_embedding(decode_embedding(data), embedding_format)
+            except Exception as e:
+                logger.warning(f"Could not migrate embedding of document {doc.id}: {str(e)}")
+                failed += 1
+                continue
+            migrated += 1
+            if dry_run:
+                continue
+            batch.update(self.collection.document(doc.id), {
+                'embedding': embedding,
+                'embedding_format': embedding_format
+            })
+            pending += 1
+            if pending == BATCH_SIZE:
+                batch.commit()
+                batch, pending = self.db.batch(), 0
+        if pending:
+            batch.commit()
+        
+        logger.info(f"Embedding migration to {embedding_format}: {migrated} migrated, "
+                    f"{skipped} already current or empty, {failed} failed")
+        return {"migrated": migrated, "skipped": skipped, "failed": failed, "format": embedding_format}
+
+    def backfill_partition_fields(self, dry_run=False):
+        """Copy meta.user_id and meta.parent_id to the top-level fields partition queries filter on
+
+        Documents saved before those fields existed are invisible to
+        iter_document_pages, list_document_ids and list_chunk_ids until this
+        runs. updated_at is bumped too, so delta syncs pick them up.
+        """
+        operations = []
+        skipped = 0
+        for doc in self.collection.select(['meta', 'user_id', 'parent_id']).stream():
+            data = doc.to_dict()
+            meta = data.get('meta') or {}
+            fields = {
+                'user_id': meta.get('user_id', DEFAULT_PARTITION),
+                'parent_id': meta.get('parent_id', doc.id)
+            }
+            if all(data.get(key) == value for key, value in fields.items()):
+                skipped += 1
+                continue
+            operations.append(("update", self.collection.document(doc.id),
+                               {**fields, 'updated_at': firestore.SERVER_TIMESTAMP}))
+        if operations and not dry_run:
+            self.writer.write(operations)
+        
+        logger.info(f"Partition field backfill: {len(operations)} updated, {skipped} already current")
+        return {"updated": len(operations), "skipped": skipped}
+
+    def delete_documents(self, document_ids, user_id=None, raise_on_failure=True):
+        """Delete one user's documents from Firestore in parallel batches, leaving tombstones
+
+        Returns {"deleted": [...], "failed": [...]} by document ID. Batches
+        that fail after retries, tombstones or deletes, raise WriteError
+        unless raise_on_failure is False, in which case their IDs are
+        reported as failed.
+        """
+        document_ids = list(document_ids)
+        user_id = user_id or DEFAULT_PARTITION
+        # Tombstones first, so a delete is never made without one
+        try:
+            self.writer.write(("set", self.tombstones.document(doc_id),
+                               {'user_id': user_id, 'deleted_at': firestore.SERVER_TIMESTAMP})
+                              for doc_id in document_ids)
+            failed = set()
+        except WriteError as e:
+            if raise_on_failure:
+                raise
+            failed = {ref.id for ref in e.failed_refs}
+            logger.warning(f"Could not write {len(failed)} tombstones; keeping those documents")
+        try:
+            self.writer.write(("delete", self.collection.document(doc_id), None)
+                              for doc_id in document_ids if doc_id not in failed)
+        except WriteError as e:
+            failed_deletes = {ref.id for ref in e.failed_refs}
+            self._drop_tombstones(failed_deletes)
+            if raise_on_failure:
+                raise
+            failed |= failed_deletes
+        deleted = [doc_id for doc_id in document_ids if doc_id not in failed]
+        logger.info(f"Deleted {len(deleted)} documents from Firestore" +
+                    (f", {len(failed)} failed" if failed else ""))
+        return {"deleted": deleted, "failed": sorted(failed)}
+
+    def delete_user_documents(self, user_id=None, extra_ids=()):
+        """Delete every document stored for one user, reporting partial failures"""
+        document_ids = self.list_document_ids(user_id) | set(extra_ids)
+        return self.delete_documents(sorted(document_ids), user_id, raise_on_failure=False)
+
+    def _drop_tombstones(self, document_ids):
+        """Withdraw the tombstones of documents whose delete failed, so loads keep them"""
+        try:
+            self.writer.write(("delete", self.tombstones.document(doc_id), None) for doc_id in document_ids)
+        except WriteError as e:
+            logger.warning(f"Could not remove {len(e.failed_refs)} tombstones of documents that were not deleted")
+
+    def deleted_since(self, user_id, deleted_after):
+        """IDs of one user's documents deleted after a timestamp"""
+        user_id = user_id or DEFAULT_PARTITION
+        # Needs a composite index on (user_id, deleted_at)
+        query = (self.tombstones
+                 .where(filter=firestore.FieldFilter('user_id', '==', user_id))
+                 .where(filter=firestore.FieldFilter('deleted_at', '>', deleted_after))
+                 .select([]))
+        with metrics.timer("stage_duration_ms", stage="firestore_read"):
+            return {doc.id for doc in query.get()}
+
+    def prune_tombstones(self, deleted_before):
+        """Remove tombstones older than a timestamp; returns how many were removed"""
+        query = self.tombstones.where(filter=firestore.FieldFilter('deleted_at', '<', deleted_before)).select([])
+        refs = [doc.reference for doc in query.get()]
+        if refs:
+            self.writer.write(("delete", ref, None) for ref in refs)
+            logger.info(f"Pruned {len(refs)} tombstones deleted before {deleted_before.isoformat()}")
+        return len(refs)
 
 class HaystackService:
     _instance = None
@@ -354,236 +851,847 @@ class HaystackService:
             return
             
         logger.info("Initializing HaystackService...")
-        self.document_store = InMemoryDocumentStore()
+        start_time = time.time()
+        self.startup_profile = {}
+        
+        # Build the query path's prompt builder and model client up front so
+        # the first query does not pay for them
+        self._timed_phase("query_components", lambda: (get_prompt_builder(), get_gemini_model()))
+        
+        # Connecting to Firestore and warming up the Ollama model wait on the
+        # network, so run them side by side: startup takes as long as the
+        # slower one instead of their sum
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="startup") as pool:
+            firebase = pool.submit(self._timed_phase, "firebase", FirebaseSync)
+            embedder = pool.submit(self._timed_phase, "embedder_warmup", get_ollama_embedder)
+            self.firebase_sync = firebase.result()
+            embedder.result()
         self.doc_embedder = get_doc_embedder()
         self.text_embedder = get_text_embedder()
-        self.firebase_sync = FirebaseSync()
         
-        # Load initial documents
-        self.refresh_documents()
+        # Local index snapshots so a partition loads from disk plus a Firestore delta
+        self.snapshots = SnapshotStore() if os.getenv("SNAPSHOTS_ENABLED", "1") == "1" else None
+        
+        # Per-user indexes, loaded on first use and evicted under a memory budget
+        self.partitions = PartitionManager(self._load_partition, on_evict=self._save_snapshot)
+        
+        # Fits retrieved documents into the prompt's token budget
+        self.context_packer = ContextPacker()
         
+        # Answers to near-identical questions, invalidated by the mutations that affect them
+        self.answer_cache = AnswerCache() if os.getenv("ANSWER_CACHE_ENABLED", "1") == "1" else None
+        
+        # Re-embeds documents loaded without a current embedding, off the query path
+        self.repairs = RepairQueue(self._repair_embeddings)
+        
+        # Writes a slice of chunks to Firestore while the next one is embedded
+        self._store_pool = ThreadPoolExecutor(max_workers=INGEST_STORE_WORKERS, thread_name_prefix="store")
+        
+        # Content of documents loaded without it, most recently retrieved last
+        self._contents = OrderedDict()
+        self._contents_lock = threading.Lock()
+        
+        # Optionally load known-busy partitions before reporting ready
+        warm_users = [u.strip() for u in os.getenv("WARM_PARTITIONS", "").split(",") if u.strip()]
+        self._timed_phase("corpus_load", lambda: [self.partitions.get(user_id) for user_id in warm_users])
+        
+        self.startup_profile["total"] = round((time.time() - start_time) * 1000, 2)
+        self.started_at = time.time()
         self._initialized = True
-        logger.info("✅ HaystackService initialized")
+        logger.info(f"✅ HaystackService initialized in {self.startup_profile['total']:.2f}ms "
+                    f"(profile: {self.startup_profile})")
     
-    def refresh_documents(self):
-        """Refresh documents from Firebase"""
-        logger.info("Refreshing documents from Firebase...")
-        docs = self.firebase_sync.load_documents()
-        if docs:
-            # Get existing document IDs
-            existing_docs = self.document_store.filter_documents({})
-            if existing_docs:
-                doc_ids = [doc.id for doc in existing_docs]
-                # Clear existing documents
-                self.document_store.delete_documents(document_ids=doc_ids)
-                
-            # Filter out documents without embeddings
-            valid_docs = []
-            for doc in docs:
-                if doc.embedding is None:
-                    logger.warning(f"Document {doc.id} has no embedding, regenerating...")
-                    try:
-                        # Regenerate embedding
-                        result = self.doc_embedder.run([doc])
-                        if result and result["documents"]:
-                            doc = result["documents"][0]
-                            # Save updated embedding to Firebase
-                            self.firebase_sync.save_documents([doc])
-                    except Exception as e:
-                        logger.error(f"Failed to regenerate embedding for document {doc.id}: {str(e)}")
-                        continue
-                valid_docs.append(doc)
-                
-            # Write valid documents
-            if valid_docs:
-                self.document_store.write_documents(valid_docs)
-                logger.info(f"Refreshed {len(valid_docs)} documents with valid embeddings")
-            else:
-                logger.warning("No valid documents with embeddings found")
-                
-            return len(valid_docs)
-        return 0
+    def _timed_phase(self, name, fn):
+        """Run one startup phase and record its duration in the startup profile"""
+        phase_start = time.time()
+        try:
+            return fn()
+        finally:
+            self.startup_profile[name] = round((time.time() - phase_start) * 1000, 2)
+            logger.info(f"Startup phase {name} took {self.startup_profile[name]:.2f}ms")
+    
+    def generation(self, user_id=None):
+        """Current corpus generation of a user's partition"""
+        return self.partitions.get(user_id).generation
+
+    def _load_partition(self, user_id):
+        """Build a user's partition from its snapshot plus a delta, or fully from Firebase"""
+        partition = Partition(user_id, create_vector_index(name=user_id), lexical=not LAZY_CONTENT)
+        if self.snapshots is not None and self._load_from_snapshot(partition):
+            return partition
+        self._refresh_partition(partition, publish=self.partitions.publish)
+        return partition
 
-    def query(self, query_text):
-        """Query documents with automatic refresh"""
+    def _load_from_snapshot(self, partition):
+        """Map a partition's snapshot and apply documents changed since its watermark"""
+        snapshot = self.snapshots.load(partition.user_id, model=EMBEDDING_MODEL)
+        if snapshot is None:
+            return False
+        records, matrix, watermark = snapshot
+        if watermark is None:
+            return False
+        if partition.lexical is not None and any(r["content"] is None for r in records):
+            # Written without content, which the lexical index needs
+            return False
+        
+        synced_at = datetime.now(timezone.utc)
         try:
-            start_time = time.time()
-            timing = {}
+            delta = self.firebase_sync.load_documents(partition.user_id, updated_after=watermark,
+                                                      include_content=not LAZY_CONTENT)
+            # Tombstones outlive the snapshot unless it is older than their retention
+            if SNAPSHOT_VERIFY_DELETES or watermark < synced_at - TOMBSTONE_RETENTION:
+                live_ids, deleted_ids = self.firebase_sync.list_document_ids(partition.user_id), None
+            else:
+                live_ids, deleted_ids = None, self.firebase_sync.deleted_since(partition.user_id, watermark)
+        except Exception as e:
+            logger.warning(f"Delta load for user {partition.user_id} failed, doing a full load: {str(e)}")
+            return False
+        
+        docs = [Document(id=r["id"], content=r["content"], meta=r["meta"]) for r in records]
+        partition.bulk_load(docs, matrix)
+        
+        # Apply changes made since the snapshot, and drop documents deleted
+        # since or changed without a current embedding
+        changed = self._indexable(partition, delta)
+        if changed:
+            partition.upsert(changed)
+        removed = partition.delete([doc.id for doc in delta if doc.embedding is None])
+        if live_ids is not None:
+            removed += partition.delete([doc.id for doc in docs if doc.id not in live_ids])
+        else:
+            # A document in the delta was written again after its tombstone
+            delta_ids = {doc.id for doc in delta}
+            removed += partition.delete([doc_id for doc_id in deleted_ids if doc_id not in delta_ids])
+        
+        partition.synced_at = synced_at
+        partition.bump_generation()
+        partition.dirty = bool(changed or removed)
+        self._invalidate_answers(partition)
+        logger.info(f"Loaded snapshot for user {partition.user_id}: {len(docs)} documents, "
+                    f"{len(changed)} changed and {removed} removed since {watermark.isoformat()}")
+        if partition.dirty:
+            self._save_snapshot(partition)
+        return True
+
+    def _save_snapshot(self, partition):
+        """Write a partition's snapshot, watermarked at its last Firestore read"""
+        if self.snapshots is None or partition.synced_at is None:
+            return
+        docs, matrix = partition.index.export()
+        records = [{"id": doc.id, "content": doc.content, "meta": doc.meta} for doc in docs]
+        # updated_at is a server timestamp, so leave room for clock skew
+        watermark = partition.synced_at - SNAPSHOT_WATERMARK_SKEW
+        self.snapshots.save(partition.user_id, records, matrix, watermark, model=EMBEDDING_MODEL)
+        partition.dirty = False
+
+    def save_snapshots(self):
+        """Write snapshots of every loaded partition that changed since its last snapshot"""
+        for partition in self.partitions.loaded():
+            if partition.dirty:
+                try:
+                    self._save_snapshot(partition)
+                except Exception as e:
+                    logger.warning(f"Failed to write snapshot for user {partition.user_id}: {str(e)}")
+        if self.snapshots is not None:
+            # Snapshots older than the retention fall back to listing IDs, so older tombstones are unused
+            try:
+                self.firebase_sync.prune_tombstones(datetime.now(timezone.utc) - TOMBSTONE_RETENTION)
+            except Exception as e:
+                logger.warning(f"Failed to prune tombstones: {str(e)}")
+
+    def _partition_for_update(self, user_id):
+        """Loaded, current partition for a user, rebuilt if a previous rebuild failed"""
+        partition = self.partitions.get(user_id)
+        if not partition.is_current():
+            with partition.lock:
+                if not partition.is_current():
+                    self._refresh_partition(partition)
+        return partition
+
+    def refresh_documents(self, user_id=None):
+        """Rebuild a user's in-memory index from Firebase"""
+        partition = self.partitions.peek(user_id)
+        if partition is None:
+            return len(self.partitions.get(user_id).index)
+        return self._refresh_partition(partition)
+
+    def _indexable(self, partition, docs):
+        """Loaded documents ready to index; the rest are queued for background re-embedding"""
+        missing = [doc for doc in docs if doc.embedding is None]
+        if missing:
+            self.repairs.submit(partition.user_id, missing)
+        return [doc for doc in docs if doc.embedding is not None]
+
+    def _repair_embeddings(self, user_id, docs):
+        """Re-embed documents without a current embedding, store them and index them if their partition is loaded
+
+        Runs on the repair queue's worker. Returns the documents that could not be repaired.
+        """
+        # Loads may leave content out; documents deleted since are dropped
+        without_content = [doc.id for doc in docs if doc.content is None]
+        if without_content:
+            contents = self.firebase_sync.load_contents(without_content)
+            docs = [dataclasses.replace(doc, content=contents[doc.id]) if doc.content is None and doc.id in contents
+                    else doc for doc in docs]
+            docs = [doc for doc in docs if doc.content is not None]
+        
+        embedded = self.doc_embedder.run(docs)["documents"]
+        failed = [doc for doc in embedded if doc.embedding is None]
+        repaired = [doc for doc in embedded if doc.embedding is not None]
+        if not repaired:
+            return failed
+        
+        partition = self.partitions.peek(user_id)
+        with partition.lock if partition is not None else contextlib.nullcontext():
+            if partition is not None:
+                # A document indexed meanwhile was rewritten with a fresh embedding
+                repaired = [doc for doc in repaired if doc.id not in partition.index]
+            try:
+                self.firebase_sync.update_embeddings(repaired)
+            except WriteError as e:
+                failed_ids = {ref.id for ref in e.failed_refs}
+                failed += [doc for doc in repaired if doc.id in failed_ids]
+                repaired = [doc for doc in repaired if doc.id not in failed_ids]
+            if partition is not None and repaired:
+                if partition.lexical is None:
+                    # Keep the partition's documents without content, like the rest of its load
+                    repaired = [dataclasses.replace(doc, content=None) for doc in repaired]
+                partition.upsert(repaired)
+                partition.bump_generation()
+                if self.answer_cache is not None:
+                    self.answer_cache.documents_changed(user_id, repaired)
+        logger.info(f"Repaired embeddings of {len(repaired)} documents for user {user_id}" +
+                    (f", {len(failed)} failed" if failed else ""))
+        return failed
+
+    def _refresh_partition(self, partition, publish=None):
+        """Reload a partition's documents from Firebase, page by page
+
+        Each page goes into the index as it arrives, and documents no longer
+        in Firebase are dropped at the end instead of clearing the index
+        first, so a loaded partition keeps answering while it refreshes.
+        publish, if given, is called after the first page so a cold partition
+        serves queries from the pages loaded so far.
+        """
+        logger.info(f"Refreshing documents for user {partition.user_id} from Firebase...")
+        synced_at = datetime.now(timezone.utc)
+        
+        with partition.lock:
+            live_ids, loaded = set(), 0
+            try:
+                pages = self.firebase_sync.iter_document_pages(partition.user_id, include_content=not LAZY_CONTENT)
+                for page in pages:
+                    loaded += len(page)
+                    valid_docs = self._indexable(partition, page)
+                    partition.upsert(valid_docs)
+                    live_ids.update(doc.id for doc in valid_docs)
+                    if publish is not None:
+                        partition.loading = True
+                        partition.indexed_generation = partition.generation
+                        publish(partition)
+                        publish = None
+            except Exception:
+                # Half-loaded: rebuild on next use
+                partition.indexed_generation = None
+                raise
+            finally:
+                partition.loading = False
             
-            # Refresh documents before querying
-            doc_count = self.refresh_documents()
-            if doc_count == 0:
-                return {
-                    "answer": "No documents found in the knowledge base.",
-                    "relevant_documents": [],
-                    "timing": {"total": 0}
-                }
+            removed = partition.delete([doc.id for doc in partition.index.documents() if doc.id not in live_ids])
+            if live_ids:
+                logger.info(f"Refreshed {len(live_ids)} documents with valid embeddings"
+                            + (f", removed {removed}" if removed else ""))
+            elif loaded:
+                logger.warning("No documents with current embeddings found yet")
             
+            partition.synced_at = synced_at
+            partition.bump_generation()
+        self._invalidate_answers(partition)
+        if self.snapshots is not None:
+            try:
+                self._save_snapshot(partition)
+            except Exception as e:
+                logger.warning(f"Failed to write snapshot for user {partition.user_id}: {str(e)}")
+        return len(live_ids)
+
+    def _invalidate_answers(self, partition):
+        """Drop cached answers for a partition reloaded from Firebase, which may hold changes made elsewhere"""
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate_user(partition.user_id)
+
+    @staticmethod
+    def _resolve_mode(query_text, mode):
+        """Pick the retrieval mode for a query; auto sends short keyword queries down the lexical path"""
+        mode = mode or DEFAULT_RETRIEVAL_MODE
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode: {mode}")
+        if mode == "auto":
+            is_keyword_query = "?" not in query_text and len(tokenize(query_text)) <= LEXICAL_FAST_PATH_MAX_TERMS
+            return "lexical" if is_keyword_query else "hybrid"
+        return mode
+
+    def _search(self, partition, query_text, query_embedding, mode, top_k):
+        """Run one retrieval mode, returning (chunk, score) hits with scores in [0, 1]"""
+        if mode == "vector":
+            return partition.index.search(query_embedding, top_k=top_k)
+        lexical_hits = partition.lexical.search(query_text, top_k=top_k)
+        if mode == "lexical":
+            # Scale BM25 scores relative to the best match
+            best = lexical_hits[0][1] if lexical_hits else 1.0
+            return [(doc, score / best) for doc, score in lexical_hits]
+        vector_hits = partition.index.search(query_embedding, top_k=top_k)
+        return reciprocal_rank_fusion([vector_hits, lexical_hits], top_k=top_k)
+
+    def _retrieve(self, query_text, user_id, timing, usage, mode=None):
+        """Embed the question, search the user's partition and build the prompt
+
+        mode is vector, hybrid (reciprocal rank fusion of vector and BM25
+        ranks), lexical (BM25 only, no embedding round trip) or auto. The mode
+        used and token counts for the packed context and the prompt go into usage.
+        Returns (hits, prompt, cache_key), or (None, reply, None) when there is
+        nothing to answer from or the answer cache already has one.
+        """
+        # Mutations keep the index current in place, so a rebuild is only
+        # needed if the partition was never loaded or a rebuild failed
+        with tracing.span("partition", user_id=user_id):
+            partition = self._partition_for_update(user_id)
+        
+        if len(partition.index) == 0:
+            return None, {
+                "answer": "No documents found in the knowledge base.",
+                "relevant_documents": [],
+                "timing": {"total": 0}
+            }, None
+        
+        requested_mode = mode or DEFAULT_RETRIEVAL_MODE
+        mode = self._resolve_mode(query_text, mode)
+        if partition.lexical is None and requested_mode != "vector":
+            # Loaded without content, so there is no lexical index to search
+            raise ValueError(f"Retrieval mode {requested_mode} needs the lexical index, "
+                             f"which is not built when LAZY_CONTENT=1")
+        if partition.loading:
+            usage["partial_index"] = True
+        candidates = QUERY_TOP_K * CHUNK_CANDIDATE_FACTOR
+        generation = partition.generation
+        
+        # Keyword fast path: answer from BM25 alone when it finds anything
+        hits = None
+        if mode == "lexical":
+            with tracing.span("retrieval", mode=mode) as stage:
+                hits = self._search(partition, query_text, None, mode, candidates)
+            timing["retrieval"] = stage.duration_ms
+            if not hits and requested_mode == "auto":
+                hits, mode = None, "hybrid"
+        
+        query_embedding = None
+        if mode != "lexical":
             # Generate query embedding
-            embed_start = time.time()
-            query_result = self.text_embedder.run(query_text)
-            query_embedding = query_result["embedding"]
-            timing["embedding"] = (time.time() - embed_start) * 1000
-            
-            # Set up retriever
-            retriever = InMemoryEmbeddingRetriever(
-                document_store=self.document_store,
-                top_k=5
-            )
-            
-            # Retrieve relevant documents
-            retrieve_start = time.time()
-            retrieval_result = retriever.run(query_embedding)
-            timing["retrieval"] = (time.time() - retrieve_start) * 1000
-            
-            if not retrieval_result.get("documents"):
-                return {
-                    "answer": "No relevant documents found.",
-                    "relevant_documents": [],
-                    "timing": timing
-                }
-            
-            # Build prompt using Sphinx prompt
-            prompt_start = time.time()
-            prompt_builder = PromptBuilder(template=SPHINX_PROMPT)
-            prompt_result = prompt_builder.run(
-                documents=retrieval_result["documents"],
+            with tracing.span("embedding") as stage:
+                try:
+                    query_result = self.text_embedder.run(query_text)
+                    query_embedding = query_result["embedding"]
+                except Exception as e:
+                    if partition.lexical is None:
+                        raise
+                    # A degraded embedder should not take queries down with it
+                    logger.warning(f"Query embedding failed, falling back to lexical retrieval: {str(e)}")
+                    mode = "lexical"
+            timing["embedding"] = stage.duration_ms
+        
+        # Near-identical questions reuse the answer while its documents are unchanged
+        if self.answer_cache is not None and mode == "vector" and not partition.loading:
+            with tracing.span("answer_cache"):
+                cached = self.answer_cache.get(partition.user_id, query_embedding)
+            metrics.increment("cache_requests_total", cache="answer", result="hit" if cached is not None else "miss")
+            if cached is not None:
+                usage["retrieval_mode"] = mode
+                return None, {**cached, "timing": dict(timing), "cached": True}, None
+        
+        # Retrieve relevant chunks with their similarity and group them by note
+        with tracing.span("retrieval", mode=mode) as stage:
+            if hits is None:
+                hits = self._search(partition, query_text, query_embedding, mode, candidates)
+            notes = group_hits(hits, QUERY_TOP_K)
+        timing["retrieval"] = timing.get("retrieval", 0) + stage.duration_ms
+        usage["retrieval_mode"] = mode
+        
+        if not notes:
+            return None, {
+                "answer": "No relevant documents found.",
+                "relevant_documents": [],
+                "timing": timing
+            }, None
+        
+        with tracing.span("content", notes=len(notes)) as stage:
+            self._fill_content(notes)
+        timing["content"] = stage.duration_ms
+        
+        # Fit the retrieved content into the context budget, then build the prompt
+        with tracing.span("prompt") as stage:
+            packed, context_stats = self.context_packer.pack(query_text, [note.text() for note in notes])
+            context_docs = [
+                Document(id=note.parent_id, content=text, meta=note.meta)
+                for note, text in zip(notes, packed)
+                if text is not None
+            ]
+            prompt_result = get_prompt_builder().run(
+                documents=context_docs,
                 question=query_text
             )
-            timing["prompt"] = (time.time() - prompt_start) * 1000
-            
-            # Log the prompt
+        timing["prompt"] = stage.duration_ms
+        usage.update(context_stats)
+        usage["prompt_tokens"] = estimate_tokens(prompt_result["prompt"])
+        tracing.annotate(retrieval_mode=mode, notes=len(notes), prompt_tokens=usage["prompt_tokens"])
+        
+        # Full prompts are large, so only a sample of them is logged
+        if PROMPT_LOG_SAMPLE_RATE > 0 and random.random() < PROMPT_LOG_SAMPLE_RATE:
             logger.info("\n🔍 Generated Prompt:")
             logger.info("=" * 50)
             logger.info(prompt_result["prompt"])
             logger.info("=" * 50)
+        
+        # Only vector results are cached: their invalidation rule relies on cosine scores
+        cache_key = (partition, query_embedding, generation) if mode == "vector" else None
+        return notes, prompt_result["prompt"], cache_key
+
+    def _fill_content(self, notes):
+        """Give retrieved chunks loaded without content their content, fetching what is not cached"""
+        missing = {doc.id: doc for note in notes for doc, _ in note.chunks if doc.content is None}
+        if not missing:
+            return
+        # Chunks of a note share its content hash, which changes whenever the note does
+        keys = {doc_id: (doc_id, doc.meta.get("content_hash")) for doc_id, doc in missing.items()}
+        contents = {}
+        with self._contents_lock:
+            for doc_id, key in keys.items():
+                if key in self._contents:
+                    self._contents.move_to_end(key)
+                    contents[doc_id] = self._contents[key]
+        
+        to_fetch = [doc_id for doc_id in missing if doc_id not in contents]
+        metrics.increment("cache_requests_total", len(contents), cache="content", result="hit")
+        metrics.increment("cache_requests_total", len(to_fetch), cache="content", result="miss")
+        if to_fetch:
+            with tracing.span("content_fetch", documents=len(to_fetch)):
+                fetched = self.firebase_sync.load_contents(to_fetch)
+            contents.update(fetched)
+            with self._contents_lock:
+                for doc_id, content in fetched.items():
+                    self._contents[keys[doc_id]] = content
+                while len(self._contents) > CONTENT_CACHE_MAX_ENTRIES:
+                    self._contents.popitem(last=False)
+        
+        # Copies, so the indexed documents stay without content
+        for note in notes:
+            note.chunks = [
+                (dataclasses.replace(doc, content=contents.get(doc.id) or "") if doc.content is None else doc, score)
+                for doc, score in note.chunks
+            ]
+
+    def _cache_answer(self, cache_key, answer, relevant_documents, notes):
+        """Cache a generated answer unless the partition changed while it was generated"""
+        if self.answer_cache is None or cache_key is None:
+            return
+        partition, query_embedding, generation = cache_key
+        if partition.generation != generation:
+            return
+        # A new note changes the result only if it beats the weakest note retrieved,
+        # unless fewer notes than asked for were found
+        min_score = min(note.score for note in notes) if len(notes) == QUERY_TOP_K else None
+        self.answer_cache.put(
+            partition.user_id,
+            query_embedding,
+            {"answer": answer, "relevant_documents": relevant_documents},
+            [doc.id for note in notes for doc, _ in note.chunks],
+            min_score
+        )
+
+    @staticmethod
+    def _record_query(timing, usage, outcome):
+        """Add a finished query's stage timings and outcome to the metrics registry"""
+        for stage, duration in timing.items():
+            metrics.observe("stage_duration_ms", duration, stage=stage)
+        metrics.increment("queries_total", mode=usage.get("retrieval_mode", "none"), outcome=outcome)
+
+    @staticmethod
+    def _format_hits(notes):
+        """Format one result per note, showing its best chunk and score"""
+        results = []
+        for note in notes:
+            content = note.best_chunk.content
+            results.append({
+                "title": note.meta.get("title", "Untitled"),
+                "content": content[:200] + "..." if len(content) > 200 else content,
+                "similarity": round(note.score * 100, 2)  # Round to 2 decimal places
+            })
+        return results
+
+    def query(self, query_text, user_id=None, mode=None):
+        """Query one user's documents, rebuilding their index only if it is out of date"""
+        try:
+            start_time = time.time()
+            timing = {}
+            usage = {}
             
-            # Generate answer with adjusted parameters for more natural conversation
-            generation_start = time.time()
-            model = get_gemini_model()
-            response = model.generate_content(
-                prompt_result["prompt"],
-                generation_config={
-                    "temperature": 0.88,  # Balanced for natural conversation
-                    "max_output_tokens": 1024,
-                    "top_p": 0.95,  # Increased for more natural language
-                    "top_k": 45,  # Slightly increased for more expressive responses
-                }
-            )
-            answer = response.text if response.text else "No answer generated"
-            timing["generation"] = (time.time() - generation_start) * 1000
+            hits, prompt, cache_key = self._retrieve(query_text, user_id, timing, usage, mode)
+            if hits is None:
+                if prompt.get("cached"):
+                    prompt["timing"]["total"] = (time.time() - start_time) * 1000
+                self._record_query(prompt["timing"], usage, "cached" if prompt.get("cached") else "empty")
+                return prompt
             
-            # Format results with similarity scores
-            results = []
-            for doc in retrieval_result["documents"]:
-                # Skip documents without embeddings
-                if doc.embedding is None or query_embedding is None:
-                    logger.warning(f"Skipping document {doc.id} due to missing embedding")
-                    continue
-                    
-                try:
-                    # Calculate cosine similarity
-                    similarity = float(np.dot(doc.embedding, query_embedding) / 
-                                    (np.linalg.norm(doc.embedding) * np.linalg.norm(query_embedding)) * 100)
-                    
-                    results.append({
-                        "title": doc.meta.get("title", "Untitled"),
-                        "content": doc.content[:200] + "..." if len(doc.content) > 200 else doc.content,
-                        "similarity": round(similarity, 2)  # Round to 2 decimal places
-                    })
-                except Exception as e:
-                    logger.warning(f"Error calculating similarity for document {doc.id}: {str(e)}")
-                    continue
-            
-            # Sort by similarity
-            results.sort(key=lambda x: x["similarity"], reverse=True)
+            # Generate answer with adjusted parameters for more natural conversation
+            with tracing.span("generation") as stage:
+                model = get_gemini_model()
+                response = model.generate_content(prompt, generation_config=GENERATION_CONFIG)
+                answer = response.text if response.text else "No answer generated"
+            timing["generation"] = stage.duration_ms
             
             timing["total"] = (time.time() - start_time) * 1000
             
+            self._record_query(timing, usage, "answered")
+            relevant_documents = self._format_hits(hits)
+            if response.text:
+                self._cache_answer(cache_key, answer, relevant_documents, hits)
             return {
                 "answer": answer,
-                "relevant_documents": results,
-                "timing": timing
+                "relevant_documents": relevant_documents,
+                "timing": timing,
+                "usage": usage
             }
             
         except Exception as e:
             logger.error(f"Error in query: {str(e)}")
             raise
 
-    def add_documents(self, documents):
-        """Add documents to both stores"""
+    def query_stream(self, query_text, user_id=None, mode=None):
+        """Streaming variant of query: yields answer chunks as they are generated
+
+        Yields {"event": "chunk", "text": ...} frames followed by one
+        {"event": "done", ...} frame with the full answer, relevant_documents
+        and timing (including time to first token).
+        """
         try:
-            # Convert to Haystack Document format
-            haystack_docs = []
-            for doc in documents:
-                haystack_doc = Document(
-                    content=doc["content"].strip(),
-                    meta={"title": doc["title"]},
-                    id=doc.get("id", str(uuid.uuid4()))  # Use Firebase ID if available
-                )
-                haystack_docs.append(haystack_doc)
+            start_time = time.time()
+            timing = {}
+            usage = {}
             
-            # Generate embeddings
-            logger.info(f"Generating embeddings for {len(haystack_docs)} documents...")
-            result = self.doc_embedder.run(haystack_docs)
-            embedded_docs = result["documents"]
+            hits, prompt, cache_key = self._retrieve(query_text, user_id, timing, usage, mode)
+            if hits is None:
+                if prompt.get("cached"):
+                    # Send the cached answer as a single chunk
+                    prompt["timing"]["total"] = (time.time() - start_time) * 1000
+                    yield {"event": "chunk", "text": prompt["answer"]}
+                self._record_query(prompt["timing"], usage, "cached" if prompt.get("cached") else "empty")
+                yield {"event": "done", **prompt}
+                return
+            
+            with tracing.span("generation", stream=True) as stage:
+                model = get_gemini_model()
+                response = model.generate_content(prompt, generation_config=GENERATION_CONFIG, stream=True)
+                parts = []
+                for chunk in response:
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        # Chunks without text parts (e.g. safety metadata only)
+                        continue
+                    if not text:
+                        continue
+                    if not parts:
+                        timing["first_token"] = (time.time() - start_time) * 1000
+                        tracing.annotate(first_token_ms=round(timing["first_token"], 3))
+                    parts.append(text)
+                    yield {"event": "chunk", "text": text}
+            timing["generation"] = stage.duration_ms
             
-            # Save to Firebase
-            self.firebase_sync.save_documents(embedded_docs)
+            timing["total"] = (time.time() - start_time) * 1000
+            logger.info(f"Streamed {len(parts)} chunks, first token after "
+                        f"{timing.get('first_token', timing['total']):.2f}ms")
             
-            logger.info(f"Successfully added {len(embedded_docs)} documents")
-            return {
-                "success": True,
-                "message": "Documents added successfully",
-                "document_count": len(embedded_docs),
-                "cached_count": len([doc for doc in embedded_docs if doc.embedding is not None])
+            self._record_query(timing, usage, "answered")
+            relevant_documents = self._format_hits(hits)
+            if parts:
+                self._cache_answer(cache_key, "".join(parts), relevant_documents, hits)
+            yield {
+                "event": "done",
+                "answer": "".join(parts) or "No answer generated",
+                "relevant_documents": relevant_documents,
+                "timing": timing,
+                "usage": usage
             }
             
+        except Exception as e:
+            logger.error(f"Error in streaming query: {str(e)}")
+            raise
+
+    def _to_haystack_documents(self, documents, user_id=None):
+        """Convert incoming notes to Haystack Documents tagged with their owner and a content hash"""
+        haystack_docs = []
+        for doc in documents:
+            content = doc["content"].strip()
+            title = doc["title"]
+            doc_hash = content_hash(f"{title}\n{content}")
+            haystack_doc = Document(
+                content=content,
+                meta={"title": title, "content_hash": doc_hash, "user_id": user_id or DEFAULT_PARTITION},
+                id=doc.get("id") or str(uuid.uuid4())  # Use Firebase ID if available
+            )
+            haystack_docs.append(haystack_doc)
+        return haystack_docs
+
+    @staticmethod
+    def _chunk_documents(haystack_docs):
+        """Split notes into overlapping, paragraph-aligned chunks that point back at their note"""
+        chunks = []
+        for doc in haystack_docs:
+            texts = split_text(doc.content)
+            for i, text in enumerate(texts):
+                chunks.append(Document(
+                    id=chunk_id(doc.id, i, len(texts)),
+                    content=text,
+                    meta={**doc.meta, "parent_id": doc.id, "chunk_index": i, "chunk_count": len(texts)}
+                ))
+        return chunks
+
+    def _embed_and_store(self, partition, haystack_docs, job=None, stored_chunks=None):
+        """Chunk and embed notes, save them to Firebase and update the partition in place
+
+        Chunks go through in slices: one slice is embedded while the one
+        before it is written, and each slice is indexed once it is stored.
+        Chunks left over from an earlier, longer version of a note are
+        deleted, including ones stored without an embedding; stored_chunks
+        ({note ID: chunk IDs}) saves reading them from Firestore when the
+        caller already has them. A failed write raises, unless a job is
+        given, in which case the notes it affected are recorded on the job
+        and the rest carry on.
+        """
+        chunks = self._chunk_documents(haystack_docs)
+        chunk_ids = {chunk.id for chunk in chunks}
+        note_ids = [doc.id for doc in haystack_docs]
+        if stored_chunks is None:
+            stored_chunks = self.firebase_sync.note_chunks(partition.user_id, note_ids)
+        stale = [(parent_id, doc_id) for parent_id in note_ids
+                 for doc_id in set(stored_chunks.get(parent_id, ())) | partition.chunk_ids([parent_id])
+                 if doc_id not in chunk_ids]
+        if job is not None:
+            job.add_chunks(len(chunks))
+        
+        logger.info(f"Generating embeddings for {len(chunks)} chunks of {len(haystack_docs)} documents...")
+        stored, failed_notes = [], set()
+        pending = None
+        for start in range(0, len(chunks), INGEST_SLICE_CHUNKS):
+            chunk_slice = chunks[start:start + INGEST_SLICE_CHUNKS]
+            with metrics.timer("stage_duration_ms", stage="ingest_embedding"), \
+                    tracing.span("ingest_embedding", chunks=len(chunk_slice)):
+                embedded = self.doc_embedder.run(chunk_slice)["documents"]
+            if job is not None:
+                job.record_embedded(len(embedded))
+            # Wait for the previous slice's write only once this slice is embedded
+            if pending is not None:
+                stored += self._finish_slice(partition, *pending, failed_notes, job)
+            # The write runs on the store pool but is recorded in this trace
+            write = self._store_pool.submit(tracing.propagate(self.firebase_sync.save_documents), embedded)
+            pending = (write, embedded)
+        if pending is not None:
+            stored += self._finish_slice(partition, *pending, failed_notes, job)
+        
+        # Keep the old chunks of notes whose new version did not make it
+        stale_ids = [doc_id for parent_id, doc_id in stale if parent_id not in failed_notes]
+        if stale_ids:
+            self.firebase_sync.delete_documents(stale_ids, partition.user_id)
+            partition.delete(stale_ids)
+            partition.bump_generation()
+            if self.answer_cache is not None:
+                self.answer_cache.documents_removed(partition.user_id, stale_ids)
+        self.partitions.rebalance(keep=partition.user_id)
+        metrics.increment("ingested_notes_total", len(haystack_docs) - len(failed_notes))
+        metrics.increment("ingested_chunks_total", len(stored))
+        return stored
+
+    def _finish_slice(self, partition, write, embedded, failed_notes, job):
+        """Wait for a slice's write, then index what was stored; returns the stored chunks"""
+        try:
+            write.result()
+            stored = embedded
+        except WriteError as e:
+            if job is None:
+                raise
+            failed_ids = {ref.id for ref in e.failed_refs}
+            for doc in embedded:
+                if doc.id in failed_ids:
+                    failed_notes.add(parent_id_of(doc))
+                    job.fail_note(parent_id_of(doc), "write", str(e))
+            stored = [doc for doc in embedded if doc.id not in failed_ids]
+        
+        # Chunks whose embedding failed are stored without one and repaired in the background
+        unembedded = [doc for doc in stored if doc.embedding is None]
+        if unembedded:
+            self.repairs.submit(partition.user_id, unembedded)
+            if job is not None:
+                for doc in unembedded:
+                    job.fail_note(parent_id_of(doc), "embedding", "Embedding failed; queued for repair")
+        
+        indexable_docs = [doc for doc in stored if doc.embedding is not None]
+        if indexable_docs:
+            partition.upsert(indexable_docs)
+            partition.bump_generation()
+            if self.answer_cache is not None:
+                self.answer_cache.documents_changed(partition.user_id, indexable_docs)
+        if job is not None:
+            job.record_written(len(stored))
+        return stored
+
+    def add_documents(self, documents, user_id=None, job=None):
+        """Add documents to both stores, reporting progress on job if given"""
+        try:
+            partition = self._partition_for_update(user_id)
+            with partition.lock:
+                # Convert to Haystack Document format
+                haystack_docs = self._to_haystack_documents(documents, user_id)
+                embedded_docs = self._embed_and_store(partition, haystack_docs, job)
+            
+                logger.info(f"Successfully added {len(haystack_docs)} documents as {len(embedded_docs)} chunks")
+                return {
+                    "success": True,
+                    "message": "Documents added successfully",
+                    "document_count": len(haystack_docs),
+                    "chunk_count": len(embedded_docs),
+                    "cached_count": len([doc for doc in embedded_docs if doc.embedding is not None])
+                }
+            
         except Exception as e:
             logger.error(f"Error adding documents: {str(e)}")
             raise
 
-    def clear_documents(self):
-        """Clear all documents from both stores"""
+    def sync_documents(self, documents, user_id=None, job=None):
+        """Bring a user's stores in line with the given notes, touching only what changed"""
         try:
-            # Get existing document IDs
-            existing_docs = self.document_store.filter_documents({})
-            if existing_docs:
-                doc_ids = [doc.id for doc in existing_docs]
-                # Clear from in-memory store
-                self.document_store.delete_documents(document_ids=doc_ids)
-                # Clear from Firebase Haystack collection
-                for doc_id in doc_ids:
-                    try:
-                        self.firebase_sync.collection.document(doc_id).delete()
-                    except Exception as e:
-                        logger.warning(f"Failed to delete document {doc_id} from Firebase: {str(e)}")
-                logger.info(f"Cleared {len(doc_ids)} documents from both stores")
-            else:
-                logger.info("No documents to clear")
+            partition = self._partition_for_update(user_id)
+            with partition.lock:
+            
+                # Notes without an ID get one derived from their content, so an
+                # unchanged note maps to the same document on every sync
+                for doc in documents:
+                    if not doc.get("id"):
+                        doc["id"] = content_hash(f"{doc['title']}\n{doc['content'].strip()}")
+                incoming = self._to_haystack_documents(documents, user_id)
+            
+                # Compare whole notes against what is stored, including chunks
+                # kept without an embedding that the index never saw; every
+                # chunk carries its note's content hash
+                stored = self.firebase_sync.note_chunks(partition.user_id)
+                stored_hashes = {parent_id: set(chunks.values()) for parent_id, chunks in stored.items()}
+            
+                to_upsert = []
+                added = updated = skipped = 0
+                seen_ids = set()
+                for doc in incoming:
+                    if doc.id in seen_ids:
+                        continue
+                    seen_ids.add(doc.id)
+                    if doc.id not in stored_hashes:
+                        added += 1
+                        to_upsert.append(doc)
+                    elif stored_hashes[doc.id] != {doc.meta["content_hash"]}:
+                        updated += 1
+                        to_upsert.append(doc)
+                    else:
+                        skipped += 1
+                to_delete = [doc_id for doc_id in stored_hashes if doc_id not in seen_ids]
+            
+                if to_upsert:
+                    self._embed_and_store(partition, to_upsert, job,
+                                          stored_chunks={doc.id: stored.get(doc.id, {}) for doc in to_upsert})
+            
+                if to_delete:
+                    chunk_ids = sorted({chunk_id for parent_id in to_delete for chunk_id in stored[parent_id]} |
+                                       partition.chunk_ids(to_delete))
+                    self.firebase_sync.delete_documents(chunk_ids, partition.user_id)
+                    partition.delete(chunk_ids)
+                    partition.bump_generation()
+                    if self.answer_cache is not None:
+                        self.answer_cache.documents_removed(partition.user_id, chunk_ids)
+            
+                logger.info(f"Synced notes: {added} added, {updated} updated, "
+                            f"{len(to_delete)} deleted, {skipped} unchanged")
+                return {
+                    "success": True,
+                    "added": added,
+                    "updated": updated,
+                    "deleted": len(to_delete),
+                    "skipped": skipped
+                }
+            
+        except Exception as e:
+            logger.error(f"Error syncing documents: {str(e)}")
+            raise
+
+    def clear_documents(self, user_id=None):
+        """Clear all of a user's documents from both stores
+
+        Returns {"success", "deleted", "failed"}; documents whose delete
+        failed stay in the index so it keeps matching Firestore.
+        """
+        try:
+            partition = self._partition_for_update(user_id)
+            with partition.lock:
+                # Everything stored for the user, including documents the index skipped
+                indexed_ids = [doc.id for doc in partition.index.documents()]
+                result = self.firebase_sync.delete_user_documents(partition.user_id, indexed_ids)
+                
+                partition.delete(result["deleted"])
+                partition.bump_generation()
+                self._invalidate_answers(partition)
+                
+                if result["failed"]:
+                    logger.error(f"Cleared {len(result['deleted'])} documents, "
+                                 f"{len(result['failed'])} failed to delete")
+                else:
+                    logger.info(f"Cleared {len(result['deleted'])} documents from both stores")
+                return {
+                    "success": not result["failed"],
+                    "deleted": len(result["deleted"]),
+                    "failed": result["failed"]
+                }
                 
         except Exception as e:
             logger.error(f"Error clearing documents: {str(e)}")
             raise
-    def delete_document(self, doc_id: str):
-        """Delete a single document from both stores"""
+
+    def delete_document(self, doc_id: str, user_id=None):
+        """Delete one of a user's notes, with all of its chunks, from both stores
+
+        Only documents stored for the user are touched. Firestore is updated
+        first, and the index and answer cache only drop what was deleted
+        there, so they never lose documents that are still stored.
+        """
         try:
-            # Delete from in-memory store
-            self.document_store.delete_documents(document_ids=[doc_id])
-            
-            # Delete from Firebase Haystack collection
-            try:
-                self.firebase_sync.collection.document(doc_id).delete()
-                logger.info(f"Deleted document {doc_id} from Haystack collection")
-            except Exception as e:
-                logger.error(f"Error deleting from Haystack collection: {str(e)}")
-                raise
+            user_id = user_id or DEFAULT_PARTITION
+            partition = self.partitions.peek(user_id)
+            with partition.lock if partition is not None else contextlib.nullcontext():
+                # Chunks are found in Firestore, so this works whether or not the partition is loaded
+                chunk_ids = self.firebase_sync.list_chunk_ids(doc_id, user_id)
+                chunk_ids |= self.firebase_sync.owned_document_ids([doc_id], user_id)
+                if partition is not None:
+                    chunk_ids.update(partition.chunk_ids([doc_id]))
+                if not chunk_ids:
+                    logger.info(f"No document {doc_id} stored for user {user_id}, nothing to delete")
+                    return True
                 
-            # Clear from cache if exists
-            if hasattr(self.firebase_sync, '_document_cache'):
-                self.firebase_sync._document_cache.pop(doc_id, None)
+                result = self.firebase_sync.delete_documents(sorted(chunk_ids), user_id, raise_on_failure=False)
                 
-            logger.info(f"Successfully deleted document {doc_id} from all stores")
+                # An unloaded partition picks the deletion up when it loads
+                if partition is not None and result["deleted"]:
+                    partition.delete(result["deleted"])
+                    partition.bump_generation()
+            if self.answer_cache is not None and result["deleted"]:
+                self.answer_cache.documents_removed(user_id, result["deleted"])
+            
+            if result["failed"]:
+                raise RuntimeError(f"{len(result['failed'])} of {len(chunk_ids)} chunks of document "
+                                   f"{doc_id} could not be deleted from Firestore")
+            logger.info(f"Successfully deleted document {doc_id} ({len(chunk_ids)} chunks) from all stores")
             return True
             
         except Exception as e:
@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_FINISHED_JOBS = 200
+
+
+class IngestJob:
+    """Progress of one background insert or sync
+
+    Counters are updated by the ingestion pipeline as slices of chunks are
+    embedded and written; failures are recorded per note with the stage
+    that failed.
+    """
+
+    def __init__(self, kind, user_id, note_count):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.user_id = user_id
+        self.status = "queued"
+        self.notes = note_count
+        self.chunks = 0
+        self.embedded = 0
+        self.written = 0
+        self.failures = OrderedDict()
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def add_chunks(self, count):
+        with self._lock:
+            self.chunks += count
+
+    def record_embedded(self, count):
+        with self._lock:
+            self.embedded += count
+
+    def record_written(self, count):
+        with self._lock:
+            self.written += count
+
+    def fail_note(self, note_id, stage, error):
+        """Record a note that was not fully ingested; the first failure of a note is kept"""
+        with self._lock:
+            self.failures.setdefault(note_id, {"id": note_id, "stage": stage, "error": error})
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def to_dict(self):
+        with self._lock:
+            end = self.finished_at or time.time()
+            elapsed = end - self.started_at if self.started_at else 0.0
+            return {
+                "job_id": self.id,
+                "kind": self.kind,
+                "user_id": self.user_id,
+                "status": self.status,
+                "notes": self.notes,
+                "chunks": self.chunks,
+                "embedded": self.embedded,
+                "written": self.written,
+                "progress": round(self.written / self.chunks, 4) if self.chunks else (1.0 if self.finished else 0.0),
+                "failed": len(self.failures),
+                "failures": list(self.failures.values()),
+                "elapsed_seconds": round(elapsed, 3),
+                "chunks_per_second": round(self.written / elapsed, 1) if elapsed > 0 else 0.0,
+                "result": self.result,
+                "error": self.error
+            }
+
+
+class JobManager:
+    """Runs ingestion jobs in the background and keeps their status for polling
+
+    Jobs run on their own workers, so a long import does not hold a request
+    slot. Finished jobs are kept for status queries, oldest dropped first.
+    """
+
+    def __init__(self, max_workers=None, max_finished=None):
+        self.max_workers = int(max_workers or os.getenv("INGEST_JOB_WORKERS", 1))
+        self.max_finished = int(max_finished or os.getenv("INGEST_MAX_FINISHED_JOBS", DEFAULT_MAX_FINISHED_JOBS))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ingest-job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, kind, user_id, note_count, fn):
+        """Queue fn(job) to run in the background and return the job"""
+        job = IngestJob(kind, user_id, note_count)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn)
+        logger.info(f"Queued {kind} job {job.id} for user {user_id} with {note_count} notes")
+        return job
+
+    def _run(self, job, fn):
+        job.started_at = time.time()
+        job.status = "running"
+        try:
+            job.result = fn(job)
+            job.status = "completed_with_errors" if job.failures else "succeeded"
+        except Exception as e:
+            logger.error(f"{job.kind.capitalize()} job {job.id} failed: {str(e)}")
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            logger.info(f"{job.kind.capitalize()} job {job.id} {job.status} in "
+                        f"{job.finished_at - job.started_at:.2f}s ({job.written} chunks written, "
+                        f"{len(job.failures)} notes failed)")
+            self._prune()
+
+    def _prune(self):
+        """Forget the oldest finished jobs beyond max_finished"""
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+            for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+                del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        """Job counts by status"""
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
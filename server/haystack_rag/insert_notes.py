@@ -27,7 +27,7 @@ def insert_notes(user_id, notes_json):
             note['content'] = content
         
         # Add documents to Haystack
-        result = service.add_documents(notes)
+        result = service.add_documents(notes, user_id)
         
         # Verify documents were added
         if not result.get('success'):
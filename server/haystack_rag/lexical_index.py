@@ -0,0 +1,123 @@
+import heapq
+import math
+import re
+import threading
+from collections import Counter
+
+_TOKEN_RE = re.compile(r"\w+")
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have how i in is it its me my of on or so that the
+their them there these this to was we were what when where which who why will with you your
+""".split())
+
+
+def tokenize(text):
+    """Lowercased word tokens without stopwords"""
+    return [token for token in _TOKEN_RE.findall((text or "").lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """Inverted index with BM25 scoring, updated incrementally per document
+
+    Postings map each term to {doc_id: term frequency}. Collection
+    statistics (document count, total length) are kept as running totals,
+    so adding or removing a document only touches that document's terms.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Drop every document from the index"""
+        with self._lock:
+            self._postings = {}
+            self._doc_terms = {}
+            self._doc_lengths = {}
+            self._documents = {}
+            self._total_length = 0
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._documents
+
+    def memory_bytes(self):
+        """Rough size of the postings and per-document term tables"""
+        with self._lock:
+            postings = sum(len(p) for p in self._postings.values())
+            return postings * 16 + len(self._postings) * 64 + len(self._documents) * 96
+
+    def _add(self, doc):
+        terms = Counter(tokenize(doc.content))
+        self._doc_terms[doc.id] = terms
+        self._doc_lengths[doc.id] = sum(terms.values())
+        self._documents[doc.id] = doc
+        self._total_length += self._doc_lengths[doc.id]
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[doc.id] = tf
+
+    def _remove(self, doc_id):
+        terms = self._doc_terms.pop(doc_id, None)
+        if terms is None:
+            return False
+        for term in terms:
+            posting = self._postings.get(term)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self._postings[term]
+        self._total_length -= self._doc_lengths.pop(doc_id)
+        del self._documents[doc_id]
+        return True
+
+    def upsert(self, documents):
+        """Insert documents or replace the ones with a matching ID"""
+        with self._lock:
+            for doc in documents:
+                self._remove(doc.id)
+                self._add(doc)
+
+    def delete(self, document_ids):
+        """Remove documents by ID; returns how many were present"""
+        with self._lock:
+            return sum(1 for doc_id in document_ids if self._remove(doc_id))
+
+    def search(self, query_text, top_k=5):
+        """Return up to top_k (document, BM25 score) pairs, best first"""
+        terms = set(tokenize(query_text))
+        with self._lock:
+            if not terms or not self._documents:
+                return []
+            n = len(self._documents)
+            avg_length = self._total_length / n or 1.0
+            scores = {}
+            for term in terms:
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+                for doc_id, tf in posting.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[doc_id] / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+            best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+            return [(self._documents[doc_id], score) for doc_id, score in best]
+
+
+def reciprocal_rank_fusion(result_lists, top_k=5, k=60):
+    """Fuse ranked (document, score) lists by reciprocal rank
+
+    Fused scores are scaled so a document ranked first in every list scores 1.0.
+    """
+    fused = {}
+    documents = {}
+    for results in result_lists:
+        for rank, (doc, _) in enumerate(results):
+            fused[doc.id] = fused.get(doc.id, 0.0) + 1.0 / (k + rank + 1)
+            documents.setdefault(doc.id, doc)
+    scale = len(result_lists) / (k + 1)
+    best = heapq.nlargest(top_k, fused.items(), key=lambda item: item[1])
+    return [(documents[doc_id], score / scale) for doc_id, score in best]
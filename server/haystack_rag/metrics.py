@@ -0,0 +1,193 @@
+import bisect
+import contextlib
+import math
+import threading
+import time
+
+# Upper bounds, in milliseconds, of the latency histogram buckets
+DEFAULT_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# Help text for the Prometheus exposition; metrics not listed get a generic one
+DESCRIPTIONS = {
+    "stage_duration_ms": "Duration of query, ingestion and Firestore stages in milliseconds",
+    "queries_total": "Queries answered, by retrieval mode and outcome",
+    "ingested_notes_total": "Notes embedded and stored",
+    "ingested_chunks_total": "Chunks embedded and stored",
+    "errors_total": "Failed commands and Firestore write batches, by operation",
+    "cache_requests_total": "Cache lookups, by cache and result",
+    "partitions_loaded": "User partitions held in memory",
+    "partition_documents": "Chunks indexed across loaded partitions",
+    "partition_memory_bytes": "Estimated memory used by loaded partitions",
+    "embedding_repair_backlog": "Documents waiting for their embedding to be repaired",
+    "answer_cache_entries": "Answers held in the answer cache",
+    "ingest_jobs": "Ingestion jobs tracked, by status",
+}
+
+
+class Histogram:
+    """Bucketed distribution of observed values, with count, sum and max"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS_MS):
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket plus the overflow (+Inf) bucket, not cumulative
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating within its bucket, as Prometheus does"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / bucket_count, self.max)
+            seen += bucket_count
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "mean": round(self.sum / self.count, 3) if self.count else 0.0,
+            "p50": round(self.quantile(0.5), 3),
+            "p95": round(self.quantile(0.95), 3),
+            "p99": round(self.quantile(0.99), 3),
+            "max": round(self.max, 3)
+        }
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf"
+    return repr(round(value, 6)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """In-process histograms, counters and gauges, keyed by name and labels
+
+    Recording is a dict update under one lock, cheap enough for every
+    request. Read as a dict with snapshot() or as Prometheus text with
+    prometheus().
+    """
+
+    def __init__(self, namespace="haystack"):
+        self.namespace = namespace
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        """Add one value to a histogram"""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        """Add to a counter"""
+        if not amount:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        """Set a value sampled from elsewhere, such as a cache's size"""
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of the enclosed block in milliseconds"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.time() - start) * 1000, **labels)
+
+    def snapshot(self):
+        """All metrics as {"histograms", "counters", "gauges"}, each name mapping to one entry per label set"""
+        def grouped(items, render):
+            result = {}
+            for (name, labels), value in sorted(items, key=lambda item: item[0]):
+                result.setdefault(name, []).append({"labels": dict(labels), **render(value)})
+            return result
+
+        with self._lock:
+            return {
+                "uptime_seconds": round(time.time() - self.started_at, 1),
+                "histograms": grouped(self._histograms.items(), Histogram.to_dict),
+                "counters": grouped(self._counters.items(), lambda value: {"value": value}),
+                "gauges": grouped(self._gauges.items(), lambda value: {"value": value})
+            }
+
+    def prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def header(name, kind):
+            full_name = f"{self.namespace}_{name}"
+            lines.append(f"# HELP {full_name} {DESCRIPTIONS.get(name, name)}")
+            lines.append(f"# TYPE {full_name} {kind}")
+
+        with self._lock:
+            last = None
+            for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                full_name = f"{self.namespace}_{name}"
+                if name != last:
+                    header(name, "histogram")
+                    last = name
+                cumulative = 0
+                for bound, bucket_count in zip(list(histogram.buckets) + [math.inf], histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', _format_value(float(bound)))])} "
+                                 f"{cumulative}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+            for metrics, kind in ((self._counters, "counter"), (self._gauges, "gauge")):
+                last = None
+                for (name, labels), value in sorted(metrics.items(), key=lambda item: item[0]):
+                    full_name = f"{self.namespace}_{name}"
+                    if name != last:
+                        header(name, kind)
+                        last = name
+                    lines.append(f"{full_name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+            self.started_at = time.time()
+
+
+# Shared by the service, the Firestore writer and the service manager
+registry = MetricsRegistry()
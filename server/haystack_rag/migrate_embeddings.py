@@ -0,0 +1,26 @@
+import sys
+import json
+import logging
+from haystack_service import FirebaseSync, EMBEDDING_FORMATS
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def migrate_embeddings(embedding_format=None, dry_run=False):
+    try:
+        result = FirebaseSync().migrate_embeddings(embedding_format, dry_run=dry_run)
+        print(json.dumps({"success": True, "dry_run": dry_run, **result}))
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error migrating embeddings: {error_msg}")
+        print(json.dumps({"success": False, "error": error_msg}))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg != "--dry-run"]
+    if len(args) > 1 or (args and args[0] not in EMBEDDING_FORMATS):
+        print(f"Usage: python migrate_embeddings.py [{'|'.join(EMBEDDING_FORMATS)}] [--dry-run]")
+        sys.exit(1)
+        
+    migrate_embeddings(args[0] if args else None, dry_run="--dry-run" in sys.argv)
@@ -0,0 +1,228 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from chunking import parent_id_of
+from lexical_index import BM25Index
+
+logger = logging.getLogger(__name__)
+
+# Partition key for calls that do not name a user
+DEFAULT_PARTITION = "_default"
+
+
+class Partition:
+    """One user's slice of the corpus: its vector and lexical indexes and corpus generation
+
+    Mutations go through upsert/delete/clear/bulk_load so both indexes hold
+    the same documents. Partitions whose documents are loaded without
+    content have no lexical index.
+    """
+
+    def __init__(self, user_id, index, lexical=True):
+        self.user_id = user_id
+        self.index = index
+        self.lexical = BM25Index() if lexical else None
+        # Corpus generation: bumped on every mutation so callers can tell
+        # whether anything changed since they last looked at the index
+        self.generation = 0
+        self.indexed_generation = None
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        # When the partition was last read from Firestore, and whether it
+        # changed since its snapshot was written
+        self.synced_at = None
+        self.dirty = False
+        # Set while a cold load is still streaming pages into the index
+        self.loading = False
+        # Serializes mutations; searches rely on the index's own lock
+        self.lock = threading.RLock()
+        # Indexed chunk IDs by the note they belong to, and the reverse
+        self._chunks = {}
+        self._parents = {}
+
+    def bump_generation(self):
+        """Record an in-place mutation of the index"""
+        self.generation += 1
+        self.indexed_generation = self.generation
+        self.dirty = True
+
+    def is_current(self):
+        """Whether the index reflects the latest corpus generation"""
+        return self.indexed_generation == self.generation
+
+    def upsert(self, documents):
+        """Index documents that have an embedding in both indexes"""
+        documents = [doc for doc in documents if getattr(doc, "embedding", None) is not None]
+        self.index.upsert(documents)
+        if self.lexical is not None:
+            # Share the vector index's copies, which no longer hold the embedding
+            self.lexical.upsert([self.index.get(doc.id) for doc in documents])
+        self._track(documents)
+
+    def delete(self, document_ids):
+        """Remove documents from both indexes; returns how many were present"""
+        document_ids = list(document_ids)
+        if self.lexical is not None:
+            self.lexical.delete(document_ids)
+        for doc_id in document_ids:
+            parent_id = self._parents.pop(doc_id, None)
+            if parent_id is not None:
+                chunks = self._chunks[parent_id]
+                chunks.discard(doc_id)
+                if not chunks:
+                    del self._chunks[parent_id]
+        return self.index.delete(document_ids)
+
+    def clear(self):
+        self.index.clear()
+        if self.lexical is not None:
+            self.lexical.clear()
+        self._chunks, self._parents = {}, {}
+
+    def bulk_load(self, documents, matrix):
+        """Replace both indexes' contents, using a matrix of pre-normalized vectors"""
+        self.index.bulk_load(documents, matrix)
+        if self.lexical is not None:
+            self.lexical.clear()
+            self.lexical.upsert(documents)
+        self._chunks, self._parents = {}, {}
+        self._track(documents)
+
+    def _track(self, documents):
+        for doc in documents:
+            parent_id = parent_id_of(doc)
+            self._parents[doc.id] = parent_id
+            self._chunks.setdefault(parent_id, set()).add(doc.id)
+
+    def chunk_ids(self, parent_ids):
+        """IDs of the indexed chunks of the given notes"""
+        return {doc_id for parent_id in parent_ids for doc_id in self._chunks.get(parent_id, ())}
+
+    def memory_bytes(self):
+        lexical_bytes = self.lexical.memory_bytes() if self.lexical is not None else 0
+        return self.index.memory_bytes() + lexical_bytes
+
+
+class PartitionManager:
+    """Lazily loaded per-user partitions, evicted least recently used first under a memory budget"""
+
+    def __init__(self, loader, memory_budget_mb=None, on_evict=None):
+        self._loader = loader
+        self._on_evict = on_evict
+        budget_mb = float(memory_budget_mb or os.getenv("PARTITION_MEMORY_BUDGET_MB", 512))
+        self.memory_budget = int(budget_mb * 1024 * 1024)
+        self._partitions = OrderedDict()
+        self._load_locks = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+        self.hits = 0
+
+    def get(self, user_id):
+        """Return the user's partition, loading it on first use"""
+        user_id = user_id or DEFAULT_PARTITION
+        with self._lock:
+            partition = self._partitions.get(user_id)
+            if partition is not None:
+                self._partitions.move_to_end(user_id)
+                partition.last_used = time.time()
+                self.hits += 1
+                return partition
+            load_lock = self._load_locks.setdefault(user_id, threading.Lock())
+
+        # Load outside the manager lock so one user's cold load does not block others
+        with load_lock:
+            with self._lock:
+                partition = self._partitions.get(user_id)
+                if partition is not None:
+                    self._partitions.move_to_end(user_id)
+                    partition.last_used = time.time()
+                    self.hits += 1
+                    return partition
+
+            start_time = time.time()
+            partition = self._loader(user_id)
+            duration = (time.time() - start_time) * 1000
+
+            with self._lock:
+                self._partitions[user_id] = partition
+                self.loads += 1
+                self._load_locks.pop(user_id, None)
+                evicted = self._evict(keep=user_id)
+            self._notify_evicted(evicted)
+            logger.info(f"Loaded partition for user {user_id} with {len(partition.index)} documents "
+                        f"in {duration:.2f}ms")
+            return partition
+
+    def publish(self, partition):
+        """Serve a partition whose loader is still filling it; get() completes the load"""
+        with self._lock:
+            self._partitions[partition.user_id] = partition
+
+    def peek(self, user_id):
+        """Return the user's partition only if it is already loaded"""
+        with self._lock:
+            return self._partitions.get(user_id or DEFAULT_PARTITION)
+
+    def loaded(self):
+        """Currently loaded partitions"""
+        with self._lock:
+            return list(self._partitions.values())
+
+    def drop(self, user_id):
+        """Forget a loaded partition; it is reloaded on next use"""
+        with self._lock:
+            self._partitions.pop(user_id or DEFAULT_PARTITION, None)
+
+    def memory_bytes(self):
+        with self._lock:
+            return sum(p.memory_bytes() for p in self._partitions.values())
+
+    def rebalance(self, keep=None):
+        """Evict partitions after a partition grew past the budget"""
+        with self._lock:
+            evicted = self._evict(keep=keep or DEFAULT_PARTITION)
+        self._notify_evicted(evicted)
+
+    def _evict(self, keep):
+        """Drop least recently used partitions until under budget; returns the evicted ones"""
+        evicted = []
+        total = sum(p.memory_bytes() for p in self._partitions.values())
+        for user_id in list(self._partitions):
+            if total <= self.memory_budget:
+                break
+            if user_id == keep:
+                continue
+            partition = self._partitions.pop(user_id)
+            total -= partition.memory_bytes()
+            self.evictions += 1
+            evicted.append(partition)
+            logger.info(f"Evicted partition for user {user_id} ({partition.memory_bytes() / 1024:.1f} KiB)")
+        return evicted
+
+    def _notify_evicted(self, evicted):
+        """Run the eviction callback outside the manager lock"""
+        if self._on_evict is None:
+            return
+        for partition in evicted:
+            try:
+                self._on_evict(partition)
+            except Exception as e:
+                logger.warning(f"Eviction callback failed for user {partition.user_id}: {str(e)}")
+
+    def stats(self):
+        """Memory usage and load/eviction counters"""
+        with self._lock:
+            return {
+                "partitions": len(self._partitions),
+                "documents": sum(len(p.index) for p in self._partitions.values()),
+                "loading": sum(1 for p in self._partitions.values() if p.loading),
+                "memory_bytes": sum(p.memory_bytes() for p in self._partitions.values()),
+                "memory_budget_bytes": self.memory_budget,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "hits": self.hits
+            }
@@ -2,7 +2,7 @@ import sys
 import json
 import logging
 import time
-from initialize_service import service_instance
+from initialize_service import initialize_rag_service
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -14,6 +14,7 @@ def query_notes(user_id, query):
         logger.info("🚀 Starting query process...")
         
         # Ensure service is initialized
+        service_instance = initialize_rag_service()
         if not service_instance or not hasattr(service_instance, '_initialized'):
             logger.error("❌ Service not properly initialized!")
             print(json.dumps({"error": "Service not initialized"}))
@@ -27,7 +28,7 @@ def query_notes(user_id, query):
         # Execute query
         logger.info("📝 Executing query...")
         query_start = time.time()
-        result = service_instance.query(query)
+        result = service_instance.query(query, user_id)
         query_time = time.time() - query_start
         
         # Log timing breakdown
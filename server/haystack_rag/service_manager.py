@@ -1,84 +1,326 @@
 import logging
 import json
+import contextlib
+import os
+import re
 import sys
-from initialize_service import service_instance
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from initialize_service import initialize_rag_service
+from ingest_jobs import JobManager
+from metrics import registry as metrics
+import tracing
+from tracing import tracer
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def handle_command(command_data):
-    """Handle different commands with the same service instance"""
+# Queries and ingestion run on separate pools so a long sync never queues
+# ahead of an interactive query; submitting and polling jobs is quick, so
+# those run with the queries
+QUERY_COMMANDS = {"query", "query_stream", "health", "stats", "trace", "submit_job", "job_status"}
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", 4))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2))
+
+# Polling and introspection commands are not traced, so they do not crowd
+# the request traces out of the buffer
+UNTRACED_COMMANDS = {"health", "stats", "trace", "job_status"}
+
+_query_pool = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="query")
+_ingest_pool = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+_stdout_lock = threading.Lock()
+
+# Background inserts and syncs submitted with submit_job, polled with job_status
+_jobs = JobManager()
+SYNC_MODES = ("diff", "full")
+
+# Picks the request ID out of a line that is not valid JSON, so the error still reaches its caller
+_REQUEST_ID_PATTERN = re.compile(r'"id"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)')
+
+# Created once in __main__, before the ready signal is sent
+service_instance = None
+
+def send_reply(reply, request_id=None):
+    """Write one JSON line to stdout, tagged with the request ID if there is one"""
+    if request_id is not None:
+        reply = {"id": request_id, **reply}
+    line = json.dumps(reply)
+    with _stdout_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+def parse_request(command_data):
+    """Parse a request line into (request_id, command, args, trace_id, dump_trace)
+
+    Accepts {"id": ..., "command": ..., "args": [...]} and the older
+    untagged ["command", arg, ...] form. Tagged requests may carry the
+    caller's "trace_id", and "trace": true to get the trace in the reply.
+    """
+    request = json.loads(command_data)
+    trace_id, dump_trace = None, False
+    if isinstance(request, dict):
+        request_id = request.get("id")
+        command = request.get("command")
+        args = request.get("args") or []
+        trace_id = request.get("trace_id")
+        dump_trace = bool(request.get("trace"))
+    elif isinstance(request, list) and len(request) >= 2:
+        request_id, command, args = None, request[0], request[1:]
+    else:
+        raise ValueError("Invalid command format")
+    if not command:
+        raise ValueError("Invalid command format")
+    return request_id, command, args, trace_id, dump_trace
+
+def recover_request_id(command_data):
+    """Best-effort request ID of a line parse_request rejected, or None"""
     try:
-        # Parse command data from JSON string
-        command_list = json.loads(command_data)
-        if not command_list or len(command_list) < 2:
-            raise ValueError("Invalid command format")
-            
-        command = command_list[0]
-        args = command_list[1:]
-        
-        logger.info(f"Received command: {command} with {len(args)} args")
-        
-        if command == "query":
-            user_id, query = args
-            logger.info(f"Processing query for user {user_id}")
-            result = service_instance.query(query)
-            print(json.dumps(result), flush=True)
-            
-        elif command == "sync":
-            user_id, notes_json = args
-            notes = json.loads(notes_json)
-            logger.info(f"Syncing {len(notes)} notes for user {user_id}")
-            service_instance.clear_documents()
-            result = service_instance.add_documents(notes)
-            if result.get('success'):
-                print(json.dumps({"success": True, "message": "Notes synced and ready for querying"}), flush=True)
-            else:
-                raise ValueError("Failed to sync notes")
-            
-        elif command == "insert":
-            user_id, notes_json = args
-            notes = json.loads(notes_json)
-            logger.info(f"Inserting {len(notes)} notes for user {user_id}")
-            result = service_instance.add_documents(notes)
-            if result.get('success'):
-                print(json.dumps({"success": True, "message": "Notes added and ready for querying"}), flush=True)
-            else:
-                raise ValueError("Failed to add notes")
-            
-        elif command == "delete":
-            user_id, doc_id = args
-            logger.info(f"Deleting document {doc_id} for user {user_id}")
-            result = service_instance.delete_document(doc_id)
-            if result:
-                print(json.dumps({"success": True, "message": "Document deleted successfully"}), flush=True)
-            else:
-                raise ValueError("Failed to delete document")
-            
+        request = json.loads(command_data)
+        if isinstance(request, dict):
+            return request.get("id")
+    except ValueError:
+        pass
+    match = _REQUEST_ID_PATTERN.search(command_data)
+    if match is None:
+        return None
+    try:
+        return json.loads(match.group(1))
+    except ValueError:
+        return None
+
+def run_sync(user_id, notes, mode="diff", job=None):
+    """Sync a user's notes, replacing everything (full) or applying only the changes (diff)"""
+    if mode == "full":
+        cleared = service_instance.clear_documents(user_id)
+        if not cleared["success"]:
+            raise ValueError(f"Failed to clear {len(cleared['failed'])} of "
+                             f"{cleared['deleted'] + len(cleared['failed'])} documents")
+        result = service_instance.add_documents(notes, user_id, job)
+        details = {"added": result.get('document_count', 0), "updated": 0, "deleted": 0, "skipped": 0}
+    elif mode == "diff":
+        result = service_instance.sync_documents(notes, user_id, job)
+        details = {key: result[key] for key in ("added", "updated", "deleted", "skipped")}
+    else:
+        raise ValueError(f"Unknown sync mode: {mode}")
+    if result.get('success'):
+        return {
+            "success": True,
+            "message": "Notes synced and ready for querying",
+            "details": details
+        }
+    raise ValueError("Failed to sync notes")
+
+def traced_job(kind, fn):
+    """Wrap a job function to run under the submitting request's trace ID"""
+    trace_id = tracing.current_trace_id()
+    def run(job):
+        with tracer.trace(trace_id, f"{kind}_job"):
+            tracing.annotate(job_id=job.id, notes=job.notes)
+            result = fn(job)
+            tracing.annotate(chunks=job.chunks, failed=len(job.failures))
+            return result
+    return run
+
+def run_insert(user_id, notes, job=None):
+    """Embed and store new or changed notes"""
+    result = service_instance.add_documents(notes, user_id, job)
+    if result.get('success'):
+        return {"success": True, "message": "Notes added and ready for querying"}
+    raise ValueError("Failed to add notes")
+
+def sample_gauges():
+    """Copy current sizes and backlogs from the service into the metrics registry"""
+    partitions = service_instance.partitions.stats()
+    metrics.set_gauge("partitions_loaded", partitions["partitions"])
+    metrics.set_gauge("partition_documents", partitions["documents"])
+    metrics.set_gauge("partition_memory_bytes", partitions["memory_bytes"])
+    metrics.set_gauge("embedding_repair_backlog", service_instance.repairs.backlog())
+    if service_instance.answer_cache is not None:
+        metrics.set_gauge("answer_cache_entries", len(service_instance.answer_cache))
+    for status, count in _jobs.stats().items():
+        metrics.set_gauge("ingest_jobs", count, status=status)
+
+def execute_command(command, args):
+    """Run one command against the shared service instance and return its reply"""
+    logger.info(f"Received command: {command} with {len(args)} args")
+
+    if command == "query":
+        user_id, query, *rest = args
+        mode = rest[0] if rest else None
+        logger.info(f"Processing query for user {user_id} ({mode or 'default'} retrieval)")
+        return service_instance.query(query, user_id, mode)
+
+    elif command == "query_stream":
+        user_id, query, *rest = args
+        mode = rest[0] if rest else None
+        logger.info(f"Processing streaming query for user {user_id} ({mode or 'default'} retrieval)")
+        return service_instance.query_stream(query, user_id, mode)
+
+    elif command == "sync":
+        user_id, notes_json, *rest = args
+        mode = rest[0] if rest else "diff"
+        notes = json.loads(notes_json)
+        logger.info(f"Syncing {len(notes)} notes for user {user_id} ({mode} mode)")
+        return run_sync(user_id, notes, mode)
+
+    elif command == "insert":
+        user_id, notes_json = args
+        notes = json.loads(notes_json)
+        logger.info(f"Inserting {len(notes)} notes for user {user_id}")
+        return run_insert(user_id, notes)
+
+    elif command == "submit_job":
+        kind, user_id, notes_json, *rest = args
+        notes = json.loads(notes_json)
+        if kind == "sync":
+            mode = rest[0] if rest else "diff"
+            if mode not in SYNC_MODES:
+                raise ValueError(f"Unknown sync mode: {mode}")
+            job = _jobs.submit(kind, user_id, len(notes),
+                               traced_job(kind, lambda job: run_sync(user_id, notes, mode, job)))
+        elif kind == "insert":
+            job = _jobs.submit(kind, user_id, len(notes),
+                               traced_job(kind, lambda job: run_insert(user_id, notes, job)))
         else:
-            raise ValueError(f"Unknown command: {command}")
-            
+            raise ValueError(f"Unknown job kind: {kind}")
+        return {"success": True, "job_id": job.id, "status": job.status}
+
+    elif command == "job_status":
+        job_id, = args
+        job = _jobs.get(job_id)
+        if job is None:
+            raise ValueError(f"Unknown job: {job_id}")
+        return job.to_dict()
+
+    elif command == "delete":
+        user_id, doc_id = args
+        logger.info(f"Deleting document {doc_id} for user {user_id}")
+        result = service_instance.delete_document(doc_id, user_id)
+        if result:
+            return {"success": True, "message": "Document deleted successfully"}
+        raise ValueError("Failed to delete document")
+
+    elif command == "health":
+        return {
+            "status": "ready",
+            "uptime_seconds": round(time.time() - service_instance.started_at, 1),
+            "startup": service_instance.startup_profile,
+            "partitions": service_instance.partitions.stats(),
+            "answer_cache": service_instance.answer_cache.stats() if service_instance.answer_cache else None,
+            "firestore_writes": service_instance.firebase_sync.writer.stats(),
+            "embedding_repairs": service_instance.repairs.stats(),
+            "ingest_jobs": _jobs.stats(),
+            "tracing": tracer.stats()
+        }
+
+    elif command == "trace":
+        # Spans of a recent request, one segment per traced command or job
+        trace_id, = args
+        segments = tracer.get(trace_id)
+        if segments is None:
+            raise ValueError(f"Unknown or expired trace: {trace_id}")
+        return {"trace_id": trace_id, "segments": segments}
+
+    elif command == "stats":
+        # Aggregated stage latencies and counters, as JSON or Prometheus text
+        output_format = args[0] if args else "json"
+        sample_gauges()
+        if output_format == "prometheus":
+            return {"format": "prometheus", "text": metrics.prometheus()}
+        if output_format != "json":
+            raise ValueError(f"Unknown stats format: {output_format}")
+        return {
+            **metrics.snapshot(),
+            "embedding": {
+                "cache": service_instance.doc_embedder.embedder.cache_stats(),
+                "throughput": service_instance.doc_embedder.embedder.throughput_stats()
+            },
+            "answer_cache": service_instance.answer_cache.stats() if service_instance.answer_cache else None
+        }
+
+    raise ValueError(f"Unknown command: {command}")
+
+def run_command(request_id, command, args, trace_id=None, dump_trace=False):
+    """Execute a command and send its reply, converting failures to error replies
+
+    Streaming commands return a generator; each frame it yields is sent as
+    its own line with the same request ID. Commands run under a trace with
+    the caller's trace ID; with dump_trace the final reply carries it.
+    """
+    if command in UNTRACED_COMMANDS:
+        trace_context = contextlib.nullcontext()
+    else:
+        # A trace returned in the reply is not logged as well
+        trace_context = tracer.trace(trace_id, command, sampled=False if dump_trace else None)
+    final = None
+    with contextlib.ExitStack() as stack:
+        trace = stack.enter_context(trace_context)
+        try:
+            result = execute_command(command, args)
+            if isinstance(result, types.GeneratorType):
+                for frame in result:
+                    if frame.get("event") == "chunk":
+                        send_reply(frame, request_id)
+                    else:
+                        final = frame
+            else:
+                final = result
+        except Exception as e:
+            error_msg = str(e)
+            logger.error(f"Error processing command {command}: {error_msg}")
+            metrics.increment("errors_total", operation=command)
+            if trace is not None:
+                trace.attrs["error"] = error_msg
+            final = {"error": error_msg}
+    # Sent after the trace has finished, so a dumped trace is complete
+    if dump_trace and trace is not None:
+        final = {**final, "trace": trace.to_dict()}
+    send_reply(final, request_id)
+
+def handle_command(command_data):
+    """Parse a request line and schedule it on the pool for its kind of work"""
+    try:
+        request_id, command, args, trace_id, dump_trace = parse_request(command_data)
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"Error processing command: {error_msg}")
-        print(json.dumps({"error": error_msg}), flush=True)
-        sys.stdout.flush()
+        logger.error(f"Error parsing command: {error_msg}")
+        send_reply({"error": error_msg}, recover_request_id(command_data))
+        return None
+
+    pool = _query_pool if command in QUERY_COMMANDS else _ingest_pool
+    return pool.submit(run_command, request_id, command, args, trace_id, dump_trace)
 
 if __name__ == "__main__":
     try:
-        # Signal that service is ready
-        print(json.dumps({"status": "ready", "message": "Service manager started"}), flush=True)
-        sys.stdout.flush()
-        logger.info("Service manager started, waiting for commands...")
-        
-        # Read commands from stdin
+        # Warm up in this process, then signal that the service is ready
+        service_instance = initialize_rag_service()
+        tracing.install_log_context()
+        send_reply({
+            "status": "ready",
+            "message": "Service manager started",
+            "startup": service_instance.startup_profile
+        })
+        logger.info(f"Service manager started with {QUERY_WORKERS} query and "
+                    f"{INGEST_WORKERS} ingest workers, waiting for commands...")
+
+        # Read commands from stdin; replies are written as they complete
         for line in sys.stdin:
             line = line.strip()
             if line:
                 handle_command(line)
-                sys.stdout.flush()
+
+        # Finish in-flight work before exiting
+        _query_pool.shutdown(wait=True)
+        _ingest_pool.shutdown(wait=True)
+        _jobs.shutdown(wait=True)
+
+        # Persist changed partitions so the next start loads from snapshots
+        service_instance.save_snapshots()
+        service_instance.doc_embedder.embedder.close()
     except Exception as e:
         logger.error(f"Fatal error in service manager: {str(e)}")
-        print(json.dumps({"error": str(e)}), flush=True)
-        sys.exit(1) 
\ No newline at end of file
+        print(json.dumps({"status": "error", "error": str(e)}), flush=True)
+        sys.exit(1)
@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import shutil
+import time
+from datetime import datetime
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots")
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotStore:
+    """Local per-partition index snapshots: a memory-mappable .npy matrix, document metadata and a watermark
+
+    Each partition directory holds a manifest.json pointing at the current
+    embeddings/metadata files. New files are written first and the manifest
+    is swapped in with os.replace, so a crash mid-write leaves the previous
+    snapshot intact.
+    """
+
+    def __init__(self, base_dir=None):
+        self.base_dir = base_dir or os.getenv("SNAPSHOT_DIR", DEFAULT_SNAPSHOT_DIR)
+        os.makedirs(self.base_dir, exist_ok=True)
+
+    def _partition_dir(self, user_id):
+        safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in user_id)
+        return os.path.join(self.base_dir, safe_name)
+
+    def load(self, user_id, model=None):
+        """Return (metadata records, memory-mapped matrix, watermark), or None if there is no usable snapshot
+
+        Snapshots of embeddings made by a model other than model are not usable.
+        """
+        directory = self._partition_dir(user_id)
+        manifest_path = os.path.join(directory, "manifest.json")
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get("version") != SNAPSHOT_VERSION:
+                logger.info(f"Ignoring snapshot for user {user_id} with version {manifest.get('version')}")
+                return None
+            if model is not None and manifest.get("model") not in (None, model):
+                logger.info(f"Ignoring snapshot for user {user_id} embedded with {manifest['model']}")
+                return None
+            with open(os.path.join(directory, manifest["metadata"])) as f:
+                records = json.load(f)
+            # Copy-on-write mapping: pages are read lazily and writes stay private
+            matrix = np.load(os.path.join(directory, manifest["embeddings"]), mmap_mode="c")
+            if matrix.shape[0] != len(records):
+                raise ValueError(f"Snapshot has {matrix.shape[0]} vectors but {len(records)} records")
+            watermark = datetime.fromisoformat(manifest["watermark"]) if manifest.get("watermark") else None
+            return records, matrix, watermark
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable snapshot for user {user_id}: {str(e)}")
+            return None
+
+    def save(self, user_id, records, matrix, watermark, model=None):
+        """Write a snapshot of a partition"""
+        start_time = time.time()
+        directory = self._partition_dir(user_id)
+        os.makedirs(directory, exist_ok=True)
+        stamp = f"{int(time.time() * 1000)}"
+        embeddings_name = f"embeddings-{stamp}.npy"
+        metadata_name = f"metadata-{stamp}.json"
+
+        np.save(os.path.join(directory, embeddings_name), np.ascontiguousarray(matrix, dtype=np.float32))
+        with open(os.path.join(directory, metadata_name), "w") as f:
+            json.dump(records, f, separators=(",", ":"))
+
+        manifest = {
+            "version": SNAPSHOT_VERSION,
+            "embeddings": embeddings_name,
+            "metadata": metadata_name,
+            "count": len(records),
+            "watermark": watermark.isoformat() if watermark else None,
+            "model": model,
+        }
+        manifest_tmp = os.path.join(directory, "manifest.json.tmp")
+        with open(manifest_tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(manifest_tmp, os.path.join(directory, "manifest.json"))
+
+        # Remove files from older snapshots
+        for name in os.listdir(directory):
+            if name.startswith(("embeddings-", "metadata-")) and name not in (embeddings_name, metadata_name):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+        logger.info(f"Wrote snapshot for user {user_id} with {len(records)} documents "
+                    f"in {(time.time() - start_time) * 1000:.2f}ms")
+
+    def delete(self, user_id):
+        shutil.rmtree(self._partition_dir(user_id), ignore_errors=True)
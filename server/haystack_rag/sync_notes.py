@@ -8,15 +8,16 @@ def sync_notes(user_id, notes_json):
         # Initialize Haystack service
         service = HaystackService()
         
-        # Clear existing documents
-        service.clear_documents()
-        
         # Parse notes from JSON
         notes = json.loads(notes_json)
         
-        # Add all documents to Haystack
-        service.add_documents(notes)
-        print(json.dumps({"success": True, "message": "Notes synced successfully"}))
+        # Upsert changed notes and drop removed ones
+        result = service.sync_documents(notes, user_id)
+        print(json.dumps({
+            "success": True,
+            "message": "Notes synced successfully",
+            "details": {key: result[key] for key in ("added", "updated", "deleted", "skipped")}
+        }))
         
     except Exception as e:
         print(json.dumps({"success": False, "error": str(e)}))
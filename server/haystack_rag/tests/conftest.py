@@ -0,0 +1,61 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The service modules import each other by name from their own directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Configure the service before anything imports it: throwaway embedding
+# cache and snapshot directory, no snapshots or answer cache unless a test
+# turns them on, and a Gemini key so the client can be built offline
+_workdir = tempfile.mkdtemp(prefix="haystack-tests-")
+os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(_workdir, "embeddings.sqlite3")
+os.environ["SNAPSHOT_DIR"] = os.path.join(_workdir, "snapshots")
+os.environ["SNAPSHOTS_ENABLED"] = "0"
+os.environ["ANSWER_CACHE_ENABLED"] = "0"
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+
+_ollama = None
+
+
+def pytest_configure(config):
+    # ollama reads OLLAMA_HOST when it is first imported, so the fake server starts before any test module loads
+    global _ollama
+    from fake_ollama import FakeOllamaServer
+    _ollama = FakeOllamaServer(dimension=64)
+    os.environ["OLLAMA_HOST"] = _ollama.start()
+
+
+def pytest_unconfigure(config):
+    if _ollama is not None:
+        _ollama.stop()
+
+
+@pytest.fixture
+def firestore_db():
+    from fake_firestore import InMemoryFirestore
+    return InMemoryFirestore()
+
+
+@pytest.fixture
+def make_service(firestore_db, monkeypatch):
+    """Build a fresh HaystackService over the fake Ollama server and an in-memory Firestore
+
+    Environment set with monkeypatch before calling it applies to the new service.
+    """
+    import haystack_service
+
+    def make():
+        monkeypatch.setattr(haystack_service.FirebaseSync, "_instance", None)
+        monkeypatch.setattr(haystack_service.HaystackService, "_instance", None)
+        haystack_service.FirebaseSync(db=firestore_db)
+        return haystack_service.HaystackService()
+
+    return make
+
+
+@pytest.fixture
+def service(make_service):
+    return make_service()
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from haystack import Document
+
+from answer_cache import AnswerCache
+
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@pytest.fixture
+def cache():
+    cache = AnswerCache(max_entries=10, ttl_seconds=3600, threshold=0.95)
+    cache.put("alice", unit(1, 0, 0), {"answer": "budget"}, ["budget#0", "budget#1"], min_score=0.8)
+    cache.put("alice", unit(0, 1, 0), {"answer": "garden"}, ["garden"], min_score=None)
+    return cache
+
+
+def test_near_identical_questions_hit(cache):
+    assert cache.get("alice", unit(1, 0.05, 0)) == {"answer": "budget"}
+    assert cache.get("alice", unit(1, 1, 0)) is None
+    assert cache.get("bob", unit(1, 0, 0)) is None
+
+
+def test_removing_a_used_document_invalidates_only_its_entries(cache):
+    cache.documents_removed("alice", ["budget#1"])
+
+    assert cache.get("alice", unit(1, 0, 0)) is None
+    assert cache.get("alice", unit(0, 1, 0)) == {"answer": "garden"}
+
+
+def test_updating_a_used_document_invalidates(cache):
+    cache.documents_changed("alice", [Document(id="budget#0", content="", embedding=[0.0, 0.0, 1.0])])
+
+    assert cache.get("alice", unit(1, 0, 0)) is None
+
+
+def test_added_document_invalidates_only_if_it_would_be_retrieved(cache):
+    # Far from the budget question, but the garden entry retrieved fewer results than asked for
+    cache.documents_changed("alice", [Document(id="new", content="", embedding=[0.0, 0.0, 1.0])])
+    assert cache.get("alice", unit(1, 0, 0)) == {"answer": "budget"}
+    assert cache.get("alice", unit(0, 1, 0)) is None
+
+    cache.documents_changed("alice", [Document(id="close", content="", embedding=[1.0, 0.1, 0.0])])
+    assert cache.get("alice", unit(1, 0, 0)) is None
+
+
+def test_mutations_of_another_user_leave_entries_alone(cache):
+    cache.documents_removed("bob", ["budget#0"])
+    cache.invalidate_user("bob")
+
+    assert len(cache) == 2
+
+
+def test_entries_expire_and_evict():
+    cache = AnswerCache(max_entries=2, ttl_seconds=3600, threshold=0.95)
+    for i in range(3):
+        cache.put("alice", unit(*np.eye(3)[i]), {"answer": i}, [str(i)])
+    assert len(cache) == 2
+    assert cache.get("alice", unit(1, 0, 0)) is None
+
+    cache.ttl_seconds = -1
+    assert cache.get("alice", unit(0, 1, 0)) is None
+    assert len(cache) == 0
@@ -0,0 +1,60 @@
+from haystack import Document
+
+from chunking import chunk_id, group_hits, parent_id_of, split_text
+from text_units import estimate_tokens
+
+
+def paragraphs(count, words=30):
+    return "\n\n".join(" ".join(f"p{i}w{j}" for j in range(words)) + "." for i in range(count))
+
+
+def test_short_text_is_one_chunk():
+    assert split_text("  A short note.  ", max_tokens=64) == ["A short note."]
+
+
+def test_chunks_respect_the_token_limit():
+    chunks = split_text(paragraphs(20), max_tokens=128, overlap_tokens=16)
+
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= 128 for chunk in chunks)
+
+
+def test_chunks_break_at_paragraphs_and_overlap():
+    text = paragraphs(10)
+    chunks = split_text(text, max_tokens=128, overlap_tokens=64)
+
+    for previous, current in zip(chunks, chunks[1:]):
+        # The next chunk starts with the closing paragraph of the previous one
+        assert current.split("\n\n")[0] == previous.split("\n\n")[-1]
+    first_paragraphs = set(text.split("\n\n"))
+    assert all(part in first_paragraphs for chunk in chunks for part in chunk.split("\n\n"))
+
+
+def test_oversized_paragraph_is_split_into_sentences_and_words():
+    sentence = " ".join(["word"] * 100) + "."
+    chunks = split_text(" ".join([sentence] * 3), max_tokens=64, overlap_tokens=0)
+
+    assert all(estimate_tokens(chunk) <= 64 for chunk in chunks)
+    assert sum(chunk.count("word") for chunk in chunks) == 300
+
+
+def test_chunk_ids_point_back_at_their_note():
+    assert chunk_id("note", 0, 1) == "note"
+    assert chunk_id("note", 2, 3) == "note#2"
+
+    assert parent_id_of(Document(id="note#2", content="", meta={"parent_id": "note"})) == "note"
+    assert parent_id_of(Document(id="legacy", content="", meta={})) == "legacy"
+
+
+def test_group_hits_keeps_top_notes_and_orders_chunks():
+    def chunk(parent, index):
+        return Document(id=f"{parent}#{index}", content=f"{parent} part {index}",
+                        meta={"parent_id": parent, "chunk_index": index})
+
+    hits = [(chunk("a", 1), 0.9), (chunk("b", 0), 0.8), (chunk("a", 0), 0.7), (chunk("c", 0), 0.6)]
+
+    notes = group_hits(hits, top_k=2)
+
+    assert [note.parent_id for note in notes] == ["a", "b"]
+    assert notes[0].score == 0.9
+    assert notes[0].text() == "a part 0\n\na part 1"
@@ -0,0 +1,56 @@
+from context_packer import ContextPacker, truncate
+from text_units import estimate_tokens
+
+
+def test_everything_fits_when_under_budget():
+    packed, stats = ContextPacker(token_budget=500).pack("question", ["first note", "second note"])
+
+    assert packed == ["first note", "second note"]
+    assert stats["packed"] == 2 and stats["truncated"] == 0
+
+
+def test_packed_context_stays_within_budget():
+    texts = [" ".join(f"filler{i}x{j}" for j in range(300)) for i in range(5)]
+
+    packed, stats = ContextPacker(token_budget=400, max_doc_tokens=200).pack("question", texts)
+
+    assert stats["context_tokens"] <= 400
+    assert sum(estimate_tokens(text) for text in packed if text) == stats["context_tokens"]
+    assert stats["truncated"] > 0
+
+
+def test_near_duplicates_are_dropped():
+    text = "Meeting notes about the quarterly budget review and hiring plan for next year"
+
+    packed, stats = ContextPacker(token_budget=500).pack("budget", [text, text + ".", "Unrelated gardening note"])
+
+    assert packed[1] is None
+    assert packed[2] is not None
+    assert stats["deduplicated"] == 1
+
+
+def test_long_documents_keep_the_passage_matching_the_question():
+    filler = "\n\n".join(" ".join(f"filler{i}w{j}" for j in range(40)) for i in range(10))
+    text = filler + "\n\nThe launch date for the rocket project is in March."
+
+    packed, _ = ContextPacker(token_budget=2000, max_doc_tokens=60).pack("When is the rocket launch?", [text])
+
+    assert "rocket" in packed[0]
+    assert estimate_tokens(packed[0]) <= 60
+
+
+def test_empty_texts_are_skipped():
+    packed, stats = ContextPacker().pack("question", ["", None, "note"])
+
+    assert packed == [None, None, "note"]
+    assert stats["packed"] == 1
+
+
+def test_truncate_cuts_at_a_word_boundary():
+    text = " ".join(["alphabet"] * 50)
+
+    cut = truncate(text, 10)
+
+    assert estimate_tokens(cut) <= 10
+    assert cut.endswith("…")
+    assert all(word == "alphabet" for word in cut.rstrip("…").split())
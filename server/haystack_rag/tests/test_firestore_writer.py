@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+from google.api_core.exceptions import ServiceUnavailable
+
+from fake_firestore import InMemoryFirestore, WriteBatch
+from firestore_writer import FirestoreWriter, WriteError
+
+
+class FlakyFirestore(InMemoryFirestore):
+    """Fails the first `failures` commits with a transient error"""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self._failure_lock = threading.Lock()
+
+    def batch(self):
+        db = self
+
+        class FlakyBatch(WriteBatch):
+            def commit(self):
+                with db._failure_lock:
+                    if db.failures > 0:
+                        db.failures -= 1
+                        raise ServiceUnavailable("try again")
+                return super().commit()
+
+        return FlakyBatch(self)
+
+
+def sets(db, count):
+    collection = db.collection("docs")
+    return [("set", collection.document(f"d{i}"), {"n": i}) for i in range(count)]
+
+
+def test_writes_are_grouped_into_full_batches():
+    db = InMemoryFirestore()
+    writer = FirestoreWriter(db, batch_size=500, max_concurrency=4)
+
+    stats = writer.write(sets(db, 1200))
+
+    assert stats["batches"] == 3 and stats["documents"] == 1200
+    assert db.commits == 3
+    assert len(db.collection("docs")) == 1200
+
+
+def test_large_documents_split_batches_by_size():
+    db = InMemoryFirestore()
+    writer = FirestoreWriter(db, batch_size=500)
+    collection = db.collection("docs")
+    blob = b"x" * (2 * 1024 * 1024)
+
+    stats = writer.write([("set", collection.document(f"d{i}"), {"blob": blob}) for i in range(10)])
+
+    assert stats["batches"] >= 3
+
+
+def test_transient_failures_are_retried_with_backoff():
+    db = FlakyFirestore(failures=2)
+    delays = []
+    writer = FirestoreWriter(db, max_concurrency=1, max_retries=3, base_delay=0.5, max_delay=8.0, sleep=delays.append)
+
+    stats = writer.write(sets(db, 10))
+
+    assert stats["retries"] == 2 and stats["failed"] == 0
+    assert len(delays) == 2
+    assert 0 <= delays[0] <= 0.5 and 0 <= delays[1] <= 1.0
+    assert len(db.collection("docs")) == 10
+
+
+def test_batches_failing_after_retries_are_reported():
+    db = FlakyFirestore(failures=10)
+    writer = FirestoreWriter(db, batch_size=5, max_concurrency=1, max_retries=1, sleep=lambda delay: None)
+
+    with pytest.raises(WriteError) as raised:
+        writer.write(sets(db, 10))
+
+    assert raised.value.stats["failed"] == 10
+    assert {ref.id for ref in raised.value.failed_refs} == {f"d{i}" for i in range(10)}
+    assert writer.stats()["failed_batches"] == 2
+
+
+def test_permanent_errors_are_not_retried():
+    db = InMemoryFirestore()
+    delays = []
+    writer = FirestoreWriter(db, sleep=delays.append)
+
+    with pytest.raises(WriteError):
+        writer.write([("update", db.collection("docs").document("missing"), {"n": 1})])
+
+    assert delays == []
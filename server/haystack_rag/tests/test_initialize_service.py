@@ -0,0 +1,11 @@
+from initialize_service import IMPORTS_MS, initialize_rag_service
+
+
+def test_startup_profile_starts_with_the_imports(service):
+    constructor_ms = service.startup_profile["total"]
+
+    profile = initialize_rag_service().startup_profile
+
+    assert next(iter(profile)) == "imports"
+    assert profile["imports"] == IMPORTS_MS
+    assert profile["total"] == round(constructor_ms + IMPORTS_MS, 2)
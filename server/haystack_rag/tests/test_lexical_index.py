@@ -0,0 +1,69 @@
+import pytest
+from haystack import Document
+
+from lexical_index import BM25Index, reciprocal_rank_fusion, tokenize
+
+
+def doc(doc_id, content=""):
+    return Document(id=doc_id, content=content)
+
+
+@pytest.fixture
+def index():
+    index = BM25Index()
+    index.upsert([
+        doc("garden", "Planted tomatoes and basil in the garden"),
+        doc("recipe", "Tomato soup recipe with basil and garlic"),
+        doc("meeting", "Quarterly planning meeting notes"),
+    ])
+    return index
+
+
+def test_tokenize_lowercases_and_drops_stopwords():
+    assert tokenize("The Garden of my Dreams") == ["garden", "dreams"]
+
+
+def test_rare_terms_rank_their_document_first(index):
+    hits = index.search("garlic basil")
+
+    assert [d.id for d, _ in hits] == ["recipe", "garden"]
+    assert hits[0][1] > hits[1][1] > 0
+
+
+def test_queries_without_matching_terms_find_nothing(index):
+    assert index.search("the of and") == []
+    assert index.search("astronomy") == []
+
+
+def test_upsert_replaces_a_documents_terms(index):
+    index.upsert([doc("meeting", "Garlic harvest planning")])
+
+    assert {d.id for d, _ in index.search("quarterly")} == set()
+    assert "meeting" in {d.id for d, _ in index.search("garlic")}
+    assert len(index) == 3
+
+
+def test_delete_removes_postings(index):
+    assert index.delete(["recipe", "missing"]) == 1
+
+    assert [d.id for d, _ in index.search("basil")] == ["garden"]
+    assert "recipe" not in index
+
+
+def test_rrf_scores_a_document_ranked_first_everywhere_as_one():
+    a, b, c = doc("a"), doc("b"), doc("c")
+
+    fused = reciprocal_rank_fusion([[(a, 0.9), (b, 0.5)], [(a, 7.0), (c, 3.0)]], top_k=3)
+
+    assert fused[0][0].id == "a"
+    assert fused[0][1] == pytest.approx(1.0)
+    assert {d.id for d, _ in fused[1:]} == {"b", "c"}
+
+
+def test_rrf_favours_documents_found_by_both_lists():
+    a, b, c = doc("a"), doc("b"), doc("c")
+
+    fused = reciprocal_rank_fusion([[(a, 1.0), (b, 0.9)], [(c, 1.0), (b, 0.9)]], top_k=3)
+
+    assert fused[0][0].id == "b"
+    assert len(fused) == 3
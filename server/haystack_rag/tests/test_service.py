@@ -0,0 +1,152 @@
+import dataclasses
+
+import pytest
+
+import haystack_service
+from firestore_writer import WriteError
+
+
+def note(note_id, content, title=None):
+    return {"id": note_id, "title": title or note_id, "content": content}
+
+
+NOTES = [
+    note("budget", "Quarterly budget review with the finance team"),
+    note("garden", "Planted tomatoes and basil in the garden"),
+    note("rocket", "The rocket launch is planned for March"),
+]
+
+
+def stored_ids(firestore_db):
+    return set(firestore_db.collection("haystack_documents")._documents)
+
+
+def test_sync_counts_only_what_changed(service, firestore_db):
+    first = service.sync_documents([dict(n) for n in NOTES], "alice")
+    assert (first["added"], first["updated"], first["deleted"], first["skipped"]) == (3, 0, 0, 0)
+
+    again = service.sync_documents([dict(n) for n in NOTES], "alice")
+    assert (again["added"], again["updated"], again["deleted"], again["skipped"]) == (0, 0, 0, 3)
+
+    changed = [note("budget", "Budget review moved to Friday"), dict(NOTES[1]), note("travel", "Book flights")]
+    diff = service.sync_documents(changed, "alice")
+    assert (diff["added"], diff["updated"], diff["deleted"], diff["skipped"]) == (1, 1, 1, 1)
+    assert stored_ids(firestore_db) == {"budget", "garden", "travel"}
+    assert len(service.partitions.get("alice").index) == 3
+
+
+def without_embeddings(docs):
+    return {"documents": [dataclasses.replace(doc, embedding=None) for doc in docs]}
+
+
+def test_sync_deletes_notes_stored_without_an_embedding(service, firestore_db, monkeypatch):
+    with monkeypatch.context() as patch:
+        patch.setattr(service.doc_embedder, "run", without_embeddings)
+        service.sync_documents([note("draft", "Embedding this note fails")], "alice")
+    assert "draft" in stored_ids(firestore_db)
+    assert len(service.partitions.get("alice").index) == 0
+
+    result = service.sync_documents([dict(NOTES[0])], "alice")
+
+    assert (result["added"], result["deleted"]) == (1, 1)
+    assert stored_ids(firestore_db) == {"budget"}
+
+
+def test_rewrite_deletes_stale_chunks_stored_without_an_embedding(service, firestore_db, monkeypatch):
+    long_note = note("journal", " ".join(f"Entry {i} about the weather and the garden." for i in range(200)))
+    with monkeypatch.context() as patch:
+        patch.setattr(service.doc_embedder, "run", without_embeddings)
+        service.add_documents([long_note], "alice")
+    assert len(stored_ids(firestore_db)) > 1
+
+    service.add_documents([note("journal", "Short entry")], "alice")
+
+    assert stored_ids(firestore_db) == {"journal"}
+    assert service.partitions.get("alice").chunk_ids(["journal"]) == {"journal"}
+
+
+def test_retrieval_finds_the_matching_note(service):
+    service.add_documents([dict(n) for n in NOTES], "alice")
+
+    for mode in ("vector", "hybrid", "lexical"):
+        hits, _, _ = service._retrieve("rocket launch", "alice", {}, {}, mode)
+        assert hits[0].parent_id == "rocket", mode
+
+
+def test_delete_leaves_other_users_documents_alone(service, firestore_db):
+    service.add_documents([dict(NOTES[0])], "alice")
+    service.add_documents([dict(NOTES[1])], "bob")
+
+    assert service.delete_document("budget", "bob")
+    assert stored_ids(firestore_db) == {"budget", "garden"}
+    assert len(service.partitions.get("alice").index) == 1
+
+    assert service.delete_document("budget", "alice")
+    assert stored_ids(firestore_db) == {"garden"}
+    assert len(service.partitions.get("alice").index) == 0
+
+
+def test_clear_reports_documents_whose_tombstone_failed(service, firestore_db, monkeypatch):
+    service.add_documents([dict(n) for n in NOTES], "alice")
+    writer = service.firebase_sync.writer
+    write = writer.write
+
+    def fail_tombstones(operations):
+        operations = list(operations)
+        tombstones = [ref for op, ref, _ in operations if op == "set" and ref.id == "garden"]
+        if tombstones:
+            raise WriteError("Tombstone batch failed", {}, tombstones)
+        return write(operations)
+
+    monkeypatch.setattr(writer, "write", fail_tombstones)
+    result = service.clear_documents("alice")
+
+    assert result == {"success": False, "deleted": 2, "failed": ["garden"]}
+    assert stored_ids(firestore_db) == {"garden"}
+    assert service.partitions.get("alice").chunk_ids(["garden"]) == {"garden"}
+
+
+def test_snapshot_load_drops_documents_deleted_since(make_service, monkeypatch, tmp_path):
+    monkeypatch.setenv("SNAPSHOTS_ENABLED", "1")
+    monkeypatch.setenv("SNAPSHOT_DIR", str(tmp_path))
+    service = make_service()
+    service.add_documents([dict(n) for n in NOTES], "alice")
+    service.partitions.drop("alice")
+
+    service.partitions.get("alice")  # Loads from Firestore and writes the snapshot
+
+    service.delete_document("garden", "alice")
+    service.partitions.drop("alice")
+    reads = []
+    sync = service.firebase_sync
+    for name in ("deleted_since", "list_document_ids"):
+        method = getattr(sync, name)
+        monkeypatch.setattr(sync, name, lambda *args, _name=name, _method=method, **kwargs:
+                            reads.append(_name) or _method(*args, **kwargs))
+    partition = service.partitions.get("alice")
+
+    assert {doc.id for doc in partition.index.documents()} == {"budget", "rocket"}
+    # The delete is found from its tombstone, not by listing every document
+    assert "deleted_since" in reads and "list_document_ids" not in reads
+
+
+def test_backfill_makes_legacy_documents_visible(service, firestore_db):
+    collection = firestore_db.collection("haystack_documents")
+    collection.document("legacy").set({"content": "old note", "meta": {"user_id": "alice"}})
+    sync = service.firebase_sync
+    assert sync.list_document_ids("alice") == set()
+
+    assert sync.backfill_partition_fields() == {"updated": 1, "skipped": 0}
+    assert sync.list_document_ids("alice") == {"legacy"}
+    assert sync.backfill_partition_fields() == {"updated": 0, "skipped": 1}
+
+
+def test_lexical_modes_need_content_in_memory(service, monkeypatch):
+    monkeypatch.setattr(haystack_service, "LAZY_CONTENT", True)
+    service.add_documents([dict(n) for n in NOTES], "alice")
+    service.partitions.drop("alice")
+
+    hits, _, _ = service._retrieve("rocket launch", "alice", {}, {}, "vector")
+    assert hits[0].parent_id == "rocket"
+    with pytest.raises(ValueError, match="lexical index"):
+        service._retrieve("rocket launch", "alice", {}, {}, "hybrid")
@@ -0,0 +1,22 @@
+import pytest
+
+from service_manager import parse_request, recover_request_id
+
+
+def test_parses_tagged_and_untagged_requests():
+    assert parse_request('{"id": "r1", "command": "query", "args": ["u", "q"], "trace_id": "t"}') == \
+        ("r1", "query", ["u", "q"], "t", False)
+    assert parse_request('["query", "u", "q"]') == (None, "query", ["u", "q"], None, False)
+    with pytest.raises(ValueError):
+        parse_request('{"id": "r1"}')
+
+
+@pytest.mark.parametrize("line, request_id", [
+    ('{"id": "r1"}', "r1"),
+    ('{"id": "r\\"2", "command": ', 'r"2'),
+    ('{"command": "query", "id": 7, "args": [}', 7),
+    ('["query"]', None),
+    ("not json", None),
+])
+def test_request_id_is_recovered_from_rejected_lines(line, request_id):
+    assert recover_request_id(line) == request_id
@@ -0,0 +1,168 @@
+import time
+
+import numpy as np
+import pytest
+from haystack import Document
+
+from vector_index import IVFIndex, VectorIndex
+
+
+def clustered(size, dimension=32, clusters=8, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimension))
+    vectors = centers[rng.integers(0, clusters, size=size)] + rng.normal(scale=0.3, size=(size, dimension))
+    return vectors.astype(np.float32)
+
+
+def documents(vectors, offset=0):
+    return [Document(id=str(offset + i), content=f"doc {offset + i}", embedding=vector.tolist())
+            for i, vector in enumerate(vectors)]
+
+
+def wait_until_trained(index, timeout=10.0):
+    deadline = time.time() + timeout
+    while not index.is_trained or index._training_scheduled:
+        assert time.time() < deadline, "IVF training did not finish"
+        time.sleep(0.01)
+
+
+def test_exact_search_ranks_by_cosine_similarity():
+    index = VectorIndex()
+    index.upsert(documents(np.eye(4, dtype=np.float32)))
+
+    hits = index.search([0.9, 0.1, 0.0, 0.0], top_k=2)
+
+    assert [doc.id for doc, _ in hits] == ["0", "1"]
+    assert hits[0][1] > hits[1][1]
+
+
+def test_upsert_replaces_and_delete_removes():
+    index = VectorIndex()
+    index.upsert(documents(np.eye(3, dtype=np.float32)))
+    index.upsert([Document(id="0", content="moved", embedding=[0.0, 0.0, 1.0])])
+    assert len(index) == 3
+    assert index.get("0").content == "moved"
+
+    assert index.delete(["1", "missing"]) == 1
+    assert "1" not in index
+    assert all(doc.id != "1" for doc, _ in index.search([0.0, 1.0, 0.0], top_k=3))
+
+
+def test_documents_are_stored_without_their_embedding():
+    index = VectorIndex()
+    index.upsert(documents(clustered(10)))
+
+    assert all(doc.embedding is None for doc in index.documents())
+    assert index.memory_bytes() == index._matrix.nbytes + sum(len(doc.content) for doc in index.documents())
+
+
+def test_search_is_unchanged_by_compaction():
+    vectors = clustered(200)
+    index = VectorIndex()
+    index.upsert(documents(vectors))
+    index.delete([str(i) for i in range(150)])
+
+    hits = index.search(vectors[170], top_k=1)
+
+    assert len(index) == 50
+    assert hits[0][0].id == "170"
+
+
+def test_ivf_with_every_list_probed_matches_exact_search():
+    vectors = clustered(500)
+    index = IVFIndex(nlist=16, min_train_size=1, auto_train=False)
+    index.upsert(documents(vectors))
+    assert index.train()
+
+    for query in vectors[:20]:
+        ivf = [doc.id for doc, _ in index.search(query, top_k=5, nprobe=16)]
+        exact = [doc.id for doc, _ in index.exact_search(query, top_k=5)]
+        assert ivf == exact
+
+
+def test_ivf_recall_with_few_probes():
+    vectors = clustered(1000)
+    index = IVFIndex(nlist=16, nprobe=4, min_train_size=1, auto_train=False)
+    index.upsert(documents(vectors))
+    index.train()
+
+    found = total = 0
+    for query in vectors[:50]:
+        exact = {doc.id for doc, _ in index.exact_search(query, top_k=5)}
+        found += len(exact & {doc.id for doc, _ in index.search(query, top_k=5)})
+        total += len(exact)
+
+    assert found / total >= 0.9
+
+
+def test_ivf_trains_in_the_background_once_large_enough():
+    vectors = clustered(300)
+    index = IVFIndex(nlist=8, min_train_size=200)
+    for doc in documents(vectors):
+        index.upsert([doc])
+        # Searches are answered throughout, exactly until the quantizer is ready
+        assert index.search(doc.embedding, top_k=1)[0][0].id == doc.id
+
+    wait_until_trained(index)
+    assert sum(len(rows) for rows in index._lists) == len(index)
+
+
+def test_ivf_training_overtaken_by_clear_is_discarded():
+    index = IVFIndex(nlist=4, min_train_size=1, auto_train=False)
+    index.upsert(documents(clustered(100)))
+    fit = IVFIndex._kmeans
+
+    def fit_then_clear(*args):
+        index.clear()
+        return fit(*args)
+
+    index._kmeans = fit_then_clear
+
+    assert index.train() is False
+    assert not index.is_trained
+
+
+def test_ivf_rows_written_during_training_are_assigned():
+    vectors = clustered(101)
+    index = IVFIndex(nlist=4, min_train_size=1, auto_train=False)
+    index.upsert(documents(vectors[:100]))
+    fit = IVFIndex._kmeans
+
+    def fit_while_writing(*args):
+        index.upsert(documents(vectors[100:], offset=100))
+        index.delete(["0"])
+        return fit(*args)
+
+    index._kmeans = fit_while_writing
+
+    assert index.train()
+    listed = {index._row_ids[row] for rows in index._lists for row in rows}
+    assert "100" in listed and "0" not in listed
+    assert len(listed) == len(index) == 100
+    assert index.search(vectors[100], top_k=1, nprobe=4)[0][0].id == "100"
+
+
+def test_ivf_quantizer_round_trips_through_disk(tmp_path):
+    vectors = clustered(200)
+    path = str(tmp_path / "quantizer.npz")
+    trained = IVFIndex(nlist=8, min_train_size=1, auto_train=False, state_path=path)
+    trained.upsert(documents(vectors))
+    trained.train()
+
+    restored = IVFIndex(nlist=8, min_train_size=1, auto_train=False, state_path=path)
+    restored.upsert(documents(vectors))
+
+    assert restored.is_trained
+    np.testing.assert_allclose(restored._centroids, trained._centroids)
+
+
+@pytest.mark.parametrize("index", [VectorIndex(), IVFIndex(min_train_size=1, auto_train=False)])
+def test_bulk_load_and_export_round_trip(index):
+    vectors = clustered(50)
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    index.bulk_load([Document(id=str(i), content="") for i in range(50)], normalized)
+
+    docs, matrix = index.export()
+
+    assert [doc.id for doc in docs] == [str(i) for i in range(50)]
+    np.testing.assert_allclose(matrix, normalized)
@@ -0,0 +1,13 @@
+import re
+
+# Rough characters-per-token ratio, used wherever text is sized in tokens
+CHARS_PER_TOKEN = 4
+
+# Blank lines between paragraphs, and whitespace after sentence-ending punctuation
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text):
+    """Approximate token count of a piece of text"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
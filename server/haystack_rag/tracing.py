@@ -0,0 +1,229 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 200
+# Segments kept per trace ID: one per traced command, plus background jobs
+MAX_SEGMENTS_PER_TRACE = 8
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+_current_span = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+    """One timed stage of a trace; start and end are offsets from the trace start in seconds"""
+
+    __slots__ = ("index", "name", "parent", "attrs", "start", "end", "thread")
+
+    def __init__(self, index, name, parent, attrs, start):
+        self.index = index
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.start = start
+        self.end = None
+        self.thread = threading.current_thread().name
+
+    @property
+    def duration_ms(self):
+        return (self.end - self.start) * 1000 if self.end is not None else None
+
+    def to_dict(self):
+        span = {
+            "name": self.name,
+            "start_ms": round(self.start * 1000, 3),
+            "duration_ms": round(self.duration_ms, 3) if self.end is not None else None,
+            "thread": self.thread
+        }
+        if self.parent is not None:
+            span["parent"] = self.parent
+        if self.attrs:
+            span["attrs"] = self.attrs
+        return span
+
+
+class Trace:
+    """Spans recorded while handling one command under a request's trace ID"""
+
+    def __init__(self, trace_id, name, sampled=False):
+        self.id = trace_id
+        self.name = name
+        self.sampled = sampled
+        self.attrs = {}
+        self.spans = []
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = None
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def finish(self):
+        self.duration_ms = self.elapsed() * 1000
+
+    def to_dict(self):
+        return {
+            "trace_id": self.id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 3) if self.duration_ms is not None else None,
+            "attrs": self.attrs,
+            # Spans are appended from worker threads too, so copy before reading
+            "spans": [span.to_dict() for span in list(self.spans)]
+        }
+
+
+class _Timing:
+    """Stand-in for a span outside any trace, still measuring its duration"""
+
+    __slots__ = ("start", "end")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def duration_ms(self):
+        return (self.end - self.start) * 1000 if self.end is not None else None
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Record the enclosed block as a span of the current trace
+
+    Yields an object whose duration_ms is set once the block exits, so
+    callers can reuse the measurement; outside a trace nothing is recorded.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        timing = _Timing()
+        try:
+            yield timing
+        finally:
+            timing.end = time.perf_counter()
+        return
+
+    parent = _current_span.get()
+    current = Span(len(trace.spans), name, parent.index if parent is not None else None, attrs, trace.elapsed())
+    trace.spans.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        current.end = trace.elapsed()
+        _current_span.reset(token)
+
+
+def annotate(**attrs):
+    """Attach attributes to the current trace"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+def current_trace_id():
+    trace = _current_trace.get()
+    return trace.id if trace is not None else None
+
+
+def propagate(fn):
+    """Wrap fn to run in the caller's trace context, for handing work to a thread pool"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+class Tracer:
+    """Starts traces and keeps the most recent ones for dumping by trace ID
+
+    Every traced command is kept in a bounded buffer. A sample_rate share of
+    them, and any slower than slow_ms, are also logged as one JSON line.
+    """
+
+    def __init__(self, sample_rate=None, slow_ms=None, buffer_size=None):
+        self.sample_rate = float(sample_rate if sample_rate is not None else os.getenv("TRACE_SAMPLE_RATE", 0.0))
+        self.slow_ms = float(slow_ms if slow_ms is not None else os.getenv("TRACE_SLOW_MS", 0))
+        self.buffer_size = int(buffer_size or os.getenv("TRACE_BUFFER_SIZE", DEFAULT_BUFFER_SIZE))
+        # trace_id -> list of finished Trace segments, oldest trace first
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+        self.started = 0
+        self.logged = 0
+
+    @contextlib.contextmanager
+    def trace(self, trace_id=None, name="request", sampled=None):
+        """Run the enclosed block under a trace; nested calls reuse the active one"""
+        if _current_trace.get() is not None:
+            yield _current_trace.get()
+            return
+        if sampled is None:
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        trace = Trace(trace_id or uuid.uuid4().hex, name, sampled)
+        token = _current_trace.set(trace)
+        self.started += 1
+        try:
+            yield trace
+        except Exception as e:
+            trace.attrs["error"] = str(e)
+            raise
+        finally:
+            _current_trace.reset(token)
+            trace.finish()
+            self._keep(trace)
+
+    def _keep(self, trace):
+        with self._lock:
+            segments = self._traces.pop(trace.id, [])
+            segments.append(trace)
+            self._traces[trace.id] = segments[-MAX_SEGMENTS_PER_TRACE:]
+            while len(self._traces) > self.buffer_size:
+                self._traces.popitem(last=False)
+        slow = self.slow_ms > 0 and trace.duration_ms >= self.slow_ms
+        if trace.sampled or slow:
+            self.logged += 1
+            logger.info(f"🧵 {'Slow trace' if slow else 'Trace'} {trace.id} ({trace.name}, "
+                        f"{trace.duration_ms:.2f}ms): {json.dumps(trace.to_dict())}")
+
+    def get(self, trace_id):
+        """Recorded segments of a trace, oldest first, or None if it is not in the buffer"""
+        with self._lock:
+            segments = self._traces.get(trace_id)
+            return [trace.to_dict() for trace in segments] if segments is not None else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buffered": len(self._traces),
+                "started": self.started,
+                "logged": self.logged,
+                "sample_rate": self.sample_rate,
+                "slow_ms": self.slow_ms
+            }
+
+
+class TraceLogFilter(logging.Filter):
+    """Adds the active trace ID to log records as %(trace)s, empty outside a trace"""
+
+    def filter(self, record):
+        trace_id = current_trace_id()
+        record.trace = f"[{trace_id}] " if trace_id else ""
+        return True
+
+
+def install_log_context(fmt="%(levelname)s:%(name)s:%(trace)s%(message)s"):
+    """Prefix log lines written through the root handlers with the trace ID"""
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceLogFilter())
+        handler.setFormatter(logging.Formatter(fmt))
+
+
+# Shared by the service manager, which starts traces, and the code recording spans
+tracer = Tracer()
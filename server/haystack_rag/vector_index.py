@@ -0,0 +1,528 @@
+import dataclasses
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Rows scored against the centroids at once when assigning vectors to lists
+ASSIGN_CHUNK_ROWS = 8192
+
+
+class VectorIndex:
+    """Exact cosine-similarity index over a contiguous, pre-normalized float32 matrix
+
+    The matrix is the only copy of the vectors: documents are stored
+    without their embedding. Rows freed by deletes go on a free list and are reused by later inserts,
+    so appends and deletes are O(1) amortized. The matrix is compacted when
+    more than half of it is free.
+    """
+
+    def __init__(self, initial_capacity=64):
+        self._lock = threading.RLock()
+        self._initial_capacity = initial_capacity
+        self.clear()
+
+    def clear(self):
+        """Drop every document from the index"""
+        with self._lock:
+            self._dimension = None
+            self._matrix = None
+            self._size = 0  # Rows in use, including freed ones below the high-water mark
+            self._valid = np.zeros(0, dtype=bool)
+            self._row_ids = []
+            self._row_docs = []
+            self._id_to_row = {}
+            self._free_rows = []
+            self._content_bytes = 0
+
+    def __len__(self):
+        return len(self._id_to_row)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._id_to_row
+
+    @property
+    def dimension(self):
+        return self._dimension
+
+    def memory_bytes(self):
+        """Approximate memory held by the index: the matrix plus document content"""
+        matrix_bytes = self._matrix.nbytes if self._matrix is not None else 0
+        return matrix_bytes + self._content_bytes
+
+    def get(self, doc_id):
+        """Return the stored document for an ID, or None"""
+        row = self._id_to_row.get(doc_id)
+        return self._row_docs[row] if row is not None else None
+
+    def documents(self):
+        """All stored documents"""
+        with self._lock:
+            return [self._row_docs[row] for row in self._id_to_row.values()]
+
+    def _ensure_capacity(self, dimension):
+        if self._matrix is None:
+            self._dimension = dimension
+            self._matrix = np.zeros((self._initial_capacity, dimension), dtype=np.float32)
+            self._valid = np.zeros(self._initial_capacity, dtype=bool)
+        elif self._size == self._matrix.shape[0]:
+            # Double capacity so appends stay O(1) amortized
+            new_capacity = self._matrix.shape[0] * 2
+            matrix = np.zeros((new_capacity, self._dimension), dtype=np.float32)
+            matrix[:self._size] = self._matrix[:self._size]
+            valid = np.zeros(new_capacity, dtype=bool)
+            valid[:self._size] = self._valid[:self._size]
+            self._matrix, self._valid = matrix, valid
+
+    def upsert(self, documents):
+        """Insert or replace documents; those without an embedding are skipped"""
+        added = 0
+        with self._lock:
+            for doc in documents:
+                if doc.embedding is None:
+                    continue
+                vector = self._normalize(doc.embedding)
+                if self._dimension is not None and vector.shape[0] != self._dimension:
+                    raise ValueError(
+                        f"Embedding dimension {vector.shape[0]} for document {doc.id} "
+                        f"does not match index dimension {self._dimension}"
+                    )
+
+                row = self._id_to_row.get(doc.id)
+                if row is None:
+                    if self._free_rows:
+                        row = self._free_rows.pop()
+                    else:
+                        self._ensure_capacity(vector.shape[0])
+                        row = self._size
+                        self._size += 1
+                        self._row_ids.append(None)
+                        self._row_docs.append(None)
+                    self._id_to_row[doc.id] = row
+                elif self._row_docs[row] is not None:
+                    self._content_bytes -= len(self._row_docs[row].content or "")
+                self._content_bytes += len(doc.content or "")
+                self._matrix[row] = vector
+                self._valid[row] = True
+                self._row_ids[row] = doc.id
+                self._row_docs[row] = dataclasses.replace(doc, embedding=None)
+                self._on_row_set(row)
+                added += 1
+        return added
+
+    def delete(self, document_ids):
+        """Remove documents by ID; unknown IDs are ignored"""
+        removed = 0
+        with self._lock:
+            for doc_id in document_ids:
+                row = self._id_to_row.pop(doc_id, None)
+                if row is None:
+                    continue
+                self._content_bytes -= len(self._row_docs[row].content or "")
+                self._valid[row] = False
+                self._row_ids[row] = None
+                self._row_docs[row] = None
+                self._free_rows.append(row)
+                self._on_row_freed(row)
+                removed += 1
+            if self._size and len(self._free_rows) > self._size // 2:
+                self._compact()
+        return removed
+
+    def bulk_load(self, documents, matrix):
+        """Replace the index contents with pre-normalized vectors, one row per document
+
+        The matrix is used as-is (it may be a memory-mapped snapshot), so
+        loading does no per-document work beyond bookkeeping.
+        """
+        with self._lock:
+            self.clear()
+            if len(documents) == 0:
+                return
+            self._matrix = matrix
+            self._dimension = matrix.shape[1]
+            self._size = len(documents)
+            self._valid = np.ones(self._size, dtype=bool)
+            self._row_ids = [doc.id for doc in documents]
+            self._row_docs = list(documents)
+            self._id_to_row = {doc_id: row for row, doc_id in enumerate(self._row_ids)}
+            self._content_bytes = sum(len(doc.content or "") for doc in documents)
+            self._on_bulk_loaded()
+
+    def export(self):
+        """Live documents and their normalized vectors, in matching order"""
+        with self._lock:
+            rows = sorted(self._id_to_row.values())
+            matrix = self._matrix[rows] if rows else np.zeros((0, self._dimension or 0), dtype=np.float32)
+            return [self._row_docs[row] for row in rows], matrix
+
+    def _on_bulk_loaded(self):
+        """Hook for subclasses: the index was replaced by bulk_load"""
+
+    def _on_row_set(self, row):
+        """Hook for subclasses: a row was written"""
+
+    def _on_row_freed(self, row):
+        """Hook for subclasses: a row was freed"""
+
+    def _compact(self):
+        """Pack live rows to the front of the matrix and drop the free list"""
+        rows = sorted(self._id_to_row.values())
+        self._matrix[:len(rows)] = self._matrix[rows]
+        self._valid[:] = False
+        self._valid[:len(rows)] = True
+        self._row_ids = [self._row_ids[row] for row in rows]
+        self._row_docs = [self._row_docs[row] for row in rows]
+        self._id_to_row = {doc_id: row for row, doc_id in enumerate(self._row_ids)}
+        self._size = len(rows)
+        self._free_rows = []
+        logger.debug(f"Compacted vector index to {self._size} rows")
+        return rows
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _top_k(self, rows, scores, top_k):
+        """Pick the best top_k rows given their scores"""
+        k = min(top_k, len(rows))
+        if k <= 0:
+            return []
+        if k < len(rows):
+            best = np.argpartition(scores, -k)[-k:]
+        else:
+            best = np.arange(len(rows))
+        best = best[np.argsort(scores[best])[::-1]]
+        return [(self._row_docs[rows[i]], float(scores[i])) for i in best if np.isfinite(scores[i])]
+
+    def search(self, query_embedding, top_k=5):
+        """Return up to top_k (document, cosine similarity) pairs, best first"""
+        with self._lock:
+            if not self._id_to_row:
+                return []
+            query = self._normalize(query_embedding)
+            scores = self._matrix[:self._size] @ query
+            scores[~self._valid[:self._size]] = -np.inf
+            return self._top_k(np.arange(self._size), scores, min(top_k, len(self._id_to_row)))
+
+
+class IVFIndex(VectorIndex):
+    """Approximate index: an inverted file over k-means clusters of the normalized vectors
+
+    Vectors are stored exactly as in VectorIndex; a query scores only the rows
+    in its nprobe nearest clusters. Below min_train_size vectors, or before the
+    quantizer is trained, searches fall back to exact brute force. nlist and
+    nprobe trade recall for speed; the trained centroids can be saved and
+    reloaded so a restart does not need to retrain.
+
+    With auto_train, reaching min_train_size (or growing retrain_growth-fold
+    since the last training) trains on a background thread; searches keep
+    using the previous centroids, or exact search, until the new ones are in.
+    """
+
+    def __init__(self, nlist=0, nprobe=8, min_train_size=2048, retrain_growth=4.0,
+                 state_path=None, initial_capacity=64, auto_train=True):
+        self.nlist = nlist  # 0 picks ~4 * sqrt(n) at training time
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.retrain_growth = retrain_growth
+        self.state_path = state_path
+        self.auto_train = auto_train
+        self._centroids = None
+        self._trained_size = 0
+        # Bumped whenever row numbers change wholesale, invalidating a training in progress
+        self._epoch = 0
+        # Rows written or freed while a training runs, reassigned when it finishes
+        self._dirty_rows = None
+        self._train_lock = threading.Lock()
+        self._training_scheduled = False
+        super().__init__(initial_capacity=initial_capacity)
+        if state_path:
+            self.load_quantizer(state_path)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._epoch += 1
+            self._assign = np.full(0, -1, dtype=np.int32)
+            self._lists = [set() for _ in range(len(self._centroids))] if self._centroids is not None else []
+
+    @property
+    def is_trained(self):
+        return self._centroids is not None
+
+    def _ensure_assign_capacity(self):
+        if self._assign.shape[0] < self._matrix.shape[0]:
+            assign = np.full(self._matrix.shape[0], -1, dtype=np.int32)
+            assign[:self._assign.shape[0]] = self._assign
+            self._assign = assign
+
+    def _on_row_set(self, row):
+        self._ensure_assign_capacity()
+        self._unassign(row)
+        if self._dirty_rows is not None:
+            self._dirty_rows.add(row)
+        if self._centroids is not None and self._centroids.shape[1] != self._dimension:
+            logger.warning("IVF quantizer dimension does not match embeddings, discarding it")
+            self._centroids = None
+            self._lists = []
+            self._assign[:] = -1
+        if self._centroids is not None:
+            cluster = int(np.argmax(self._centroids @ self._matrix[row]))
+            self._assign[row] = cluster
+            self._lists[cluster].add(row)
+            if len(self) > self._trained_size * self.retrain_growth:
+                self._train_in_background()
+        elif len(self) >= self.min_train_size:
+            self._train_in_background()
+
+    def _on_row_freed(self, row):
+        self._unassign(row)
+        if self._dirty_rows is not None:
+            self._dirty_rows.add(row)
+
+    def _train_in_background(self):
+        """Start a training thread unless one is already pending (called under the index lock)"""
+        if not self.auto_train or self._training_scheduled:
+            return
+        self._training_scheduled = True
+
+        def run():
+            try:
+                self.train()
+            except Exception as e:
+                logger.error(f"IVF quantizer training failed: {str(e)}")
+            finally:
+                with self._lock:
+                    self._training_scheduled = False
+
+        threading.Thread(target=run, name="ivf-train", daemon=True).start()
+
+    def _on_bulk_loaded(self):
+        self._assign = np.full(self._matrix.shape[0], -1, dtype=np.int32)
+        if self._centroids is not None and self._centroids.shape[1] != self._dimension:
+            logger.warning("IVF quantizer dimension does not match embeddings, discarding it")
+            self._centroids = None
+        if self._centroids is not None:
+            rows = np.arange(self._size)
+            self._assign[rows] = self._assign_rows(rows)
+            self._rebuild_lists()
+        else:
+            self._lists = []
+            if self._size >= self.min_train_size:
+                self._train_in_background()
+
+    def _unassign(self, row):
+        cluster = self._assign[row]
+        if cluster >= 0:
+            self._lists[cluster].discard(row)
+            self._assign[row] = -1
+
+    def _compact(self):
+        old_assign = self._assign.copy()
+        self._epoch += 1
+        rows = super()._compact()
+        self._assign[:] = -1
+        self._assign[:len(rows)] = old_assign[rows]
+        self._rebuild_lists()
+        return rows
+
+    def _rebuild_lists(self):
+        self._lists = [set() for _ in range(len(self._centroids))] if self._centroids is not None else []
+        if self._centroids is None:
+            return
+        for row in np.flatnonzero(self._assign[:self._size] >= 0):
+            self._lists[self._assign[row]].add(int(row))
+
+    def _assign_rows(self, rows, centroids=None):
+        """Nearest-centroid assignment for a set of rows, in chunks to bound memory"""
+        centroids = self._centroids if centroids is None else centroids
+        assignments = np.empty(len(rows), dtype=np.int32)
+        for i in range(0, len(rows), ASSIGN_CHUNK_ROWS):
+            chunk = rows[i:i + ASSIGN_CHUNK_ROWS]
+            assignments[i:i + len(chunk)] = np.argmax(self._matrix[chunk] @ centroids.T, axis=1)
+        return assignments
+
+    @staticmethod
+    def _kmeans(data, nlist, iterations, rng):
+        """Spherical k-means centroids of the rows of data"""
+        centroids = data[rng.choice(len(data), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(data @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, data)
+            counts = np.bincount(labels, minlength=nlist)
+            empty = counts == 0
+            # Re-seed empty clusters from random points
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.maximum(norms, 1e-12)
+        return centroids.astype(np.float32)
+
+    def train(self, iterations=10, sample_size=65536, seed=0):
+        """Fit the coarse quantizer with spherical k-means and reassign every vector
+
+        The index lock is only held to copy the sample, to copy each chunk of
+        rows being assigned and to swap the result in, so searches and writes
+        carry on meanwhile. Returns whether the new centroids were installed;
+        a training overtaken by clear, bulk_load or compaction is dropped.
+        """
+        with self._train_lock:
+            with self._lock:
+                rows = np.flatnonzero(self._valid[:self._size])
+                if len(rows) == 0:
+                    return False
+                nlist = self.nlist or max(1, int(4 * np.sqrt(len(rows))))
+                nlist = min(nlist, len(rows))
+                rng = np.random.default_rng(seed)
+                sample = rows if len(rows) <= sample_size else rng.choice(rows, sample_size, replace=False)
+                data = self._matrix[sample]
+                epoch = self._epoch
+                self._dirty_rows = set()
+            try:
+                centroids = self._kmeans(data, nlist, iterations, rng)
+
+                assignments = np.empty(len(rows), dtype=np.int32)
+                for i in range(0, len(rows), ASSIGN_CHUNK_ROWS):
+                    with self._lock:
+                        if self._epoch != epoch:
+                            return False
+                        chunk = self._matrix[rows[i:i + ASSIGN_CHUNK_ROWS]]
+                    assignments[i:i + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+
+                with self._lock:
+                    if self._epoch != epoch or centroids.shape[1] != self._dimension:
+                        return False
+                    self._centroids = centroids
+                    self._trained_size = len(rows)
+                    self._ensure_assign_capacity()
+                    self._assign[:] = -1
+                    self._assign[rows] = assignments
+                    # Rows touched during training: freed ones drop out, rewritten ones are reassigned
+                    dirty = np.array(sorted(self._dirty_rows), dtype=np.int64)
+                    if len(dirty):
+                        self._assign[dirty] = -1
+                        live = dirty[self._valid[dirty]]
+                        if len(live):
+                            self._assign[live] = self._assign_rows(live)
+                    self._rebuild_lists()
+            finally:
+                with self._lock:
+                    self._dirty_rows = None
+            logger.info(f"Trained IVF quantizer with {nlist} lists over {len(rows)} vectors")
+            if self.state_path:
+                self.save_quantizer(self.state_path)
+            return True
+
+    def save_quantizer(self, path):
+        """Persist the trained centroids"""
+        if self._centroids is None:
+            return
+        with open(path, "wb") as f:
+            np.savez(f, centroids=self._centroids, trained_size=self._trained_size)
+
+    def load_quantizer(self, path):
+        """Load previously trained centroids, if present"""
+        try:
+            with np.load(path) as state:
+                self._centroids = state["centroids"].astype(np.float32)
+                self._trained_size = int(state["trained_size"])
+            self._lists = [set() for _ in range(len(self._centroids))]
+            logger.info(f"Loaded IVF quantizer with {len(self._centroids)} lists from {path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable IVF quantizer at {path}: {str(e)}")
+            self._centroids = None
+
+    def search(self, query_embedding, top_k=5, nprobe=None):
+        """Approximate search over the nprobe closest clusters"""
+        with self._lock:
+            if self._centroids is None or len(self) < self.min_train_size:
+                return super().search(query_embedding, top_k)
+            query = self._normalize(query_embedding)
+            nprobe = min(nprobe or self.nprobe, len(self._centroids))
+            centroid_scores = self._centroids @ query
+            probes = np.argpartition(centroid_scores, -nprobe)[-nprobe:]
+            rows = np.fromiter(
+                (row for cluster in probes for row in self._lists[cluster]),
+                dtype=np.int64
+            )
+            if len(rows) == 0:
+                return []
+            scores = self._matrix[rows] @ query
+            return self._top_k(rows, scores, top_k)
+
+    def exact_search(self, query_embedding, top_k=5):
+        """Brute-force search over the same vectors, for recall measurement"""
+        return VectorIndex.search(self, query_embedding, top_k)
+
+
+def create_vector_index(backend=None, name=None):
+    """Build the vector index backend named by VECTOR_INDEX_BACKEND ("exact" or "ivf")
+
+    With IVF_STATE_DIR set, each named index keeps its trained quantizer in
+    its own file in that directory.
+    """
+    backend = (backend or os.getenv("VECTOR_INDEX_BACKEND", "exact")).lower()
+    if backend == "exact":
+        return VectorIndex()
+    if backend == "ivf":
+        state_dir = os.getenv("IVF_STATE_DIR")
+        state_path = None
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+            safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in (name or "default"))
+            state_path = os.path.join(state_dir, f"{safe_name}.ivf.npz")
+        return IVFIndex(
+            nlist=int(os.getenv("IVF_NLIST", 0)),
+            nprobe=int(os.getenv("IVF_NPROBE", 8)),
+            min_train_size=int(os.getenv("IVF_MIN_TRAIN_SIZE", 2048)),
+            state_path=state_path
+        )
+    raise ValueError(f"Unknown vector index backend: {backend}")
+
+
+def recall_report(index, queries, top_k=5, nprobes=(1, 2, 4, 8, 16, 32)):
+    """Measure recall@k and latency of an IVFIndex against exact search on the same vectors"""
+    def percentile(values, q):
+        return round(float(np.percentile(values, q)), 3) if values else 0.0
+
+    exact_ids, exact_ms = [], []
+    for query in queries:
+        start = time.perf_counter()
+        hits = index.exact_search(query, top_k)
+        exact_ms.append((time.perf_counter() - start) * 1000)
+        exact_ids.append({doc.id for doc, _ in hits})
+
+    report = {
+        "documents": len(index),
+        "queries": len(queries),
+        "top_k": top_k,
+        "nlist": len(index._centroids) if index.is_trained else 0,
+        "exact": {"p50_ms": percentile(exact_ms, 50), "p95_ms": percentile(exact_ms, 95)},
+        "ann": []
+    }
+    for nprobe in nprobes:
+        recalls, ann_ms = [], []
+        for query, expected in zip(queries, exact_ids):
+            start = time.perf_counter()
+            hits = index.search(query, top_k, nprobe=nprobe)
+            ann_ms.append((time.perf_counter() - start) * 1000)
+            if expected:
+                recalls.append(len(expected & {doc.id for doc, _ in hits}) / len(expected))
+        p50 = percentile(ann_ms, 50)
+        report["ann"].append({
+            "nprobe": nprobe,
+            f"recall@{top_k}": round(float(np.mean(recalls)), 4) if recalls else 0.0,
+            "p50_ms": p50,
+            "p95_ms": percentile(ann_ms, 95),
+            "speedup_p50": round(report["exact"]["p50_ms"] / p50, 2) if p50 else 0.0
+        })
+    return report
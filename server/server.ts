@@ -3,6 +3,8 @@ import cors from 'cors';
 import compression from 'compression';
 import { PythonShell } from 'python-shell';
 import dotenv from 'dotenv';
+import { randomUUID } from 'crypto';
+import { AsyncLocalStorage } from 'async_hooks';
 
 // Load environment variables
 dotenv.config();
@@ -12,30 +14,95 @@ app.use(cors());
 app.use(compression() as express.RequestHandler);
 app.use(express.json());
 
+// Every request gets a trace ID (the caller's X-Trace-Id, or a new one) that
+// is sent with each command it issues, so Python logs and spans can be tied
+// back to it. With X-Trace: 1 the collected trace is returned in the reply.
+type TraceContext = { traceId: string; dump: boolean };
+const traceContext = new AsyncLocalStorage<TraceContext>();
+
+app.use((req, res, next) => {
+  const traceId = req.get('X-Trace-Id') || randomUUID();
+  res.setHeader('X-Trace-Id', traceId);
+  traceContext.run({ traceId, dump: req.get('X-Trace') === '1' }, next);
+});
+
 const PORT = process.env.PORT || 3001;
 
 // Create persistent Python shell for RAG service
 let serviceShell: PythonShell | null = null;
 let serverReady = false;
 
+// Startup includes the Ollama warmup, which is slow on a cold model
+const SERVICE_READY_TIMEOUT_MS = Number(process.env.SERVICE_READY_TIMEOUT_MS || 120000);
+
+// Requests in flight, keyed by request ID; replies can arrive in any order
+type PendingRequest = {
+  resolve: (value: any) => void;
+  reject: (reason: Error) => void;
+  timeoutId: NodeJS.Timeout;
+  // Streaming commands: called for each intermediate frame
+  onFrame?: (frame: any) => void;
+};
+const pendingRequests = new Map<string, PendingRequest>();
+
+// Time allowed without any reply; each streamed frame restarts the clock
+const COMMAND_TIMEOUT_MS = 30000;
+
+const armTimeout = (id: string) => setTimeout(() => {
+  const pending = pendingRequests.get(id);
+  if (pending) {
+    pendingRequests.delete(id);
+    pending.reject(new Error('Command timed out'));
+  }
+}, COMMAND_TIMEOUT_MS);
+
+const rejectAllPending = (error: Error) => {
+  for (const [id, pending] of pendingRequests) {
+    clearTimeout(pending.timeoutId);
+    pending.reject(error);
+    pendingRequests.delete(id);
+  }
+};
+
+// Route a reply line from the service manager to the request it answers
+const handleServiceMessage = (message: string) => {
+  let response: any;
+  try {
+    response = JSON.parse(message);
+  } catch (error) {
+    console.error('⚠️ Invalid service manager message:', message);
+    return;
+  }
+
+  if (!response || response.id === undefined) {
+    // Readiness and untagged messages are handled elsewhere
+    return;
+  }
+
+  const pending = pendingRequests.get(response.id);
+  if (!pending) {
+    console.warn(`⚠️ Reply for unknown or timed out request ${response.id}`);
+    return;
+  }
+
+  clearTimeout(pending.timeoutId);
+  const { id, ...result } = response;
+
+  // Intermediate frames of a streaming command keep the request open
+  if (response.event === 'chunk') {
+    pending.timeoutId = armTimeout(id);
+    pending.onFrame?.(result);
+    return;
+  }
+
+  pendingRequests.delete(id);
+  pending.resolve(result);
+};
+
 const initializeService = async (): Promise<void> => {
   console.log('🚀 Initializing RAG service...');
   try {
-    // First run the initialization script and wait for it to complete
-    const initResults = await PythonShell.run('haystack_rag/initialize_service.py', { 
-      pythonPath: 'python',
-      pythonOptions: ['-u']
-    });
-    
-    // Check initialization result
-    const initResult = JSON.parse(initResults[0]);
-    if (initResult.status !== 'ready') {
-      throw new Error(initResult.error || 'Initialization failed');
-    }
-    
-    console.log('✅ Model initialized successfully');
-    
-    // Then create persistent shell for service manager
+    // The service manager warms up in its own process and signals when ready
     serviceShell = new PythonShell('haystack_rag/service_manager.py', {
       mode: 'text',
       pythonPath: 'python',
@@ -53,6 +120,7 @@ const initializeService = async (): Promise<void> => {
       console.error('❌ Service shell error:', err);
       serviceShell = null;
       serverReady = false;
+      rejectAllPending(err);
     });
 
     // Handle process exit
@@ -60,8 +128,12 @@ const initializeService = async (): Promise<void> => {
       console.log('⚠️ Service shell closed, will reinitialize on next request');
       serviceShell = null;
       serverReady = false;
+      rejectAllPending(new Error('Service shell closed'));
     });
 
+    // Dispatch replies to pending requests by ID
+    serviceShell.on('message', handleServiceMessage);
+
     // Wait for service manager to be ready
     await new Promise<void>((resolve, reject) => {
       if (!serviceShell) {
@@ -71,7 +143,7 @@ const initializeService = async (): Promise<void> => {
 
       const timeoutId = setTimeout(() => {
         reject(new Error('Service manager initialization timed out'));
-      }, 30000);
+      }, SERVICE_READY_TIMEOUT_MS);
 
       serviceShell.once('message', (message) => {
         try {
@@ -79,6 +151,9 @@ const initializeService = async (): Promise<void> => {
           if (response.status === 'ready') {
             clearTimeout(timeoutId);
             console.log('✅ Service manager ready');
+            if (response.startup) {
+              console.log('⏱️ Startup profile (ms):', response.startup);
+            }
             serverReady = true;
             resolve();
           } else {
@@ -109,8 +184,8 @@ const ensureService = async () => {
   return serviceShell;
 };
 
-// Helper function to execute command
-const executeCommand = async (command: string, ...args: string[]): Promise<any> => {
+// Helper function to execute command; streaming commands pass onFrame
+const sendCommand = async (command: string, args: string[], onFrame?: (frame: any) => void): Promise<any> => {
   if (!serverReady) {
     throw new Error('Server not ready. Please wait for initialization to complete.');
   }
@@ -121,88 +196,151 @@ const executeCommand = async (command: string, ...args: string[]): Promise<any>
   }
 
   return new Promise((resolve, reject) => {
-    let responseReceived = false;
-    const timeoutId = setTimeout(() => {
-      if (!responseReceived) {
-        shell.removeAllListeners('message');
-        shell.removeAllListeners('error');
-        reject(new Error('Command timed out'));
-      }
-    }, 30000); // 30 second timeout
+    const id = randomUUID();
+    const timeoutId = armTimeout(id);
 
-    const handleMessage = (message: string) => {
-      try {
-        clearTimeout(timeoutId);
-        responseReceived = true;
-        shell.removeAllListeners('message');
-        shell.removeAllListeners('error');
-        const response = JSON.parse(message);
-        resolve(response);
-      } catch (error) {
-        reject(error);
-      }
-    };
-
-    const handleError = (error: Error) => {
-      clearTimeout(timeoutId);
-      responseReceived = true;
-      shell.removeAllListeners('message');
-      shell.removeAllListeners('error');
-      reject(error);
-    };
+    pendingRequests.set(id, { resolve, reject, timeoutId, onFrame });
 
     try {
-      const commandStr = JSON.stringify([command, ...args]);
-      console.log('📤 Sending command:', commandStr);
-      shell.on('message', handleMessage);
-      shell.on('error', handleError);
+      const trace = traceContext.getStore();
+      const commandStr = JSON.stringify({ id, command, args, trace_id: trace?.traceId, trace: trace?.dump || undefined });
+      console.log(`📤 Sending command ${command} (${id}, trace ${trace?.traceId ?? 'none'})`);
       shell.send(commandStr);
     } catch (error) {
-      handleError(error as Error);
+      clearTimeout(timeoutId);
+      pendingRequests.delete(id);
+      reject(error as Error);
     }
   });
 };
 
+const executeCommand = (command: string, ...args: string[]): Promise<any> =>
+  sendCommand(command, args);
+
+// Resolves with the final frame after passing each chunk frame to onFrame
+const executeStreamingCommand = (command: string, onFrame: (frame: any) => void, ...args: string[]): Promise<any> =>
+  sendCommand(command, args, onFrame);
+
+// Inserts and syncs run as background jobs in the service manager; callers
+// that want the outcome poll the job instead of holding one long command
+const JOB_POLL_INTERVAL_MS = Number(process.env.JOB_POLL_INTERVAL_MS || 500);
+const JOB_WAIT_TIMEOUT_MS = Number(process.env.JOB_WAIT_TIMEOUT_MS || 30 * 60 * 1000);
+
+const submitJob = async (kind: string, ...args: string[]): Promise<string> => {
+  const result = await executeCommand('submit_job', kind, ...args);
+  if (result.error) {
+    throw new Error(result.error);
+  }
+  return result.job_id;
+};
+
+const waitForJob = async (jobId: string): Promise<any> => {
+  const deadline = Date.now() + JOB_WAIT_TIMEOUT_MS;
+  while (Date.now() < deadline) {
+    const job = await executeCommand('job_status', jobId);
+    if (job.error && !job.status) {
+      throw new Error(job.error);
+    }
+    if (job.status !== 'queued' && job.status !== 'running') {
+      return job;
+    }
+    await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+  }
+  throw new Error(`Job ${jobId} did not finish within ${JOB_WAIT_TIMEOUT_MS}ms`);
+};
+
 // Initialize service before starting server
 console.log('🌟 Starting server...');
 initializeService().then(() => {
   // API endpoint to sync all notes for a user
+  // Runs as a background job; with "async": true the job ID is returned
+  // straight away (202) for polling GET /api/rag/jobs/:jobId
   app.post('/api/rag/sync', async (req, res) => {
     try {
-      const { userId, notes } = req.body;
-      const result = await executeCommand('sync', userId, JSON.stringify(notes));
-      if (result.success) {
-        res.json({ success: true, message: result.message });
-      } else {
-        throw new Error(result.error);
+      const { userId, notes, mode } = req.body;
+      const args = mode ? [JSON.stringify(notes), mode] : [JSON.stringify(notes)];
+      const jobId = await submitJob('sync', userId, ...args);
+      if (req.body.async) {
+        return res.status(202).json({ success: true, jobId });
+      }
+      const job = await waitForJob(jobId);
+      if (job.status === 'failed') {
+        throw new Error(job.error);
       }
+      res.json({ success: true, message: job.result.message, details: job.result.details, jobId, failures: job.failures });
     } catch (error) {
       console.error('Error syncing notes:', error);
       res.status(500).json({ error: 'Failed to sync notes' });
     }
   });
 
-  // API endpoint to add a single note
+  // API endpoint to add a single note; accepts "async" like sync
   app.post('/api/rag/insert', async (req, res) => {
     try {
       const { userId, notes } = req.body;
-      const result = await executeCommand('insert', userId, JSON.stringify(notes));
-      if (result.success) {
-        res.json({ success: true, message: result.message });
-      } else {
-        throw new Error(result.error);
+      const jobId = await submitJob('insert', userId, JSON.stringify(notes));
+      if (req.body.async) {
+        return res.status(202).json({ success: true, jobId });
+      }
+      const job = await waitForJob(jobId);
+      if (job.status === 'failed') {
+        throw new Error(job.error);
       }
+      res.json({ success: true, message: job.result.message, jobId, failures: job.failures });
     } catch (error) {
       console.error('Error inserting notes:', error);
       res.status(500).json({ error: 'Failed to insert notes' });
     }
   });
 
+  // Progress, throughput and per-note failures of an insert or sync job
+  app.get('/api/rag/jobs/:jobId', async (req, res) => {
+    try {
+      const result = await executeCommand('job_status', req.params.jobId);
+      if (result.error) {
+        return res.status(404).json({ error: result.error });
+      }
+      res.json(result);
+    } catch (error) {
+      console.error('Error getting job status:', error);
+      res.status(500).json({ error: 'Failed to get job status' });
+    }
+  });
+
   // API endpoint to query the knowledge base
+  // With "stream": true the answer is sent as JSON lines: chunk frames as
+  // they are generated, then a done frame with relevant_documents and timing.
+  // "mode" selects retrieval: vector, hybrid, lexical or auto
   app.post('/api/rag/query', async (req, res) => {
+    const { userId, query, stream, mode } = req.body;
+    const queryArgs = mode ? [query, mode] : [query];
+    if (stream) {
+      res.setHeader('Content-Type', 'application/x-ndjson');
+      res.setHeader('Cache-Control', 'no-cache');
+      res.flushHeaders();
+      const writeFrame = (frame: any) => {
+        if (!res.writableEnded) {
+          res.write(JSON.stringify(frame) + '\n');
+          // Push each frame past the compression middleware's buffer
+          res.flush();
+        }
+      };
+      try {
+        const result = await executeStreamingCommand('query_stream', writeFrame, userId, ...queryArgs);
+        if (result.error) {
+          throw new Error(result.error);
+        }
+        writeFrame(result);
+      } catch (error) {
+        console.error('Error streaming query:', error);
+        writeFrame({ event: 'error', error: 'Failed to query notes' });
+      }
+      res.end();
+      return;
+    }
+
     try {
-      const { userId, query } = req.body;
-      const result = await executeCommand('query', userId, query);
+      const result = await executeCommand('query', userId, ...queryArgs);
       if (result.error) {
         throw new Error(result.error);
       }
@@ -233,6 +371,59 @@ initializeService().then(() => {
     }
   });
 
+  // Readiness probe: answers once the service manager has warmed up
+  app.get('/api/rag/health', async (req, res) => {
+    try {
+      const result = await executeCommand('health');
+      res.json(result);
+    } catch (error) {
+      console.error('Error checking service health:', error);
+      res.status(503).json({ status: 'unavailable' });
+    }
+  });
+
+  // Spans recorded for a recent request, by the trace ID in its X-Trace-Id header
+  app.get('/api/rag/traces/:traceId', async (req, res) => {
+    try {
+      const result = await executeCommand('trace', req.params.traceId);
+      if (result.error) {
+        return res.status(404).json({ error: result.error });
+      }
+      res.json(result);
+    } catch (error) {
+      console.error('Error getting trace:', error);
+      res.status(500).json({ error: 'Failed to get trace' });
+    }
+  });
+
+  // Aggregated per-stage latency histograms, counters and cache statistics
+  app.get('/api/rag/stats', async (req, res) => {
+    try {
+      const result = await executeCommand('stats');
+      if (result.error) {
+        throw new Error(result.error);
+      }
+      res.json(result);
+    } catch (error) {
+      console.error('Error getting service stats:', error);
+      res.status(503).json({ error: 'Failed to get service stats' });
+    }
+  });
+
+  // The same metrics in the Prometheus text format, for scraping
+  app.get('/metrics', async (req, res) => {
+    try {
+      const result = await executeCommand('stats', 'prometheus');
+      if (result.error) {
+        throw new Error(result.error);
+      }
+      res.type('text/plain; version=0.0.4').send(result.text);
+    } catch (error) {
+      console.error('Error getting service metrics:', error);
+      res.status(503).type('text/plain').send('# service unavailable\n');
+    }
+  });
+
   app.listen(PORT, () => {
     console.log(`✨ Server is running on port ${PORT}`);
   });